@@ -1,34 +1,57 @@
 import os
+import io
+import csv
 import logging
 import json
-import uuid
-from datetime import datetime, timezone
-from flask import Flask, request, jsonify, abort, render_template, flash, redirect, url_for, current_app, send_from_directory
-from dotenv import load_dotenv
+import base64
+import hashlib
+import zipfile
+import click
+from flask import Flask, request, jsonify, abort, render_template, flash, redirect, url_for, current_app, send_from_directory, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from config import settings
 import services
 import database
+import logconfig
+import metrics
+import profiling
+import ratelimit
+import replication
+import scheduler
+import snapshots
+import tracing
 import utils
 
-load_dotenv()
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logconfig.setup_logging()
+logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
-app.config['DATABASE'] = os.getenv("DATABASE_FILENAME", "shiosayi.db")
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
+settings.validate()
+if settings.TRUSTED_PROXY_COUNT:
+    # request.remote_addr becomes the client the proxies saw, which is what rate limits are keyed on.
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=settings.TRUSTED_PROXY_COUNT, x_proto=settings.TRUSTED_PROXY_COUNT)
+app.config['DATABASE'] = settings.DATABASE
+app.config['SECRET_KEY'] = settings.SECRET_KEY
 database.init_app(app)
-
-KOFI_TOKEN = os.getenv("KOFI_VERIFICATION_TOKEN")
-ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
-JOIN_FORM_ACCESS = os.getenv("JOIN_FORM_ACCESS", "admin")
-CDN_STORAGE_PATH = os.getenv("CDN_STORAGE_PATH")
-
-if not app.config['SECRET_KEY']:
-    raise RuntimeError("FATAL: FLASK_SECRET_KEY is not set in the environment.")
-if not KOFI_TOKEN:
-    raise RuntimeError("FATAL: KOFI_VERIFICATION_TOKEN is not set in the environment.")
-if JOIN_FORM_ACCESS == "admin" and not ADMIN_API_TOKEN:
-    raise RuntimeError("FATAL: JOIN_FORM_ACCESS is 'admin' but ADMIN_API_TOKEN is not set.")
+metrics.init_app(app)
+replication.init_app(app)
+ratelimit.init_app(app)
+profiling.init_app(app)
+metrics.register_gauge('email_outbox_pending', 'Emails waiting in the outbox queue.', services.count_pending_emails)
+metrics.register_gauge('log_queue_depth', 'Log records waiting for the writer thread.', logconfig.queue_depth)
+metrics.register_gauge('log_records_dropped', 'INFO-and-below log records dropped because the queue was full.',
+                       logconfig.dropped_records)
+metrics.register_gauge('poster_backlog', 'Poster uploads rendering or waiting for a render slot.', utils.poster_backlog)
+
+KOFI_TOKEN = settings.KOFI_VERIFICATION_TOKEN
+ADMIN_API_TOKEN = settings.ADMIN_API_TOKEN
+JOIN_FORM_ACCESS = settings.JOIN_FORM_ACCESS
+CDN_STORAGE_PATH = settings.CDN_STORAGE_PATH
+POSTER_MULTIPART_OVERHEAD = 64 * 1024
+POSTER_CACHE_SECONDS = 365 * 24 * 60 * 60
+POSTER_UPLOAD_MAX_FILES = settings.POSTER_UPLOAD_MAX_FILES
+FILMS_CACHE_SECONDS = 60
 
 def check_admin_access(access_mode, required_token):
     if access_mode == "admin":
@@ -36,6 +59,16 @@ def check_admin_access(access_mode, required_token):
         if not token or token != required_token:
             abort(403)
 
+def check_admin_bearer():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Authorization header is missing or malformed."}), 401
+
+    token = auth_header.split(' ')[1]
+    if not ADMIN_API_TOKEN or token != ADMIN_API_TOKEN:
+        return jsonify({"error": "Invalid or missing admin token."}), 403
+    return None
+
 @app.route('/join', methods=['GET', 'POST'])
 def join_form():
     check_admin_access(JOIN_FORM_ACCESS, ADMIN_API_TOKEN)
@@ -48,40 +81,50 @@ def join_form():
             flash('Both name and email are required.', 'error')
             return redirect(url_for('join_form'))
 
-        fake_payload = {
-            "verification_token": KOFI_TOKEN,
-            "message_id": str(uuid.uuid4()),
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "type": "Subscription",
-            "from_name": name,
-            "message": "Manual join from internal form.",
-            "amount": "3.00",
-            "url": "#",
-            "email": email,
-            "currency": "USD",
-            "is_subscription_payment": True,
-            "is_first_subscription_payment": True,
-            "kofi_transaction_id": f"form_generated_{str(uuid.uuid4())}",
-            "tier_name": "lover",
-        }
-
         try:
-            with app.test_client() as client:
-                logging.info(f"Internal form: dispatching fake event to /webhook for {email}")
-                response = client.post('/webhook', data={'data': json.dumps(fake_payload)})
-                if response.status_code != 200:
-                    raise Exception(f"Internal webhook call failed with status {response.status_code}. Response: {response.get_data(as_text=True)}")
-
-            flash(f"Success! Guardian '{name}' has been added. Please check your email for a welcome message.", 'success')
+            result = services.onboard_guardians([{"name": name, "email": email, "tier": "lover"}])
+            if result['created'] + result['restored'] == 0:
+                raise Exception(f"Guardian was not created: {result}")
+            # Sent right away; if that fails the email stays in the outbox for the scheduler's emails job.
+            try:
+                sent = services.send_queued_emails(limit=None, to_emails=[email.strip()])['sent']
+            except Exception as e:
+                logger.warning("Internal form: welcome email for %s left queued. Error: %s", email, e)
+                sent = 0
+            if sent:
+                flash(f"Success! Guardian '{name}' has been added. A welcome email is on its way.", 'success')
+            else:
+                flash(f"Success! Guardian '{name}' has been added. The welcome email could not be sent yet and will be retried.", 'success')
         except Exception as e:
-            logging.error(f"Internal form: failed to process event for {email}. Error: {e}")
-            flash("An error occurred while adding the guardian. The event could not be processed. Please check the server logs for details.", 'error')
+            logger.error("Internal form: failed to add guardian %s. Error: %s", email, e)
+            flash("An error occurred while adding the guardian. Please check the server logs for details.", 'error')
 
         redirect_url = url_for('join_form', token=request.form.get('admin_token'))
         return redirect(redirect_url)
 
     return render_template('join.html', admin_token=request.args.get('token'))
 
+@app.route('/admin/onboard', methods=['POST'])
+def onboard_guardians_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    if 'members' not in request.files:
+        return jsonify({"error": "Missing 'members' CSV file in the request."}), 400
+
+    # Parsed in full before anything is written, so a bad file is a 400 with nothing committed.
+    try:
+        members = list(csv.DictReader(io.StringIO(request.files['members'].read().decode('utf-8'), newline='')))
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": f"The members file is not a valid UTF-8 CSV: {e}"}), 400
+    try:
+        result = services.onboard_guardians(members)
+    except services.OnboardingConflictError as e:
+        return jsonify({"error": f"{e} Uploading the file again skips the guardians already added.",
+                        "committed": e.result}), 409
+    return jsonify(result), 201
+
 @app.route('/webhook', methods=['POST'])
 def kofi_webhook():
     if 'data' not in request.form:
@@ -100,24 +143,28 @@ def kofi_webhook():
     if (data.get("type") == "Subscription" and
         data.get("is_subscription_payment") is True and
         data.get("tier_name") is not None):
-        logging.info(f"Processing MEMBERSHIP payment for tier '{data.get('tier_name')}' from {data.get('email')}")
+        logger.info("Processing MEMBERSHIP payment for tier '%s' from %s", data.get('tier_name'), data.get('email'))
         services.process_subscription_payment(data)
     else:
-        logging.info(f"Ignoring non-membership event (type: '{data.get('type')}', tier: {data.get('tier_name')}). No action taken.")
+        logger.info("Ignoring non-membership event (type: '%s', tier: %s). No action taken.", data.get('type'), data.get('tier_name'))
 
     return jsonify({"message": "Webhook received successfully."}), 200
 
 @app.route('/admin/housekeeping', methods=['POST'])
 def housekeeping_route():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or malformed."}), 401
-    
-    token = auth_header.split(' ')[1]
-    if not ADMIN_API_TOKEN or token != ADMIN_API_TOKEN:
-        return jsonify({"error": "Invalid or missing admin token."}), 403
-
-    result = services.perform_housekeeping()
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    dry_run = request.args.get('dry_run', 'false').lower() in ('1', 'true', 'yes')
+    chunk_size = request.args.get('chunk_size', services.HOUSEKEEPING_CHUNK_SIZE, type=int)
+    if chunk_size < 1:
+        return jsonify({"error": "'chunk_size' must be a positive integer."}), 400
+
+    with scheduler.exclusive_run(database.get_db(), 'housekeeping') as acquired:
+        if not acquired:
+            return jsonify({"error": "Housekeeping is already running."}), 409
+        result = services.perform_housekeeping(chunk_size=chunk_size, dry_run=dry_run)
     return jsonify(result), 200
 
 @app.route('/suggest', methods=['POST'])
@@ -138,12 +185,16 @@ def create_suggestion():
         new_suggestion = services.add_suggestion(email, title, notes)
         return jsonify({"message": "Suggestion received successfully.", "suggestion": new_suggestion}), 201
     except Exception as e:
-        logging.error(f"Could not add suggestion: {e}")
+        logger.error("Could not add suggestion: %s", e)
         return jsonify({"error": "An internal error occurred."}), 500
 
+# The bodies of the routes clients poll are plain functions of their arguments, so that
+# asgi.py can serve the same responses without going through a Flask request.
 @app.route('/auth')
 def authenticate_guardian():
-    token = request.args.get('token')
+    return auth_response(request.args.get('token'))
+
+def auth_response(token):
     if not token:
         return jsonify({"error": "API token is required."}), 401
     
@@ -156,7 +207,9 @@ def authenticate_guardian():
 
 @app.route('/magnet/<int:film_id>')
 def get_magnet(film_id):
-    token = request.args.get('TOKEN')
+    return magnet_response(film_id, request.args.get('TOKEN'))
+
+def magnet_response(film_id, token):
     if not token:
         return jsonify({"error": "API token is required."}), 401
 
@@ -170,6 +223,75 @@ def get_magnet(film_id):
         
     return jsonify({"film_id": film_id, "magnet": magnet_link})
 
+def encode_cursor(after_id):
+    return base64.urlsafe_b64encode(json.dumps({"after_id": after_id}).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return int(json.loads(base64.urlsafe_b64decode(padded))['after_id'])
+
+@app.route('/films')
+def list_films_route():
+    try:
+        after_id = decode_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+    except (ValueError, KeyError, TypeError):
+        return jsonify({"error": "Invalid cursor."}), 400
+
+    limit = request.args.get('limit', services.FILMS_PAGE_SIZE, type=int)
+    if not 1 <= limit <= services.FILMS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {services.FILMS_MAX_PAGE_SIZE}."}), 400
+
+    fields = None
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in services.PUBLIC_FILM_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown field(s): {', '.join(unknown)}."}), 400
+
+    status = request.args.get('status')
+    if status and status not in ('orphan', 'adopted'):
+        return jsonify({"error": "status must be 'orphan' or 'adopted'."}), 400
+
+    page = services.list_films(
+        after_id=after_id,
+        limit=limit,
+        fields=fields,
+        status=status,
+        region=request.args.get('region'),
+        year_min=request.args.get('year_min', type=int),
+        year_max=request.args.get('year_max', type=int),
+        guardian_id=request.args.get('guardian_id'),
+        title=request.args.get('q')
+    )
+    body = {"films": page['films'], "next_cursor": encode_cursor(page['next_after_id']) if page['next_after_id'] else None}
+
+    response = jsonify(body)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    response.headers['Cache-Control'] = f'public, max-age={FILMS_CACHE_SECONDS}'
+    return response.make_conditional(request)
+
+@app.route('/changes')
+def list_changes_route():
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', services.CHANGES_PAGE_SIZE, type=int)
+    if since < 0 or not 1 <= limit <= services.CHANGES_MAX_PAGE_SIZE:
+        return jsonify({"error": f"since must be >= 0 and limit between 1 and {services.CHANGES_MAX_PAGE_SIZE}."}), 400
+
+    try:
+        page = services.get_changes(since=since, limit=limit)
+    except services.ChangesCompactedError as e:
+        return jsonify({"error": str(e), "resync": "/db/public", "horizon": e.horizon}), 410
+
+    ndjson = request.args.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+    if ndjson:
+        body = ''.join(json.dumps(change, separators=(',', ':')) + '\n' for change in page['changes'])
+        response = app.response_class(body, mimetype='application/x-ndjson')
+    else:
+        response = app.response_class(json.dumps(page, separators=(',', ':')), mimetype='application/json')
+    response.headers['X-Next-Since'] = str(page['next_since'])
+    response.headers['X-Has-More'] = 'true' if page['has_more'] else 'false'
+    return response
+
 @app.route('/adopt/<int:film_id>', methods=['POST'])
 def adopt_film_route(film_id):
     token = request.args.get('TOKEN')
@@ -193,16 +315,7 @@ def download_public_db():
     except FileNotFoundError:
         return jsonify({"error": "Public database file not found. Please run the publish process first."}), 404
 
-@app.route('/admin/publish', methods=['POST'])
-def publish_database():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or malformed."}), 401
-        
-    token = auth_header.split(' ')[1]
-    if not ADMIN_API_TOKEN or token != ADMIN_API_TOKEN:
-        return jsonify({"error": "Invalid or missing admin token."}), 403
-
+def publish_public_database():
     main_db_path = current_app.config['DATABASE']
     
     db_dir = os.path.join(CDN_STORAGE_PATH, "db")
@@ -210,7 +323,18 @@ def publish_database():
     
     os.makedirs(db_dir, exist_ok=True)
     
-    result = services.generate_public_database(main_db_path, public_db_full_path)
+    return services.generate_public_database(main_db_path, public_db_full_path)
+
+@app.route('/admin/publish', methods=['POST'])
+def publish_database():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    with scheduler.exclusive_run(database.get_db(), 'publish') as acquired:
+        if not acquired:
+            return jsonify({"error": "Publishing is already running."}), 409
+        result = publish_public_database()
 
     if result['status'] == 'success':
         return jsonify(result), 200
@@ -219,6 +343,9 @@ def publish_database():
 
 @app.route('/db/public.sha256')
 def get_public_db_checksum():
+    return public_db_checksum_response()
+
+def public_db_checksum_response():
     sha256_path = os.path.join(CDN_STORAGE_PATH, 'db', 'public.db.sha256')
 
     if not os.path.exists(sha256_path):
@@ -228,34 +355,412 @@ def get_public_db_checksum():
         checksum = f.read().strip()
     return f"{checksum}\n"
 
+@app.route('/db/<filename>')
+def download_public_snapshot(filename):
+    if filename not in snapshots.published_filenames():
+        abort(404)
+    directory = os.path.join(CDN_STORAGE_PATH, "db")
+    if not os.path.exists(os.path.join(directory, filename)):
+        return jsonify({"error": "Snapshot file not found. Please run the publish process first."}), 404
+    return send_from_directory(directory, filename, as_attachment=not filename.endswith('.sha256'))
+
 @app.route('/admin/upload-poster', methods=['POST'])
 def upload_poster_route():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or malformed."}), 401
-    
-    token = auth_header.split(' ')[1]
-    if not ADMIN_API_TOKEN or token != ADMIN_API_TOKEN:
-        return jsonify({"error": "Invalid or missing admin token."}), 403
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
 
-    if 'poster' not in request.files:
+    # Refuse oversized uploads before werkzeug spools the multipart body: by Content-Length when
+    # there is one, and for a chunked upload as soon as the cap is passed while parsing.
+    request.max_content_length = utils.MAX_FILE_SIZE_BYTES + POSTER_MULTIPART_OVERHEAD
+    try:
+        files = request.files
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"File is too large. Maximum size is {utils.MAX_FILE_SIZE_BYTES / 1024 / 1024} MB."}), 413
+
+    if 'poster' not in files:
         return jsonify({"error": "Missing 'poster' file in the request."}), 400
     
-    file = request.files['poster']
+    file = files['poster']
 
     if file.filename == '':
         return jsonify({"error": "No file selected."}), 400
 
-    result = utils.process_and_save_poster(file)
+    # Staging reads at most one byte past the size limit, even from a chunked upload with no
+    # Content-Length, and hashes what it read; duplicates are discarded after the fact.
+    result = utils.stage_poster(file)
+    for stage, ms in result.get('timings_ms', {}).items():
+        metrics.observe('poster_stage_seconds', {'stage': stage}, ms / 1000)
+    if not result['success']:
+        return jsonify({"error": result['error']}), 400
 
-    if result['success']:
-        return jsonify({
-            "message": "Poster uploaded and processed successfully.",
-            "url": result['url']
-        }), 201
+    sha256 = result['sha256']
+    existing = services.find_poster(sha256)
+    if existing:
+        utils.discard_staged_poster(result['id'])
+        return jsonify({"message": "Poster was already uploaded.", "url": existing['url'], "id": existing['id']}), 200
+    pending = services.find_poster_job(sha256)
+    if pending:
+        utils.discard_staged_poster(result['id'])
+        return jsonify(poster_job_body(pending)), 202
+
+    # Rendered on this worker's poster pool once the response is sent; the scheduler's posters
+    # job picks up an upload whose worker exited first.
+    poster_id = result['id']
+    services.queue_poster_job(poster_id, sha256)
+    if not utils.submit_poster_render(render_poster_job, current_app._get_current_object(), poster_id,
+                                      profiling.handoff_interval()):
+        services.cancel_poster_job(poster_id)
+        utils.discard_staged_poster(poster_id)
+        return jsonify({"error": "Poster processing is busy. Please retry shortly."}), 503, {'Retry-After': '2'}
+    return jsonify(poster_job_body(services.get_poster_job(poster_id))), 202
+
+def render_poster_job(flask_app, poster_id, profile_interval=None):
+    # A sampled upload's profile ends when it responds, so the render is sampled on its own.
+    sampler = profiling.start_handoff_sampler(profile_interval)
+    try:
+        with flask_app.app_context():
+            result = services.render_poster_job(poster_id)
+    finally:
+        if sampler is not None:
+            profiling.finish_sampler(sampler, '/admin/upload-poster', 'POST', 202, stage='render', poster_id=poster_id)
+    for stage, ms in (result or {}).get('timings_ms', {}).items():
+        metrics.observe('poster_stage_seconds', {'stage': stage}, ms / 1000)
+
+def poster_job_body(job):
+    body = {"id": job['id'], "status": job['status'], "status_url": url_for('poster_job_route', poster_id=job['id'])}
+    if job['status'] == 'ready':
+        manifest = utils.load_poster_manifest(job['id'])
+        body.update(url=job['url'], variants=manifest['variants'] if manifest else None)
+    elif job['status'] == 'failed':
+        body['error'] = job['error']
+    return body
+
+@app.route('/admin/upload-poster/<poster_id>')
+def poster_job_route(poster_id):
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    job = services.get_poster_job(poster_id)
+    if not job:
+        return jsonify({"error": "Poster upload not found."}), 404
+    return jsonify(poster_job_body(job)), 200
+
+@app.route('/admin/upload-posters', methods=['POST'])
+def upload_posters_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    files = request.files.getlist('posters')
+    if not files:
+        return jsonify({"error": "Missing 'posters' files in the request."}), 400
+
+    try:
+        count = sum(utils.count_poster_files(file.stream) if file.filename.lower().endswith('.zip') else 1
+                    for file in files)
+    except zipfile.BadZipFile:
+        return jsonify({"error": "A '.zip' upload is not a valid zip archive."}), 400
+    if count > POSTER_UPLOAD_MAX_FILES:
+        return jsonify({"error": f"At most {POSTER_UPLOAD_MAX_FILES} posters per upload; "
+                                 f"use `flask --app app ingest-posters` for larger sets."}), 413
+
+    def sources():
+        for file in files:
+            if file.filename.lower().endswith('.zip'):
+                yield from utils.iter_poster_files(file.stream)
+            else:
+                yield file.filename, file.read(utils.MAX_FILE_SIZE_BYTES + 1)
+
+    # Rendered in this process: a request must not start a process pool of its own.
+    result = services.ingest_posters(sources(), workers=0)
+    return jsonify(result), 200
+
+@app.route('/posters/<name>')
+def serve_poster(name):
+    """
+    Serves a content-hashed poster file ('<hash>.webp'), or negotiates the best format for
+    '<poster id>-<variant>' from the Accept header using the poster's manifest.
+    """
+    if not CDN_STORAGE_PATH:
+        abort(404)
+    posters_dir = os.path.join(CDN_STORAGE_PATH, 'posters')
+    headers = {}
+    if '.' not in name:
+        poster_id, _, variant = name.rpartition('-')
+        manifest = utils.load_poster_manifest(poster_id) if poster_id else None
+        if not manifest or variant not in manifest.get("variants", {}):
+            abort(404)
+        filename = utils.negotiate_poster_format(manifest, variant, request.headers.get('Accept'))
+        if not filename:
+            abort(406)
+        name = filename
+        headers['Vary'] = 'Accept'
+
+    extension = name.rsplit('.', 1)[-1]
+    if extension not in utils.POSTER_MIME_TYPES:
+        abort(404)
+
+    response = send_from_directory(posters_dir, name, mimetype=utils.POSTER_MIME_TYPES[extension], max_age=POSTER_CACHE_SECONDS)
+    # Both URL shapes are immutable: hashed names never change content, and a poster id is never reused.
+    response.headers['Cache-Control'] = f'public, max-age={POSTER_CACHE_SECONDS}, immutable'
+    response.headers.update(headers)
+    return response
+
+@app.route('/admin/stats')
+def stats_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    try:
+        result = services.get_stats(since=request.args.get('since'), until=request.args.get('until'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result), 200
+
+def encode_suggestion_cursor(votes, after_id):
+    return base64.urlsafe_b64encode(json.dumps({"votes": votes, "after_id": after_id}).encode()).decode().rstrip('=')
+
+def decode_suggestion_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    position = json.loads(base64.urlsafe_b64decode(padded))
+    return int(position['votes']), int(position['after_id'])
+
+@app.route('/admin/suggestions')
+def list_suggestions_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    try:
+        after = decode_suggestion_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, KeyError, TypeError):
+        return jsonify({"error": "Invalid cursor."}), 400
+
+    status = request.args.get('status', 'pending')
+    if status not in services.SUGGESTION_STATUSES:
+        return jsonify({"error": f"status must be one of: {', '.join(services.SUGGESTION_STATUSES)}."}), 400
+
+    limit = request.args.get('limit', services.SUGGESTIONS_PAGE_SIZE, type=int)
+    if not 1 <= limit <= services.SUGGESTIONS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {services.SUGGESTIONS_MAX_PAGE_SIZE}."}), 400
+
+    page = services.list_suggestions(status=status, after=after, limit=limit)
+    next_cursor = encode_suggestion_cursor(*page['next_after']) if page['next_after'] else None
+    return jsonify({"suggestions": page['suggestions'], "next_cursor": next_cursor}), 200
+
+@app.route('/admin/export/<name>')
+def export_route(name):
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+    try:
+        chunks = services.export_table(name, fmt, since=request.args.get('since'),
+                                       until=request.args.get('until'), compress=compress)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    filename = f"{name}.{fmt}{'.gz' if compress else ''}"
+    mimetype = 'application/gzip' if compress else ('text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    # stream_with_context keeps the app context (and so get_read_db) alive while the body is sent.
+    response = app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/admin/metrics')
+def metrics_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/admin/slow-queries', methods=['GET', 'DELETE'])
+def slow_queries_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    if request.method == 'DELETE':
+        tracing.clear()
+        return jsonify({"message": "Slow query buffer cleared."}), 200
+
+    return jsonify({
+        "enabled": tracing.SLOW_QUERY_TRACE,
+        "threshold_ms": tracing.SLOW_QUERY_THRESHOLD_MS,
+        "worker_pid": os.getpid(),
+        "queries": tracing.slow_queries()
+    }), 200
+
+@app.route('/admin/profiles')
+def list_profiles_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    return jsonify({"config": profiling.current_config(), "profiles": profiling.list_profiles()}), 200
+
+@app.route('/admin/profiles/config', methods=['PUT', 'DELETE'])
+def profiles_config_route():
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    if request.method == 'DELETE':
+        profiling.clear_config()
+        return jsonify({"message": "Profiling disabled."}), 200
+
+    data = request.get_json(silent=True) or {}
+    routes = data.get('routes') or []
+    known_routes = {rule.rule for rule in app.url_map.iter_rules()}
+    unknown = [route for route in routes if route not in known_routes]
+    if not routes or unknown:
+        return jsonify({"error": "Provide 'routes' as a list of route rules.", "unknown_routes": unknown}), 400
+    try:
+        sample_rate = float(data.get('sample_rate', 0.1))
+        interval_ms = float(data.get('interval_ms', profiling.DEFAULT_INTERVAL_MS))
+        duration_seconds = int(data['duration_seconds']) if data.get('duration_seconds') else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "sample_rate, interval_ms and duration_seconds must be numbers."}), 400
+    if not 0 < sample_rate <= 1 or interval_ms <= 0:
+        return jsonify({"error": "sample_rate must be in (0, 1] and interval_ms positive."}), 400
+
+    config = profiling.set_config(routes, sample_rate, interval_ms, duration_seconds)
+    return jsonify({"message": "Profiling enabled.", "config": config}), 200
+
+@app.route('/admin/profiles/<name>')
+def download_profile_route(name):
+    auth_error = check_admin_bearer()
+    if auth_error:
+        return auth_error
+
+    if not name.endswith('.folded'):
+        abort(404)
+    return send_from_directory(profiling.PROFILE_DIR, name, as_attachment=True, mimetype='text/plain')
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    result = services.rebuild_stats()
+    click.echo(f"Rebuilt stats rollups ({result['revenue_rows']} revenue rows, {result['member_rows']} membership rows).")
+
+@app.cli.command('import-ex-guardians')
+@click.argument('csv_path', default='ex_guardians.csv')
+def import_ex_guardians_command(csv_path):
+    imported = services.import_ex_guardians_csv(csv_path)
+    click.echo(f"Imported {imported} archived guardians from '{csv_path}'.")
+
+@app.cli.command('onboard-guardians')
+@click.argument('csv_path')
+@click.option('--send-emails', is_flag=True, help='Send the queued welcome emails right away.')
+def onboard_guardians_command(csv_path, send_emails):
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        result = services.onboard_guardians(csv.DictReader(csvfile))
+    click.echo(f"Created {result['created']}, restored {result['restored']}, skipped {result['skipped_existing']}, invalid {result['invalid']}.")
+    for error in result['errors']:
+        click.echo(f"  {error}")
+    if send_emails:
+        sent = services.send_queued_emails(limit=None)
+        click.echo(f"Sent {sent['sent']} emails ({sent['failed']} failed).")
+
+@app.cli.command('send-queued-emails')
+def send_queued_emails_command():
+    result = services.send_queued_emails(limit=None)
+    click.echo(f"Sent {result['sent']} emails ({result['failed']} failed).")
+
+@app.cli.command('ingest-posters')
+@click.argument('path')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: one per CPU).')
+def ingest_posters_command(path, workers):
+    """Attaches posters named <film id>.jpg or <info hash>.jpg from a directory or zip file."""
+    result = services.ingest_posters(utils.iter_poster_files(path), workers=workers)
+    click.echo(f"{result['files']} files: {result['rendered']} rendered, {result['duplicates_exact']} exact and "
+               f"{result['duplicates_perceptual']} perceptual duplicates, {result['unmatched']} unmatched, "
+               f"{result['invalid']} invalid. {result['films_updated']} films updated "
+               f"({result['files_per_second']} files/s).")
+    for error in result['errors']:
+        click.echo(f"  {error}")
+
+@app.cli.command('compact-changes')
+@click.option('--tombstone-days', type=int, default=services.CHANGE_LOG_TOMBSTONE_DAYS,
+              help='Keep delete entries for this many days.')
+def compact_changes_command(tombstone_days):
+    result = services.compact_changes(tombstone_days=tombstone_days)
+    click.echo(f"Removed {result['superseded_removed']} superseded and {result['tombstones_removed']} old delete entries "
+               f"(horizon {result['horizon']}).")
+
+@app.cli.command('merge-suggestions')
+def merge_suggestions_command():
+    """Merges suggestions stored before titles were normalized into one row per film."""
+    result = services.merge_suggestions()
+    click.echo(f"Keyed {result['keyed']} suggestions and folded {result['merged']} duplicates into them.")
+
+@app.cli.command('export')
+@click.argument('name', type=click.Choice(list(services.EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(services.EXPORT_FORMATS), default='csv')
+@click.option('--since', help='Only rows on or after this date (YYYY-MM-DD or ISO datetime).')
+@click.option('--until', help='Only rows before this date.')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default: stdout).')
+def export_command(name, fmt, since, until, compress, output):
+    try:
+        chunks = services.export_table(name, fmt, since=since, until=until, compress=compress)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for chunk in chunks:
+        output.write(chunk)
+
+SCHEDULED_JOBS = [
+    scheduler.Job('housekeeping', services.perform_housekeeping, scheduler.HOUSEKEEPING_INTERVAL, off_peak=True),
+    scheduler.Job('publish', publish_public_database, scheduler.PUBLISH_INTERVAL),
+    scheduler.Job('emails', services.send_queued_emails, scheduler.EMAIL_INTERVAL),
+    scheduler.Job('posters', services.render_pending_posters, scheduler.POSTER_INTERVAL),
+    scheduler.Job('compact-changes', services.compact_changes, scheduler.HOUSEKEEPING_INTERVAL, off_peak=True),
+]
+
+@app.cli.command('replicate')
+@click.option('--once', is_flag=True, help='Ship (primary) or apply (replica) once and exit.')
+def replicate_command(once):
+    """Ships the database to REPLICATION_DIR on the primary, or applies what was shipped on a replica."""
+    if not replication.REPLICATION_DIR:
+        raise click.UsageError("REPLICATION_DIR is not set.")
+    public_dir = os.path.join(CDN_STORAGE_PATH, "db") if CDN_STORAGE_PATH else None
+    if replication.REPLICATION_ROLE == 'primary':
+        node = replication.Shipper(app.config['DATABASE'], replication.REPLICATION_DIR, public_dir)
+        step = node.ship
+    elif replication.REPLICATION_ROLE == 'replica':
+        node = replication.Replica(replication.REPLICATION_DIR, app.config['DATABASE'], public_dir)
+        step = node.apply
     else:
-        return jsonify({"error": result['error']}), 400
+        raise click.UsageError("REPLICATION_ROLE must be 'primary' or 'replica'.")
+
+    if once:
+        result = step()
+        click.echo(f"Generation {result.get('generation')}, as of {result.get('as_of')}.")
+    else:
+        replication.run_forever(step)
+
+@app.cli.command('run-scheduler')
+@click.option('--once', is_flag=True, help='Run any due jobs once and exit.')
+def run_scheduler_command(once):
+    if once:
+        ran = scheduler.run_due_jobs(app, SCHEDULED_JOBS, scheduler.holder_id())
+        click.echo(f"Ran jobs: {', '.join(ran) if ran else 'none'}.")
+    else:
+        scheduler.run_forever(app, SCHEDULED_JOBS)
 
 @app.route('/health')
 def health_check():
-    return jsonify({"status": "ok"}), 200
\ No newline at end of file
+    return health_response()
+
+def health_response():
+    replica = replication.health()
+    if replica is None:
+        return jsonify({"status": "ok"}), 200
+    # A stale replica fails its health check, so load balancers stop sending it reads.
+    return jsonify({"status": "stale" if replica['stale'] else "ok", "replication": replica}), 503 if replica['stale'] else 200
\ No newline at end of file
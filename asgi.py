@@ -0,0 +1,259 @@
+# asgi.py
+"""
+ASGI entry point, for serving many mostly idle polling clients from an event loop:
+
+    uvicorn asgi:app --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:app
+
+Open and keep-alive connections are held by the event loop instead of costing a worker
+thread each. The routes clients poll (/auth, /magnet/<id>, /db/public.sha256, /health) have
+async variants that run the same response functions as app.py on a small thread pool, with
+the same rate limits, metrics and profiling. Every other request, and any method but GET, is
+handed to the Flask app on that pool unchanged, so it behaves exactly as under gunicorn.
+"""
+import re
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from werkzeug.exceptions import InternalServerError
+
+import app as app_module
+from config import settings
+import metrics
+import profiling
+import ratelimit
+import replication
+
+logger = logging.getLogger(__name__)
+
+# Connections waiting on these threads cost no thread themselves.
+ASGI_THREADS = settings.ASGI_THREADS
+# Request bodies larger than this are spooled to a temporary file before Flask reads them.
+BODY_SPOOL_BYTES = 1024 * 1024
+# Response chunks buffered between a Flask thread and a slow client before the thread waits.
+RESPONSE_QUEUE_CHUNKS = 8
+
+flask_app = app_module.app
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi")
+# Utilization (and so load shedding) is measured against the threads that actually serve requests.
+ratelimit.utilization.threads = ASGI_THREADS
+
+_MAGNET_PATH = re.compile(r"/magnet/(\d+)")
+
+
+def _read_route(path, query):
+    """Returns (rule, response function, arguments) if the request has an async variant, else None."""
+    if path == '/auth':
+        return '/auth', app_module.auth_response, (query.get('token'),)
+    match = _MAGNET_PATH.fullmatch(path)
+    if match:
+        return '/magnet/<int:film_id>', app_module.magnet_response, (int(match[1]), query.get('TOKEN'))
+    if path == '/db/public.sha256':
+        return '/db/public.sha256', app_module.public_db_checksum_response, ()
+    if path == '/health':
+        return '/health', app_module.health_response, ()
+    return None
+
+
+def _query_args(scope):
+    args = {}
+    for key, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True, errors='replace'):
+        # Like request.args.get: the first value wins.
+        args.setdefault(key, value)
+    return args
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _serve_read(rule, view, args, credentials):
+    """Runs on the thread pool: what Flask's before/after hooks and the route would do for this request."""
+    started = time.perf_counter()
+    with flask_app.app_context():
+        response = replication.admission_response(rule)
+        if response is None and ratelimit.RATE_LIMIT_ENABLED:
+            now = time.monotonic()
+            client = ratelimit.client_key(rule, **credentials)
+            response = ratelimit.admission_response(rule, client, now)
+            if response is None:
+                admission_id = object()
+                ratelimit.utilization.begin(admission_id, now)
+        if response is None:
+            sampler = profiling.start_sampler(rule)
+            try:
+                response = flask_app.make_response(view(*args))
+            except Exception:
+                logger.exception("Unhandled error serving %s", rule)
+                response = InternalServerError().get_response()
+            finally:
+                if ratelimit.RATE_LIMIT_ENABLED:
+                    ratelimit.utilization.end(admission_id, time.monotonic())
+            if sampler is not None:
+                profiling.finish_sampler(sampler, rule, 'GET', response.status_code)
+        if metrics.METRICS_ENABLED:
+            metrics.record_request(rule, 'GET', response.status_code, time.perf_counter() - started)
+            metrics.record_db_usage(rule)
+            metrics.flush()
+    return response
+
+
+async def _serve_read_route(scope, query, send, rule, view, args):
+    credentials = dict(
+        token=query.get('TOKEN') or query.get('token'),
+        auth_header=_header(scope, b'authorization'),
+        address=ratelimit.forwarded_address(scope['client'][0] if scope.get('client') else '',
+                                            _header(scope, b'x-forwarded-for'))
+    )
+    loop = asyncio.get_running_loop()
+    response = await loop.run_in_executor(_executor, _serve_read, rule, view, args, credentials)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.to_wsgi_list()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings are bytes decoded as latin-1.
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        elif f"HTTP_{name}" in environ:
+            environ[f"HTTP_{name}"] += f",{value}"
+        else:
+            environ[f"HTTP_{name}"] = value
+    return environ
+
+
+def _run_flask(environ, loop, queue, disconnected):
+    """Runs on the thread pool: calls the Flask app and passes its response to the event loop chunk by chunk.
+
+    The whole response is produced on this one thread, so generators using stream_with_context
+    keep their app context.
+    """
+    def put(message):
+        asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers],
+        })
+        return lambda data: put({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    try:
+        result = flask_app(environ, start_response)
+        try:
+            for chunk in result:
+                # Stop producing (e.g. an export) once the client has gone.
+                if disconnected.is_set():
+                    return
+                if chunk:
+                    put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    finally:
+        put(None)
+
+
+async def _read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+async def _watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def _call_flask(scope, receive, send):
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=RESPONSE_QUEUE_CHUNKS)
+    disconnected = threading.Event()
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, disconnected))
+    job = loop.run_in_executor(_executor, _run_flask, _wsgi_environ(scope, body), loop, queue, disconnected)
+    try:
+        # Drain until the thread is done, even after a disconnect, so it never blocks on a full queue.
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            if not disconnected.is_set():
+                await send(message)
+        await job
+    finally:
+        watcher.cancel()
+        body.close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    if scope['method'] == 'GET':
+        query = _query_args(scope)
+        route = _read_route(scope['path'], query)
+        if route is not None:
+            return await _serve_read_route(scope, query, send, *route)
+    await _call_flask(scope, receive, send)
@@ -1,19 +1,164 @@
 import os
+import re
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
+# The only place .env is read. Every setting is resolved here, once, when this module is first
+# imported; modules that keep a module-level name for a setting copy it from `settings`.
 load_dotenv()
 
+
+def _int(environ, name, default, minimum=0):
+    value = environ.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        raise RuntimeError(f"FATAL: {name} must be an integer, got {value!r}.")
+    if parsed < minimum:
+        raise RuntimeError(f"FATAL: {name} must be at least {minimum}, got {parsed}.")
+    return parsed
+
+
+def _float(environ, name, default, minimum=0.0):
+    value = environ.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = float(value)
+    except ValueError:
+        raise RuntimeError(f"FATAL: {name} must be a number, got {value!r}.")
+    if parsed < minimum:
+        raise RuntimeError(f"FATAL: {name} must be at least {minimum}, got {parsed}.")
+    return parsed
+
+
+def _choice(environ, name, default, choices):
+    value = environ.get(name, default)
+    if value not in choices:
+        raise RuntimeError(f"FATAL: {name} must be one of {', '.join(repr(c) for c in choices)}, got {value!r}.")
+    return value
+
+
 class Config:
     """
-    Configuration class for the Flask application.
-    Loads sensitive data from environment variables.
+    Configuration for the Flask application, resolved once from the environment.
+    Use the shared `settings` instance rather than reading these variables directly.
+    Malformed numbers and out-of-range values raise RuntimeError when the settings are built.
     """
-    KOFI_VERIFICATION_TOKEN = os.getenv("KOFI_VERIFICATION_TOKEN")
-    DATABASE_NAME = os.getenv("DATABASE_NAME", "shiosayi_system.db")
-    RESEND_API_KEY = os.getenv("RESEND_API_KEY")
-
-    if not KOFI_VERIFICATION_TOKEN:
-        print("WARNING: KOFI_VERIFICATION_TOKEN not set in environment variables. Webhook verification will fail.")
-    if not RESEND_API_KEY:
-        print("WARNING: RESEND_API_KEY not set in environment variables. Email service may not function.")
+
+    def __init__(self, environ=os.environ):
+        self.SECRET_KEY = environ.get("FLASK_SECRET_KEY")
+        self.DATABASE = environ.get("DATABASE_FILENAME", "shiosayi.db")
+        self.KOFI_VERIFICATION_TOKEN = environ.get("KOFI_VERIFICATION_TOKEN")
+        self.ADMIN_API_TOKEN = environ.get("ADMIN_API_TOKEN")
+        self.JOIN_FORM_ACCESS = environ.get("JOIN_FORM_ACCESS", "admin")
+        self.CDN_STORAGE_PATH = environ.get("CDN_STORAGE_PATH")
+        self.CDN_BASE_URL = environ.get("CDN_BASE_URL")
+        self.RESEND_API_KEY = environ.get("RESEND_API_KEY")
+        self.TEST_MODE = environ.get("TEST_MODE") == "true"
+        self.TEST_EMAIL_RECIPIENT = environ.get("TEST_EMAIL_RECIPIENT", "delivered@resend.dev")
+        # Reverse proxies in front of the app whose X-Forwarded-For can be trusted; 0 uses the peer address.
+        self.TRUSTED_PROXY_COUNT = _int(environ, "TRUSTED_PROXY_COUNT", 0)
+
+        # Logging (logconfig.py).
+        self.LOG_LEVEL = environ.get("LOG_LEVEL", "INFO")
+        # Per-logger overrides, e.g. "services=WARNING,mail=DEBUG".
+        self.LOG_LEVELS = environ.get("LOG_LEVELS", "")
+        # Share of INFO-and-below records to keep per logger, e.g. "services=0.1". WARNING and above are always kept.
+        self.LOG_SAMPLE_RATES = environ.get("LOG_SAMPLE_RATES", "")
+        self.LOG_FORMAT = _choice(environ, "LOG_FORMAT", "json", ("json", "text"))
+        self.LOG_FILE = environ.get("LOG_FILE")
+        # Records waiting for the writer thread; past this, INFO and below are dropped rather than queued.
+        self.LOG_QUEUE_SIZE = _int(environ, "LOG_QUEUE_SIZE", 10000, minimum=1)
+
+        # Metrics (metrics.py).
+        self.METRICS_ENABLED = environ.get("METRICS_ENABLED", "true") == "true"
+        # With several gunicorn workers, point this at a shared directory so /admin/metrics
+        # reports the sum over all workers instead of whichever worker served the scrape.
+        self.METRICS_DIR = environ.get("METRICS_DIR")
+        self.METRICS_FLUSH_SECONDS = _float(environ, "METRICS_FLUSH_SECONDS", 5)
+
+        # Slow query tracing (tracing.py).
+        self.SLOW_QUERY_TRACE = environ.get("SLOW_QUERY_TRACE", "false") == "true"
+        self.SLOW_QUERY_THRESHOLD_MS = _float(environ, "SLOW_QUERY_THRESHOLD_MS", 50)
+        self.SLOW_QUERY_BUFFER_SIZE = _int(environ, "SLOW_QUERY_BUFFER_SIZE", 200, minimum=1)
+
+        # Profiling (profiling.py). Shared by every worker: the config written by
+        # /admin/profiles/config and the captured profiles.
+        self.PROFILE_DIR = os.path.abspath(environ.get("PROFILE_DIR", "profiles"))
+        self.PROFILE_MAX_FILES = _int(environ, "PROFILE_MAX_FILES", 200)
+        self.PROFILE_MAX_AGE_HOURS = _float(environ, "PROFILE_MAX_AGE_HOURS", 72)
+
+        # Rate limiting and load shedding (ratelimit.py).
+        self.RATE_LIMIT_ENABLED = environ.get("RATE_LIMIT_ENABLED", "true") == "true"
+        # Per-route overrides, e.g. "/auth=30/60,/suggest=5/60": a bucket of 30 requests that refills over 60 seconds.
+        # Keys are Flask rules, as in /admin/metrics. A limit of 0 turns limiting off for that route.
+        self.RATE_LIMITS = environ.get("RATE_LIMITS", "")
+        # With several gunicorn workers, point this at a SQLite file all of them can write so a client's
+        # buckets are shared. Without it each worker keeps its own, and the limits apply per worker.
+        self.RATE_LIMIT_DB = environ.get("RATE_LIMIT_DB")
+        # Request threads per worker (gunicorn --threads); utilization is busy time over this many threads.
+        self.WORKER_THREADS = _int(environ, "WORKER_THREADS", 1, minimum=1)
+        # Above this utilization the SHED_ROUTES are answered with 503 until the worker catches up.
+        self.SHED_UTILIZATION = _float(environ, "SHED_UTILIZATION", 0.9)
+        self.SHED_ROUTES = environ.get("SHED_ROUTES", "/auth,/suggest,/join,/films,/changes,/magnet/<int:film_id>")
+        self.SHED_RETRY_AFTER_SECONDS = _int(environ, "SHED_RETRY_AFTER_SECONDS", 2)
+        # Routes whose buckets are always per address. Whatever token a caller sends there is either being
+        # checked (/auth) or not a guardian token at all, so keying on it would let a client pick a fresh
+        # bucket per request.
+        self.ADDRESS_KEYED_ROUTES = environ.get("ADDRESS_KEYED_ROUTES", "/auth,/suggest,/join,/webhook")
+
+        # Replication (replication.py). REPLICATION_ROLE is empty for a single node.
+        self.REPLICATION_ROLE = _choice(environ, "REPLICATION_ROLE", "", ("", "primary", "replica"))
+        self.REPLICATION_DIR = environ.get("REPLICATION_DIR")
+        self.REPLICATION_INTERVAL_SECONDS = _float(environ, "REPLICATION_INTERVAL_SECONDS", 5)
+        # A replica whose data is older than this answers its read routes (and /health) with 503.
+        self.REPLICA_MAX_LAG_SECONDS = _float(environ, "REPLICA_MAX_LAG_SECONDS", 60)
+        # The Flask rules a replica serves. Everything else writes or is admin-only, and belongs to the primary.
+        self.REPLICA_ROUTES = environ.get(
+            "REPLICA_ROUTES", "/auth,/magnet/<int:film_id>,/films,/changes,/db/public,/db/public.sha256,/db/<filename>"
+        )
+
+        # Background jobs (scheduler.py), in seconds.
+        self.SCHEDULER_HOUSEKEEPING_INTERVAL = _int(environ, "SCHEDULER_HOUSEKEEPING_INTERVAL", 24 * 60 * 60, minimum=1)
+        self.SCHEDULER_PUBLISH_INTERVAL = _int(environ, "SCHEDULER_PUBLISH_INTERVAL", 60 * 60, minimum=1)
+        self.SCHEDULER_EMAIL_INTERVAL = _int(environ, "SCHEDULER_EMAIL_INTERVAL", 60, minimum=1)
+        self.SCHEDULER_POSTER_INTERVAL = _int(environ, "SCHEDULER_POSTER_INTERVAL", 5 * 60, minimum=1)
+        self.SCHEDULER_JITTER_SECONDS = _int(environ, "SCHEDULER_JITTER_SECONDS", 300)
+        self.SCHEDULER_POLL_SECONDS = _int(environ, "SCHEDULER_POLL_SECONDS", 30, minimum=1)
+        self.SCHEDULER_LEASE_SECONDS = _int(environ, "SCHEDULER_LEASE_SECONDS", 60 * 60, minimum=1)
+        # A held lease is renewed this often, so a run longer than SCHEDULER_LEASE_SECONDS keeps it.
+        self.SCHEDULER_LEASE_RENEW_SECONDS = _float(
+            environ, "SCHEDULER_LEASE_RENEW_SECONDS", self.SCHEDULER_LEASE_SECONDS / 3, minimum=1
+        )
+        # 'H-H' local-time window (end exclusive, may wrap past midnight) for off-peak jobs; empty means always.
+        self.SCHEDULER_OFF_PEAK_HOURS = environ.get("SCHEDULER_OFF_PEAK_HOURS", "2-5")
+        window = re.fullmatch(r"(\d{1,2})-(\d{1,2})", self.SCHEDULER_OFF_PEAK_HOURS)
+        if self.SCHEDULER_OFF_PEAK_HOURS and not (window and all(int(hour) < 24 for hour in window.groups())):
+            raise RuntimeError(
+                f"FATAL: SCHEDULER_OFF_PEAK_HOURS must look like '2-5', got {self.SCHEDULER_OFF_PEAK_HOURS!r}."
+            )
+
+        # Posters (utils.py, services.py, app.py).
+        self.POSTER_WORKERS = _int(environ, "POSTER_WORKERS", 2, minimum=1)
+        self.POSTER_QUEUE_LIMIT = _int(environ, "POSTER_QUEUE_LIMIT", 4)
+        self.POSTER_FORMATS = [name.strip() for name in environ.get("POSTER_FORMATS", "webp,avif").split(',')]
+        # A job still 'rendering' after this long was lost with its worker and is rendered again.
+        self.POSTER_JOB_STALE_SECONDS = _int(environ, "POSTER_JOB_STALE_SECONDS", 600, minimum=1)
+        # Larger ingests belong to `flask ingest-posters`, which can use every core without tying up a worker.
+        self.POSTER_UPLOAD_MAX_FILES = _int(environ, "POSTER_UPLOAD_MAX_FILES", 50, minimum=1)
+
+        # Threads running SQLite reads and Flask requests under asgi:app.
+        self.ASGI_THREADS = _int(environ, "ASGI_THREADS", 8, minimum=1)
+
+    def validate(self):
+        """Raises RuntimeError for settings the server cannot start without."""
+        if not self.SECRET_KEY:
+            raise RuntimeError("FATAL: FLASK_SECRET_KEY is not set in the environment.")
+        if not self.KOFI_VERIFICATION_TOKEN:
+            raise RuntimeError("FATAL: KOFI_VERIFICATION_TOKEN is not set in the environment.")
+        if self.JOIN_FORM_ACCESS == "admin" and not self.ADMIN_API_TOKEN:
+            raise RuntimeError("FATAL: JOIN_FORM_ACCESS is 'admin' but ADMIN_API_TOKEN is not set.")
+
+settings = Config()
@@ -1,25 +1,230 @@
+import time
 import sqlite3
+from urllib.parse import parse_qsl
 import click
 from flask import current_app, g
+import metrics
+import tracing
+import utils
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Counts rows fetched and time spent on behalf of its connection.
+
+    SQLite does most of a SELECT's work as its rows are stepped through, not in execute, so the
+    fetches are timed too. A statement is traced once its cursor is exhausted, re-executed,
+    closed or dropped, with the time of the execute and every fetch.
+    """
+
+    _statement = None
+
+    def _begin(self, sql, parameters):
+        self._finish()
+        self._statement, self._seconds = (sql, parameters), 0.0
+
+    def _spent(self, started, rows=0):
+        seconds = time.perf_counter() - started
+        self.connection.record_fetch(seconds, rows)
+        if self._statement is not None:
+            self._seconds += seconds
+
+    def _finish(self):
+        if self._statement is not None:
+            sql, parameters = self._statement
+            self._statement = None
+            if tracing.SLOW_QUERY_TRACE:
+                tracing.record_statement(self.connection, sql, parameters, self._seconds)
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            seconds = time.perf_counter() - started
+            self._seconds += seconds
+            self.connection.record_query(seconds, max(self.rowcount, 0))
+            if self.description is None:
+                self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            seconds = time.perf_counter() - started
+            self._seconds += seconds
+            self.connection.record_query(seconds, max(self.rowcount, 0))
+            self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._spent(started, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._spent(started, len(rows))
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._spent(started, len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._spent(started)
+            self._finish()
+            raise
+        self._spent(started, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # db.execute(...).fetchone() never exhausts its cursor; it is traced when the cursor is dropped.
+        self._finish()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection that keeps query, row and time totals for the request that owns it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def record_query(self, seconds, rows_changed=0):
+        self.queries += 1
+        self.rows += rows_changed
+        self.seconds += seconds
+
+    def record_fetch(self, seconds, rows):
+        self.rows += rows
+        self.seconds += seconds
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def _connection_factory():
+    # The per-statement and per-row accounting only feeds metrics and the slow query trace.
+    return InstrumentedConnection if metrics.METRICS_ENABLED or tracing.SLOW_QUERY_TRACE else sqlite3.Connection
 
 def get_db():
     if 'db' not in g:
+        # On a read replica (see replication.py) even this connection must not write to the shipped copy.
+        read_only = current_app.config.get('DATABASE_READ_ONLY')
         g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+            f"file:{current_app.config['DATABASE']}?mode=ro" if read_only else current_app.config['DATABASE'],
+            uri=bool(read_only),
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            factory=_connection_factory()
         )
         g.db.row_factory = sqlite3.Row
     return g.db
 
+def get_read_db():
+    """A read-only connection for endpoints that never write; it cannot take the write lock."""
+    if 'read_db' not in g:
+        g.read_db = sqlite3.connect(
+            f"file:{current_app.config['DATABASE']}?mode=ro",
+            uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            factory=_connection_factory()
+        )
+        g.read_db.row_factory = sqlite3.Row
+    return g.read_db
+
 def close_db(e=None):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    for name in ('db', 'read_db'):
+        db = g.pop(name, None)
+        if db is not None:
+            db.close()
+
+# Columns added after a table was first released. CREATE TABLE IF NOT EXISTS
+# won't add them to an existing database, so init-db adds them here first.
+COLUMN_MIGRATIONS = [
+    ('films', 'info_hash', 'TEXT'),
+    ('suggestions', 'title_key', 'TEXT'),
+    ('suggestions', 'year', 'INTEGER'),
+    ('suggestions', 'votes', 'INTEGER NOT NULL DEFAULT 1'),
+    ('suggestions', 'last_suggested_at', 'DATETIME'),
+    ('ex_guardian_films', 'restored_at', 'DATETIME'),
+]
+
+def migrate_db(db):
+    for table, column, declaration in COLUMN_MIGRATIONS:
+        columns = [row['name'] for row in db.execute(f"PRAGMA table_info({table})")]
+        if columns and column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    db.commit()
+
+def magnet_info_hash(magnet):
+    """The lowercase hex info-hash in a magnet link's xt=urn:btih: (hex or base32), or None."""
+    if not magnet or not magnet.lower().startswith('magnet:?'):
+        return None
+    for key, value in parse_qsl(magnet[len('magnet:?'):]):
+        if key.lower() != 'xt' or not value.lower().startswith('urn:btih:'):
+            continue
+        try:
+            return utils.btih_to_hex(value[len('urn:btih:'):])
+        except ValueError:
+            return None
+    return None
+
+def backfill_info_hashes(db, batch_size=5000):
+    """
+    Fills films.info_hash from the magnet links of films stored before the column existed.
+    Links without a valid info-hash stay NULL, as does a film whose hash another film already
+    has. Returns the number of films updated; safe to run again.
+    """
+    updated, last_id = 0, 0
+    while True:
+        rows = db.execute(
+            "SELECT id, magnet FROM films WHERE info_hash IS NULL AND magnet IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        for row in rows:
+            info_hash = magnet_info_hash(row['magnet'])
+            if info_hash:
+                updated += db.execute(
+                    "UPDATE films SET info_hash = ?1 WHERE id = ?2 AND NOT EXISTS (SELECT 1 FROM films WHERE info_hash = ?1)",
+                    (info_hash, row['id'])
+                ).rowcount
+        db.commit()
+    return updated
 
 def init_db():
     db = get_db()
+    migrate_db(db)
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    # After the schema, so the info_hash index is there for the uniqueness checks.
+    backfill_info_hashes(db)
 
 @click.command('init-db')
 def init_db_command():
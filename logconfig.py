@@ -0,0 +1,147 @@
+# logconfig.py
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+from config import settings
+
+LOG_LEVEL = settings.LOG_LEVEL
+LOG_LEVELS = settings.LOG_LEVELS
+LOG_SAMPLE_RATES = settings.LOG_SAMPLE_RATES
+LOG_FORMAT = settings.LOG_FORMAT
+LOG_FILE = settings.LOG_FILE
+LOG_QUEUE_SIZE = settings.LOG_QUEUE_SIZE
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Attributes every LogRecord has; anything else was passed through `extra=` and is emitted as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+_dropped = 0
+# Argument types that cannot change between the call and the writer thread formatting the message.
+_IMMUTABLE_ARGS = (str, int, float, bool, type(None), bytes)
+
+
+def _parse_mapping(value):
+    mapping = {}
+    for item in value.split(','):
+        if '=' in item:
+            key, setting = item.split('=', 1)
+            mapping[key.strip()] = setting.strip()
+    return mapping
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fixed share of low-severity records for the configured loggers (and their children)."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                rate = self.rates[name]
+                if random.random() >= rate:
+                    return False
+                record.sample_rate = rate
+                return True
+            name = name.rpartition('.')[0]
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues the record without formatting it, so the formatter only runs on the writer thread."""
+
+    def prepare(self, record):
+        # A dict or list argument could change before the writer gets to it; render the message
+        # now in that case. Plain values are left for the writer thread.
+        args = record.args or ()
+        if not isinstance(args, tuple) or not all(isinstance(arg, _IMMUTABLE_ARGS) for arg in args):
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                _dropped += 1
+                return
+            # Warnings and errors wait for room instead of being lost.
+            self.queue.put(record)
+
+
+def _start_listener(log_queue, handler):
+    global _listener
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def queue_depth():
+    """Records waiting for the writer thread."""
+    return _listener.queue.qsize() if _listener is not None else 0
+
+
+def dropped_records():
+    """INFO-and-below records dropped because the queue was full."""
+    return _dropped
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup_logging():
+    """Routes all logging through a queue drained by one background writer thread. Safe to call twice."""
+    root = logging.getLogger()
+    if any(isinstance(handler, DeferredQueueHandler) for handler in root.handlers):
+        return
+
+    if LOG_FILE:
+        handler = logging.handlers.WatchedFileHandler(LOG_FILE)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter({name: float(rate) for name, rate in _parse_mapping(LOG_SAMPLE_RATES).items()}))
+
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_mapping(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _start_listener(log_queue, handler)
+    atexit.register(_stop_listener)
+    # The writer thread does not survive a fork (e.g. gunicorn --preload), so start a new one in the child.
+    os.register_at_fork(after_in_child=lambda: _start_listener(log_queue, handler))
@@ -1,22 +1,26 @@
 # mail.py
 
-import os
-import resend
-from resend.exceptions import ResendError
 import logging
-from dotenv import load_dotenv
+from config import settings
 
-load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 class EmailService:
+    BATCH_LIMIT = 100
+
     def __init__(self):
-        self.api_key = os.getenv("RESEND_API_KEY")
+        self.api_key = settings.RESEND_API_KEY
         if not self.api_key:
             raise ValueError("RESEND_API_KEY is not set.")
-        resend.api_key = self.api_key
         self.from_address = "Shiosayi <sys@shiosayi.org>"
-        logging.info("EmailService initialized successfully.")
+        logger.info("EmailService initialized successfully.")
+
+    def _client(self):
+        # The resend SDK pulls in requests and its HTTP stack, so it is only imported
+        # once an email is actually sent, not in every worker and CLI command at startup.
+        import resend
+        resend.api_key = self.api_key
+        return resend
 
     def _get_template_html(self, template_name: str, data: dict) -> str:
         # We now use one flexible template
@@ -44,26 +48,55 @@ class EmailService:
             """
             return html_content
         else:
-            logging.warning(f"Unknown email template: {template_name}")
+            logger.warning("Unknown email template: %s", template_name)
             return "<p>No template found for this email type.</p>"
 
+    def _resolve_recipient(self, to_email: str) -> str:
+        if settings.TEST_MODE:
+            test_recipient = settings.TEST_EMAIL_RECIPIENT
+            logger.info("TEST MODE: Overriding recipient from '%s' to '%s'", to_email, test_recipient)
+            return test_recipient
+        return to_email
+
     def send_email(self, to_email: str, subject: str, template_name: str, template_data: dict = None):
         if template_data is None: template_data = {}
 
         html_content = self._get_template_html(template_name, template_data)
         
-        recipient = to_email
-        if os.getenv("TEST_MODE") == "true":
-            test_recipient = os.getenv("TEST_EMAIL_RECIPIENT", "delivered@resend.dev")
-            logging.info(f"TEST MODE: Overriding recipient from '{to_email}' to '{test_recipient}'")
-            recipient = test_recipient
+        recipient = self._resolve_recipient(to_email)
 
+        resend = self._client()
         try:
             r = resend.Emails.send({
                 "from": self.from_address, "to": recipient, "subject": subject, "html": html_content
             })
-            logging.info(f"Email sent successfully to '{recipient}' (Original: '{to_email}').")
+            logger.info("Email sent successfully to '%s' (Original: '%s').", recipient, to_email)
             return r
-        except ResendError as e:
-            logging.error(f"Failed to send email to '{recipient}'. Resend API Error: {e}")
+        except resend.exceptions.ResendError as e:
+            logger.error("Failed to send email to '%s'. Resend API Error: %s", recipient, e)
             return None
+
+    def send_batch(self, messages: list):
+        """Sends up to BATCH_LIMIT emails in one API call.
+
+        Each message is a dict with 'to_email', 'subject', 'template_name' and 'template_data'.
+        Returns True if Resend accepted the batch.
+        """
+        if len(messages) > self.BATCH_LIMIT:
+            raise ValueError(f"A batch can hold at most {self.BATCH_LIMIT} emails.")
+
+        params = [{
+            "from": self.from_address,
+            "to": self._resolve_recipient(message['to_email']),
+            "subject": message['subject'],
+            "html": self._get_template_html(message['template_name'], message.get('template_data') or {})
+        } for message in messages]
+
+        resend = self._client()
+        try:
+            resend.Batch.send(params)
+            logger.info("Batch of %s emails sent successfully.", len(params))
+            return True
+        except resend.exceptions.ResendError as e:
+            logger.error("Failed to send batch of %s emails. Resend API Error: %s", len(params), e)
+            return False
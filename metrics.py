@@ -0,0 +1,190 @@
+# metrics.py
+import os
+import json
+import time
+import threading
+from flask import g, request
+from config import settings
+
+METRICS_ENABLED = settings.METRICS_ENABLED
+METRICS_DIR = settings.METRICS_DIR
+METRICS_FLUSH_SECONDS = settings.METRICS_FLUSH_SECONDS
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_gauges = {}      # name -> (help, callback returning {labels: value})
+_last_flush = 0.0
+
+HELP = {
+    'http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by route.'),
+    'sqlite_queries_total': ('counter', 'SQLite statements executed through get_db, by route.'),
+    'sqlite_rows_total': ('counter', 'SQLite rows fetched or changed through get_db, by route.'),
+    'sqlite_seconds_total': ('counter', 'Time spent executing SQLite statements through get_db, by route.'),
+    'poster_stage_seconds': ('histogram', 'Poster upload processing time by stage.'),
+}
+
+
+def inc(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, labels, value, buckets=LATENCY_BUCKETS):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(buckets) + 2)
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def register_gauge(name, help_text, callback):
+    """Registers a gauge computed at scrape time.
+
+    callback() returns a number, or a dict mapping label tuples like (('tier', 'lover'),) to numbers.
+    """
+    _gauges[name] = (help_text, callback)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, list(labels), list(values)] for (name, labels), values in _histograms.items()],
+        }
+
+
+def flush(force=False):
+    """Writes this worker's totals to METRICS_DIR, at most every METRICS_FLUSH_SECONDS."""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    _last_flush = now
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _collect():
+    """Returns counters and histograms summed over every worker that has flushed to METRICS_DIR."""
+    if not METRICS_DIR:
+        snapshots = [_snapshot()]
+    else:
+        flush(force=True)
+        snapshots = []
+        for filename in os.listdir(METRICS_DIR):
+            if filename.endswith(".json"):
+                try:
+                    with open(os.path.join(METRICS_DIR, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, [0] * len(values))
+            for index, value in enumerate(values):
+                merged[index] += value
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def render_prometheus():
+    counters, histograms = _collect()
+    lines = []
+
+    for metric_name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+        metric_type, help_text = HELP.get(metric_name, ('counter', metric_name))
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric_name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), values in sorted(histograms.items()):
+            if name != metric_name:
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, values):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+
+    for name, (help_text, callback) in sorted(_gauges.items()):
+        try:
+            values = callback()
+        except Exception:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(values, dict):
+            for labels, value in values.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            lines.append(f"{name} {values}")
+
+    return "\n".join(lines) + "\n"
+
+
+def record_request(route, method, status, seconds):
+    inc('http_requests_total', {'route': route, 'method': method, 'status': str(status)})
+    observe('http_request_duration_seconds', {'route': route}, seconds)
+
+
+def record_db_usage(route):
+    """Adds the statements run on the current app context's connections to the route's totals."""
+    for name in ('db', 'read_db'):
+        db = g.get(name)
+        if db is not None and hasattr(db, 'queries'):
+            inc('sqlite_queries_total', {'route': route}, db.queries)
+            inc('sqlite_rows_total', {'route': route}, db.rows)
+            inc('sqlite_seconds_total', {'route': route}, db.seconds)
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    record_request(route, request.method, response.status_code, time.perf_counter() - started)
+    record_db_usage(route)
+    flush()
+    return response
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
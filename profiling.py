@@ -0,0 +1,225 @@
+# profiling.py
+import os
+import sys
+import json
+import time
+import random
+import threading
+from collections import Counter
+from flask import g, request
+from config import settings
+
+PROFILE_DIR = settings.PROFILE_DIR
+PROFILE_MAX_FILES = settings.PROFILE_MAX_FILES
+PROFILE_MAX_AGE_HOURS = settings.PROFILE_MAX_AGE_HOURS
+PROFILE_CONFIG_RELOAD_SECONDS = 2.0
+DEFAULT_INTERVAL_MS = 5
+
+_config = {}
+_config_mtime = None
+_config_checked = 0.0
+_config_lock = threading.Lock()
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread and counts collapsed stacks.
+
+    A request's sampler only sees the request thread. Work it hands to another thread, like a
+    poster render on the render pool, gets its own sampler from start_handoff_sampler.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = frame.f_globals.get('__name__', '?')
+                stack.append(f"{code.co_name} ({module}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+
+def _config_path():
+    return os.path.join(PROFILE_DIR, "config.json")
+
+
+def current_config():
+    """Returns the active profiling config, re-reading the shared file at most every couple of seconds."""
+    global _config, _config_mtime, _config_checked
+    now = time.monotonic()
+    if now - _config_checked >= PROFILE_CONFIG_RELOAD_SECONDS:
+        with _config_lock:
+            _config_checked = now
+            try:
+                mtime = os.stat(_config_path()).st_mtime
+            except OSError:
+                _config, _config_mtime = {}, None
+            else:
+                if mtime != _config_mtime:
+                    try:
+                        with open(_config_path()) as f:
+                            _config = json.load(f)
+                        _config_mtime = mtime
+                    except (OSError, ValueError):
+                        _config = {}
+
+    if _config.get('expires_at') and time.time() > _config['expires_at']:
+        return {}
+    return _config
+
+
+def set_config(routes, sample_rate, interval_ms=DEFAULT_INTERVAL_MS, duration_seconds=None):
+    global _config_checked
+    config = {
+        "routes": sorted(set(routes)),
+        "sample_rate": sample_rate,
+        "interval_ms": interval_ms,
+        "expires_at": time.time() + duration_seconds if duration_seconds else None,
+    }
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(f"{_config_path()}.tmp", "w") as f:
+        json.dump(config, f)
+    os.replace(f"{_config_path()}.tmp", _config_path())
+    _config_checked = 0.0
+    return config
+
+
+def clear_config():
+    global _config_checked
+    try:
+        os.remove(_config_path())
+    except FileNotFoundError:
+        pass
+    _config_checked = 0.0
+
+
+def _save(counts, meta):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = meta['route'].strip('/').replace('/', '_').replace('<', '').replace('>', '').replace(':', '-') or 'root'
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{slug}_{os.getpid()}_{int(time.time() * 1000) % 1000:03d}"
+
+    # Collapsed-stack format: one "frame;frame;frame count" line per stack, as read by
+    # flamegraph.pl, speedscope and inferno.
+    with open(os.path.join(PROFILE_DIR, f"{name}.folded"), "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    with open(os.path.join(PROFILE_DIR, f"{name}.json"), "w") as f:
+        json.dump(meta, f)
+    prune()
+
+
+def list_profiles():
+    profiles = []
+    if not os.path.isdir(PROFILE_DIR):
+        return profiles
+    for filename in os.listdir(PROFILE_DIR):
+        if not filename.endswith(".folded"):
+            continue
+        name = filename[:-len(".folded")]
+        try:
+            with open(os.path.join(PROFILE_DIR, f"{name}.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        profiles.append({"name": filename, **meta})
+    return sorted(profiles, key=lambda profile: profile.get('captured_at', 0), reverse=True)
+
+
+def prune():
+    """Keeps at most PROFILE_MAX_FILES profiles, none older than PROFILE_MAX_AGE_HOURS."""
+    cutoff = time.time() - PROFILE_MAX_AGE_HOURS * 3600
+    profiles = list_profiles()
+    for index, profile in enumerate(profiles):
+        if index >= PROFILE_MAX_FILES or profile.get('captured_at', 0) < cutoff:
+            name = profile['name'][:-len(".folded")]
+            for suffix in (".folded", ".json"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, f"{name}{suffix}"))
+                except FileNotFoundError:
+                    pass
+
+
+def start_sampler(rule):
+    """Starts sampling the calling thread if `rule` is configured and picked by the sample rate, else returns None."""
+    config = current_config()
+    if not config or rule not in config.get('routes', ()):
+        return None
+    if random.random() >= config.get('sample_rate', 0):
+        return None
+    interval = config.get('interval_ms', DEFAULT_INTERVAL_MS) / 1000
+    return StackSampler(threading.get_ident(), interval).start()
+
+
+def handoff_interval():
+    """Returns the sampling interval of the current request's profile, or None if it is not sampled."""
+    sampler = g.get('profile_sampler')
+    return sampler.interval if sampler is not None else None
+
+
+def start_handoff_sampler(interval):
+    """Samples the calling thread for work handed off by a sampled request; None when interval is None."""
+    if interval is None:
+        return None
+    return StackSampler(threading.get_ident(), interval).start()
+
+
+def finish_sampler(sampler, rule, method, status, **meta):
+    """Stops a sampler from start_sampler or start_handoff_sampler and saves its profile, if it took any samples."""
+    counts = sampler.stop()
+    if not counts:
+        return
+    _save(counts, {
+        "route": rule,
+        "method": method,
+        "status": status,
+        "duration_ms": round((time.perf_counter() - sampler.started) * 1000, 3),
+        "samples": sum(counts.values()),
+        "interval_ms": round(sampler.interval * 1000, 3),
+        "captured_at": time.time(),
+        "pid": os.getpid(),
+        **meta,
+    })
+
+
+def _before_request():
+    if request.url_rule:
+        sampler = start_sampler(request.url_rule.rule)
+        if sampler is not None:
+            g.profile_sampler = sampler
+
+
+def _after_request(response):
+    if 'profile_sampler' in g:
+        g.profile_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        finish_sampler(sampler, request.url_rule.rule, request.method, g.pop('profile_status', 500))
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,264 @@
+# ratelimit.py
+import math
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import g, jsonify, request
+from config import settings
+import metrics
+from database import get_read_db
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = settings.RATE_LIMIT_ENABLED
+RATE_LIMITS = settings.RATE_LIMITS
+RATE_LIMIT_DB = settings.RATE_LIMIT_DB
+WORKER_THREADS = settings.WORKER_THREADS
+SHED_UTILIZATION = settings.SHED_UTILIZATION
+SHED_ROUTES = settings.SHED_ROUTES
+SHED_RETRY_AFTER_SECONDS = settings.SHED_RETRY_AFTER_SECONDS
+ADDRESS_KEYED_ROUTES = settings.ADDRESS_KEYED_ROUTES
+
+DEFAULT_LIMITS = {
+    '/auth': (30, 60),
+    '/suggest': (5, 60),
+    '/join': (10, 60),
+    '/magnet/<int:film_id>': (60, 60),
+    '/adopt/<int:film_id>': (30, 60),
+    # Generous, and keyed by address: Ko-fi sends from a handful of hosts.
+    '/webhook': (300, 60),
+}
+UTILIZATION_WINDOW_SECONDS = 1.0
+MEMORY_BUCKET_LIMIT = 100_000
+SHARED_BUCKET_TTL_SECONDS = 3600
+
+
+def _parse_limits(value):
+    limits = dict(DEFAULT_LIMITS)
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        route, setting = item.split('=', 1)
+        burst, _, seconds = setting.partition('/')
+        limits[route.strip()] = (float(burst), float(seconds or 1))
+    return {route: limit for route, limit in limits.items() if limit[0] > 0}
+
+
+_limits = _parse_limits(RATE_LIMITS)
+_shed_routes = {route.strip() for route in SHED_ROUTES.split(',') if route.strip()}
+_address_keyed_routes = {route.strip() for route in ADDRESS_KEYED_ROUTES.split(',') if route.strip()}
+
+
+class MemoryBuckets:
+    """Token buckets for this process only, at most MEMORY_BUCKET_LIMIT of them."""
+
+    def __init__(self):
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at], least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, now):
+        """Takes one token. Returns 0 if allowed, else the seconds until a token is available."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MEMORY_BUCKET_LIMIT:
+                    # The least recently used client has had the longest to refill, so it loses the least.
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[key] = [burst, now]
+            else:
+                self._buckets.move_to_end(key)
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+
+class SharedBuckets:
+    """Token buckets in a SQLite file, so every worker on the host draws from the same bucket."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._calls = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=0.5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, burst, rate, now):
+        connection = self._connection()
+        # One statement, so concurrent workers cannot both spend the last token.
+        cursor = connection.execute(
+            """
+            INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?1, ?2 - 1, ?4)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = MIN(?2, tokens + (?4 - updated_at) * ?3) - 1, updated_at = ?4
+            WHERE MIN(?2, tokens + (?4 - updated_at) * ?3) >= 1
+            """,
+            (key, burst, rate, now)
+        )
+        self._calls += 1
+        if self._calls % 1000 == 0:
+            connection.execute("DELETE FROM rate_limit_buckets WHERE updated_at < ?", (now - SHARED_BUCKET_TTL_SECONDS,))
+        if cursor.rowcount:
+            return 0
+        row = connection.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+        tokens = min(burst, row[0] + (now - row[1]) * rate) if row else 0
+        return max(1 - tokens, 0) / rate
+
+
+_memory_buckets = MemoryBuckets()
+_buckets = SharedBuckets(RATE_LIMIT_DB) if RATE_LIMIT_DB else _memory_buckets
+
+
+def forwarded_address(address, forwarded_for):
+    """The client address as ProxyFix(x_for=TRUSTED_PROXY_COUNT) would see it, for requests served outside Flask."""
+    hops = forwarded_for.split(',') if settings.TRUSTED_PROXY_COUNT and forwarded_for else []
+    if len(hops) >= settings.TRUSTED_PROXY_COUNT > 0:
+        return hops[-settings.TRUSTED_PROXY_COUNT].strip()
+    return address
+
+
+def _is_guardian_token(token):
+    try:
+        return get_read_db().execute("SELECT 1 FROM guardians WHERE token = ?", (token,)).fetchone() is not None
+    except sqlite3.Error:
+        return False
+
+
+def client_key(route, token=None, auth_header=None, address=None):
+    """The caller's API token (hashed) if it is a real guardian token, otherwise its address.
+
+    Defaults to the current request; needs an app context, since the token is looked up before it is trusted.
+    """
+    if address is None:
+        # /magnet and /adopt take ?TOKEN=, /auth takes ?token=.
+        token = request.args.get('TOKEN') or request.args.get('token')
+        auth_header = request.headers.get('Authorization', '')
+        # The proxies' X-Forwarded-For has already been applied here when TRUSTED_PROXY_COUNT is set.
+        address = request.remote_addr
+    if route in _address_keyed_routes:
+        return f"ip:{address}"
+    if not token and auth_header and auth_header.startswith('Bearer '):
+        token = auth_header[len('Bearer '):]
+    # An unknown token shares its address's bucket, so guessing tokens is limited like any other request.
+    if token and _is_guardian_token(token):
+        return "token:" + hashlib.sha256(token.encode()).hexdigest()[:16]
+    return f"ip:{address}"
+
+
+def check_rate_limit(route, client=None, now=None):
+    """Returns 0 if the request may proceed, else the seconds the client should wait."""
+    limit = _limits.get(route)
+    if limit is None:
+        return 0
+    burst, seconds = limit
+    # Wall-clock time: bucket timestamps outlive the process in RATE_LIMIT_DB, and are compared across workers.
+    now = time.time() if now is None else now
+    key = f"{route}|{client or client_key(route)}"
+    try:
+        return _buckets.take(key, burst, burst / seconds, now)
+    except sqlite3.Error as e:
+        # A locked or broken state file must not take the site down; fall back to this worker's buckets.
+        logger.warning("Shared rate limit state unavailable (%s); using per-worker limits.", e)
+        return _memory_buckets.take(key, burst, burst / seconds, now)
+
+
+class Utilization:
+    """Share of this worker's request threads that were busy, smoothed over about a second."""
+
+    def __init__(self, threads):
+        self.threads = max(threads, 1)
+        self.value = 0.0
+        self._lock = threading.Lock()
+        self._started = {}  # request id -> start time
+        self._busy_done = 0.0
+        self._last_busy = 0.0
+        self._last_at = time.monotonic()
+
+    def begin(self, request_id, now):
+        with self._lock:
+            self._started[request_id] = now
+
+    def end(self, request_id, now):
+        with self._lock:
+            started = self._started.pop(request_id, None)
+            if started is not None:
+                self._busy_done += now - started
+
+    def current(self, now):
+        with self._lock:
+            elapsed = now - self._last_at
+            if elapsed >= UTILIZATION_WINDOW_SECONDS:
+                busy = self._busy_done + sum(now - started for started in self._started.values())
+                sample = min((busy - self._last_busy) / (elapsed * self.threads), 1.0)
+                self.value = 0.5 * self.value + 0.5 * sample
+                self._last_busy, self._last_at = busy, now
+            return self.value
+
+
+utilization = Utilization(WORKER_THREADS)
+
+
+def _too_many(message, status, retry_after):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def admission_response(route, client, monotonic_now):
+    """Returns the 503 or 429 response for a request that must be turned away, or None. Needs an app context.
+
+    monotonic_now is only for utilization; the rate limit buckets take their own wall-clock time.
+    """
+    if utilization.current(monotonic_now) >= SHED_UTILIZATION and route in _shed_routes:
+        # Jitter spreads the retries so they do not all come back in the same second.
+        return _too_many("Server is busy, please retry shortly.", 503,
+                         SHED_RETRY_AFTER_SECONDS + random.randint(0, SHED_RETRY_AFTER_SECONDS))
+
+    wait = check_rate_limit(route, client) if route else 0
+    if wait:
+        return _too_many("Too many requests.", 429, math.ceil(wait))
+    return None
+
+
+def _before_request():
+    now = time.monotonic()
+    route = request.url_rule.rule if request.url_rule else None
+    response = admission_response(route, client_key(route) if route in _limits else None, now)
+    if response is not None:
+        return response
+
+    g.admission_id = object()
+    utilization.begin(g.admission_id, now)
+
+
+def _teardown_request(exc):
+    request_id = g.pop('admission_id', None)
+    if request_id is not None:
+        utilization.end(request_id, time.monotonic())
+
+
+def init_app(app):
+    if not RATE_LIMIT_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    metrics.register_gauge('worker_utilization', 'Busy share of this worker\'s request threads.',
+                           lambda: round(utilization.value, 3))
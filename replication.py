@@ -0,0 +1,294 @@
+# replication.py
+"""
+Read replicas of the primary database, for serving the read-only routes from more than one node.
+
+The primary ships a consistent copy of its database to REPLICATION_DIR (a local or mounted
+directory) whenever it has changed, together with the published files under CDN_STORAGE_PATH/db.
+Replicas copy each new snapshot next to their own DATABASE and swap it in with a rename, so
+requests already reading the old file finish undisturbed. A manifest records when the shipped
+copy was last known to match the primary; a replica serves its read routes only while that is
+less than REPLICA_MAX_LAG_SECONDS ago, and answers 503 rather than staler data.
+
+    # on the primary, next to the app
+    REPLICATION_ROLE=primary REPLICATION_DIR=/mnt/shiosayi flask --app app replicate
+    # on each replica: the apply loop, and the app itself
+    REPLICATION_ROLE=replica REPLICATION_DIR=/mnt/shiosayi flask --app app replicate
+    REPLICATION_ROLE=replica REPLICATION_DIR=/mnt/shiosayi gunicorn app:app
+
+The primary keeps SQLite's default rollback journal, so there are no WAL frames to ship; the
+backup API gives a consistent snapshot instead, and is only run when PRAGMA data_version shows
+that something was committed since the last one. It is taken on the primary's own disk, so
+writers wait for a local copy at most, never for REPLICATION_DIR.
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+from flask import jsonify, request
+from config import settings
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REPLICATION_ROLE = settings.REPLICATION_ROLE
+REPLICATION_DIR = settings.REPLICATION_DIR
+REPLICATION_INTERVAL_SECONDS = settings.REPLICATION_INTERVAL_SECONDS
+REPLICA_MAX_LAG_SECONDS = settings.REPLICA_MAX_LAG_SECONDS
+REPLICA_ROUTES = settings.REPLICA_ROUTES
+
+SNAPSHOT_FILENAME = "primary.db"
+MANIFEST_FILENAME = "manifest.json"
+PUBLIC_DIRNAME = "db"
+# Served by a replica whatever its lag, so it can be monitored and taken out of rotation.
+ALWAYS_ROUTES = {'/health', '/admin/metrics'}
+
+_replica_routes = {route.strip() for route in REPLICA_ROUTES.split(',') if route.strip()}
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _mirror_files(source_dir, target_dir):
+    """Copies files that are new or changed (by size and mtime) from source_dir. Returns the names copied."""
+    if not os.path.isdir(source_dir):
+        return []
+    os.makedirs(target_dir, exist_ok=True)
+    copied = []
+    # Checksums last, so a .sha256 never describes a file that has not arrived yet.
+    for name in sorted(os.listdir(source_dir), key=lambda name: (name.endswith(".sha256"), name)):
+        source = os.path.join(source_dir, name)
+        if name.endswith((".tmp", ".bak")) or not os.path.isfile(source):
+            continue
+        target = os.path.join(target_dir, name)
+        stat = os.stat(source)
+        try:
+            current = os.stat(target)
+            if (current.st_size, current.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                continue
+        except FileNotFoundError:
+            pass
+        shutil.copy2(source, f"{target}.tmp")
+        os.replace(f"{target}.tmp", target)
+        copied.append(name)
+    return copied
+
+
+class Shipper:
+    """Runs on the primary: ships the database to the replication directory when it has changed."""
+
+    def __init__(self, db_path, directory, public_dir=None):
+        self.db_path = db_path
+        self.directory = directory
+        self.public_dir = public_dir
+        self._source = None
+        self._data_version = None
+        self.manifest = _read_json(os.path.join(directory, MANIFEST_FILENAME)) or {"generation": 0}
+
+    def ship(self, now=None):
+        """Ships a snapshot if anything was committed since the last one, and refreshes the manifest either way."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self._source is None:
+            self._source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        # Read before the copy: a commit landing during it changes data_version again and is shipped next time.
+        data_version = self._source.execute("PRAGMA data_version").fetchone()[0]
+        as_of = time.time() if now is None else now
+
+        if data_version != self._data_version:
+            # The backup holds a read lock on the primary, which blocks its writers from committing.
+            # Take it next to the database, where it is a local copy, and send that to the directory
+            # (possibly a network mount) afterwards, with no lock held.
+            local_path = f"{self.db_path}.shipping"
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            target = sqlite3.connect(local_path)
+            try:
+                self._source.backup(target)
+                # Replicas only ever read the copy; with a rollback journal they need no -wal or -shm beside it.
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+            sha256 = _file_sha256(local_path)
+            tmp_path = os.path.join(self.directory, f"{SNAPSHOT_FILENAME}.tmp")
+            try:
+                shutil.copyfile(local_path, tmp_path)
+            finally:
+                os.remove(local_path)
+            os.replace(tmp_path, os.path.join(self.directory, SNAPSHOT_FILENAME))
+            self._data_version = data_version
+            self.manifest = {
+                "generation": self.manifest["generation"] + 1,
+                "sha256": sha256,
+                "bytes": os.path.getsize(os.path.join(self.directory, SNAPSHOT_FILENAME)),
+                "shipped_at": as_of,
+            }
+            logger.info("Replication: shipped generation %s (%s bytes).", self.manifest["generation"], self.manifest["bytes"])
+
+        if self.public_dir:
+            _mirror_files(self.public_dir, os.path.join(self.directory, PUBLIC_DIRNAME))
+        # The shipped copy still matches the primary as of `as_of`; this is what replica lag is measured from.
+        self.manifest["as_of"] = as_of
+        _write_json(os.path.join(self.directory, MANIFEST_FILENAME), self.manifest)
+        return self.manifest
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+
+def replica_state_path(db_path):
+    return f"{db_path}.replica.json"
+
+
+class Replica:
+    """Runs on a replica: applies shipped snapshots to the local database."""
+
+    def __init__(self, directory, db_path, public_dir=None):
+        self.directory = directory
+        self.db_path = db_path
+        self.public_dir = public_dir
+        self.state = _read_json(replica_state_path(db_path)) or {}
+
+    def apply(self, now=None):
+        """Applies the shipped snapshot unless it is the one already applied. Returns the replica state."""
+        manifest = _read_json(os.path.join(self.directory, MANIFEST_FILENAME))
+        if not manifest or not manifest.get("sha256"):
+            return self.state
+
+        # Generations start again at 1 if REPLICATION_DIR is re-created, so the checksum decides too.
+        if (manifest["generation"], manifest["sha256"]) != (self.state.get("generation"), self.state.get("sha256")):
+            incoming = f"{self.db_path}.incoming"
+            shutil.copyfile(os.path.join(self.directory, SNAPSHOT_FILENAME), incoming)
+            if _file_sha256(incoming) != manifest["sha256"]:
+                # The primary shipped again while we copied; the next pass picks up the new one.
+                os.remove(incoming)
+                logger.info("Replication: snapshot changed while copying; retrying.")
+                return self.state
+            os.replace(incoming, self.db_path)
+            logger.info("Replication: applied generation %s.", manifest["generation"])
+
+        if self.public_dir:
+            _mirror_files(os.path.join(self.directory, PUBLIC_DIRNAME), self.public_dir)
+        self.state = {
+            "generation": manifest["generation"],
+            "sha256": manifest["sha256"],
+            "as_of": manifest["as_of"],
+            "applied_at": time.time() if now is None else now,
+        }
+        _write_json(replica_state_path(self.db_path), self.state)
+        return self.state
+
+
+def run_forever(step, interval=REPLICATION_INTERVAL_SECONDS):
+    while True:
+        started = time.monotonic()
+        try:
+            step()
+        except (OSError, sqlite3.Error) as e:
+            # A mount that is briefly unavailable must not stop the loop; lag grows until it is back.
+            logger.warning("Replication: pass failed (%s); retrying.", e)
+        time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+class LagReader:
+    """A replica's lag in seconds, from the state file its apply loop writes; None before the first apply."""
+
+    def __init__(self, db_path):
+        self.path = replica_state_path(db_path)
+        self._state = None
+        self._mtime = None
+
+    def lag(self, now=None):
+        now = time.time() if now is None else now
+        # A stat per request is cheap; the file is only parsed again after the apply loop rewrites it.
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            self._state, self._mtime = _read_json(self.path), mtime
+        if not self._state:
+            return None
+        return max(now - self._state["as_of"], 0.0)
+
+
+_lag_reader = None
+
+
+def current_lag():
+    return _lag_reader.lag() if _lag_reader else None
+
+
+def is_stale(lag):
+    return lag is None or lag > REPLICA_MAX_LAG_SECONDS
+
+
+def admission_response(route):
+    """On a replica, the 503 for a route it does not serve or for data that is too stale, else None."""
+    if REPLICATION_ROLE != 'replica' or route is None or route in ALWAYS_ROUTES:
+        return None
+    if route not in _replica_routes:
+        response = jsonify({"error": "This node is a read-only replica; send this request to the primary."})
+        response.status_code = 503
+        return response
+    if is_stale(current_lag()):
+        response = jsonify({"error": "Replica data is out of date, please retry shortly.",
+                            "retry_after": int(REPLICATION_INTERVAL_SECONDS) + 1})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(REPLICATION_INTERVAL_SECONDS) + 1)
+        return response
+    return None
+
+
+def health():
+    """Replication details for /health, or None on a single node."""
+    if REPLICATION_ROLE != 'replica':
+        return None
+    lag = current_lag()
+    return {"role": "replica", "lag_seconds": None if lag is None else round(lag, 3), "stale": is_stale(lag)}
+
+
+def _lag_gauge():
+    lag = current_lag()
+    return -1 if lag is None else round(lag, 3)
+
+
+def _before_request():
+    return admission_response(request.url_rule.rule if request.url_rule else None)
+
+
+def init_app(app):
+    global _lag_reader
+    if REPLICATION_ROLE != 'replica':
+        return
+    if not REPLICATION_DIR:
+        raise RuntimeError("FATAL: REPLICATION_ROLE is 'replica' but REPLICATION_DIR is not set.")
+    # Nothing on a replica may write to the copy it serves; the next snapshot would discard it anyway.
+    app.config['DATABASE_READ_ONLY'] = True
+    _lag_reader = LagReader(app.config['DATABASE'])
+    app.before_request(_before_request)
+    metrics.register_gauge('replication_lag_seconds', 'Age of the data this replica serves (-1 before the first apply).',
+                           _lag_gauge)
@@ -0,0 +1,227 @@
+# scheduler.py
+import os
+import json
+import math
+import time
+import random
+import socket
+import sqlite3
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+from config import settings
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+HOUSEKEEPING_INTERVAL = settings.SCHEDULER_HOUSEKEEPING_INTERVAL
+PUBLISH_INTERVAL = settings.SCHEDULER_PUBLISH_INTERVAL
+EMAIL_INTERVAL = settings.SCHEDULER_EMAIL_INTERVAL
+POSTER_INTERVAL = settings.SCHEDULER_POSTER_INTERVAL
+JITTER_SECONDS = settings.SCHEDULER_JITTER_SECONDS
+POLL_SECONDS = settings.SCHEDULER_POLL_SECONDS
+LEASE_SECONDS = settings.SCHEDULER_LEASE_SECONDS
+LEASE_RENEW_SECONDS = settings.SCHEDULER_LEASE_RENEW_SECONDS
+OFF_PEAK_HOURS = settings.SCHEDULER_OFF_PEAK_HOURS
+
+
+class Job:
+    """A periodic job. Jobs marked off_peak run once per `interval` (rounded up to whole days) inside OFF_PEAK_HOURS."""
+
+    def __init__(self, name, func, interval, off_peak=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.off_peak = off_peak
+        self.jitter = random.uniform(0, JITTER_SECONDS)
+
+
+def holder_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def in_off_peak_window(now=None, window=OFF_PEAK_HOURS):
+    """Checks an 'H-H' local-time window (end exclusive, may wrap past midnight). Empty means always."""
+    if not window:
+        return True
+    start, end = (int(part) for part in window.split('-'))
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def window_opened(moment, window=OFF_PEAK_HOURS):
+    """The last time at or before `moment` that the 'H-H' window opened."""
+    opened = moment.replace(hour=int(window.split('-')[0]), minute=0, second=0, microsecond=0)
+    return opened if opened <= moment else opened - timedelta(days=1)
+
+
+def acquire_lease(db, job_name, holder, lease_seconds=LEASE_SECONDS):
+    now = time.time()
+    cursor = db.execute(
+        """
+        INSERT INTO scheduler_leases (job, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (job) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE scheduler_leases.expires_at < ? OR scheduler_leases.holder = excluded.holder
+        """,
+        (job_name, holder, now + lease_seconds, now)
+    )
+    db.commit()
+    return cursor.rowcount == 1
+
+
+def release_lease(db, job_name, holder):
+    db.execute("UPDATE scheduler_leases SET expires_at = 0 WHERE job = ? AND holder = ?", (job_name, holder))
+    db.commit()
+
+
+def renew_lease(db, job_name, holder, lease_seconds=LEASE_SECONDS):
+    """Extends a lease this holder still has. Returns False if it has lost it."""
+    cursor = db.execute(
+        "UPDATE scheduler_leases SET expires_at = ? WHERE job = ? AND holder = ?",
+        (time.time() + lease_seconds, job_name, holder)
+    )
+    db.commit()
+    return cursor.rowcount == 1
+
+
+class LeaseHeartbeat:
+    """Renews a lease from a background thread while a job runs, on a connection of its own."""
+
+    def __init__(self, db_path, job_name, holder, interval=LEASE_RENEW_SECONDS):
+        self.db_path = db_path
+        self.job_name = job_name
+        self.holder = holder
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-{job_name}", daemon=True)
+
+    def _run(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    if not renew_lease(db, self.job_name, self.holder):
+                        self.lost = True
+                        logger.warning("Scheduler: lost the lease on '%s' while running it.", self.job_name)
+                        return
+                except sqlite3.Error as e:
+                    # The job itself may hold the write lock; the lease has time for another try.
+                    logger.warning("Scheduler: could not renew the lease on '%s' (%s).", self.job_name, e)
+        finally:
+            db.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+@contextmanager
+def exclusive_run(db, job_name, holder=None):
+    """Holds a job's lease for the duration of the block, renewing it as needed. Yields False if another instance holds it."""
+    holder = holder or f"{holder_id()}:{uuid.uuid4().hex[:8]}"
+    if not acquire_lease(db, job_name, holder):
+        yield False
+        return
+    try:
+        with LeaseHeartbeat(current_app.config['DATABASE'], job_name, holder):
+            yield True
+    finally:
+        release_lease(db, job_name, holder)
+
+
+def last_run_started(db, job_name):
+    row = db.execute(
+        "SELECT started_at FROM job_runs WHERE job = ? ORDER BY started_at DESC LIMIT 1", (job_name,)
+    ).fetchone()
+    return row['started_at'] if row else None
+
+
+def is_due(db, job, now=None, window=OFF_PEAK_HOURS):
+    now = now or time.time()
+    last_started = last_run_started(db, job.name)
+    if not (job.off_peak and window):
+        return last_started is None or now >= last_started + job.interval + job.jitter
+
+    # An off-peak run is due at the window's opening plus this run's jitter, never at the last
+    # run plus the interval: that drifts by the jitter every day until it skips one or leaves the window.
+    moment = datetime.fromtimestamp(now)
+    if not in_off_peak_window(moment, window):
+        return False
+    opened = window_opened(moment, window)
+    start, end = (int(part) for part in window.split('-'))
+    if now < opened.timestamp() + min(job.jitter, (end - start) % 24 * 3600 / 2):
+        return False
+    if last_started is None:
+        return True
+    days_since = (opened.date() - window_opened(datetime.fromtimestamp(last_started), window).date()).days
+    return days_since >= max(1, math.ceil(job.interval / (24 * 60 * 60)))
+
+
+def run_job(db, job, holder):
+    """Runs a job and records its duration and outcome in job_runs."""
+    started = time.time()
+    cursor = db.execute(
+        "INSERT INTO job_runs (job, holder, started_at, status) VALUES (?, ?, ?, 'running')",
+        (job.name, holder, started)
+    )
+    db.commit()
+    run_id = cursor.lastrowid
+    logger.info("Scheduler: starting job '%s' (run %s).", job.name, run_id)
+
+    status, detail = 'success', None
+    try:
+        result = job.func()
+        if isinstance(result, dict) and result.get('status') == 'error':
+            status = 'error'
+        detail = json.dumps(result, default=str)
+    except Exception as e:
+        logger.exception("Scheduler: job '%s' failed.", job.name)
+        status, detail = 'error', str(e)
+
+    duration_ms = round((time.time() - started) * 1000, 2)
+    db.execute(
+        "UPDATE job_runs SET finished_at = ?, duration_ms = ?, status = ?, detail = ? WHERE id = ?",
+        (time.time(), duration_ms, status, detail, run_id)
+    )
+    db.commit()
+    logger.info("Scheduler: job '%s' finished with status '%s' in %s ms.", job.name, status, duration_ms)
+    return status
+
+
+def run_due_jobs(app, jobs, holder):
+    """Runs every due job this process can take the lease for. Returns the names of the jobs run."""
+    ran = []
+    for job in jobs:
+        with app.app_context():
+            db = get_db()
+            if not is_due(db, job):
+                continue
+            with exclusive_run(db, job.name, holder) as acquired:
+                if not acquired:
+                    logger.info("Scheduler: job '%s' is due but another instance holds the lease.", job.name)
+                    continue
+                # Another instance may have finished a run between our check and taking the lease.
+                if is_due(db, job):
+                    run_job(db, job, holder)
+                    job.jitter = random.uniform(0, JITTER_SECONDS)
+                    ran.append(job.name)
+    return ran
+
+
+def run_forever(app, jobs, poll_seconds=POLL_SECONDS):
+    holder = holder_id()
+    logger.info("Scheduler started as '%s' with jobs: %s.", holder, ', '.join(job.name for job in jobs))
+    while True:
+        run_due_jobs(app, jobs, holder)
+        time.sleep(poll_seconds + random.uniform(0, poll_seconds / 2))
@@ -1,4 +1,4 @@
-CREATE TABLE guardians (
+CREATE TABLE IF NOT EXISTS guardians (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT,
     email TEXT UNIQUE NOT NULL,
@@ -8,7 +8,7 @@ CREATE TABLE guardians (
     last_paid_at DATETIME
 );
 
-CREATE TABLE films (
+CREATE TABLE IF NOT EXISTS films (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     title TEXT NOT NULL,
     year INTEGER,
@@ -18,19 +18,32 @@ CREATE TABLE films (
     guardian_id TEXT,
     status TEXT CHECK (status IN ('orphan', 'adopted')) NOT NULL DEFAULT 'orphan',
     magnet TEXT,
-    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    info_hash TEXT
 );
 
-CREATE TABLE suggestions (
+CREATE TABLE IF NOT EXISTS suggestions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     email TEXT NOT NULL,
     title TEXT NOT NULL,
     notes TEXT,
     status TEXT CHECK (status IN ('pending', 'added', 'ignored')) DEFAULT 'pending',
-    suggested_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    suggested_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    title_key TEXT,
+    year INTEGER,
+    votes INTEGER NOT NULL DEFAULT 1,
+    last_suggested_at DATETIME
 );
 
-CREATE TABLE kofi_events (
+-- One row per (film, email): a second suggestion of the same film from the same address is not another vote.
+CREATE TABLE IF NOT EXISTS suggestion_votes (
+    title_key TEXT NOT NULL,
+    email TEXT NOT NULL,
+    voted_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (title_key, email)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS kofi_events (
     id TEXT PRIMARY KEY,
     timestamp DATETIME NOT NULL,
     type TEXT CHECK (type IN ('Donation', 'Subscription')) NOT NULL,
@@ -46,4 +59,189 @@ CREATE TABLE kofi_events (
     tier_name TEXT,
     kofi_transaction_id TEXT,
     raw_payload TEXT
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily_revenue (
+    day TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    kind TEXT CHECK (kind IN ('new', 'renewal', 'donation')) NOT NULL,
+    amount REAL NOT NULL DEFAULT 0,
+    events INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, currency, tier, kind)
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily_members (
+    day TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    joined INTEGER NOT NULL DEFAULT 0,
+    renewed INTEGER NOT NULL DEFAULT 0,
+    lapsed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, tier)
+);
+
+CREATE TABLE IF NOT EXISTS stats_active_tiers (
+    tier TEXT PRIMARY KEY,
+    active INTEGER NOT NULL DEFAULT 0
+);
+
+-- Seeded from the guardians already present when the table is new, so that the incremental
+-- updates start from the real counts. Re-running init-db leaves a populated table alone.
+INSERT INTO stats_active_tiers (tier, active)
+SELECT tier, COUNT(*) FROM guardians
+WHERE NOT EXISTS (SELECT 1 FROM stats_active_tiers)
+GROUP BY tier;
+
+CREATE INDEX IF NOT EXISTS idx_films_guardian_id ON films (guardian_id);
+CREATE INDEX IF NOT EXISTS idx_guardians_last_paid_at ON guardians (last_paid_at);
+-- Date-range exports page through these in (date, rowid) order.
+CREATE INDEX IF NOT EXISTS idx_guardians_joined_at ON guardians (joined_at);
+CREATE INDEX IF NOT EXISTS idx_suggestions_suggested_at ON suggestions (suggested_at);
+CREATE INDEX IF NOT EXISTS idx_kofi_events_timestamp ON kofi_events (timestamp);
+-- A membership payment is a renewal if the same email has an earlier one (services._bump_payment_rollup).
+CREATE INDEX IF NOT EXISTS idx_kofi_events_email_timestamp ON kofi_events (email, timestamp, id);
+-- Suggestions of the same film (see utils.normalize_title) are merged into one row; rows from
+-- before the merge have no key until `flask --app app merge-suggestions` runs.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_suggestions_title_key ON suggestions (title_key);
+-- /admin/suggestions reads this backwards: most votes first, newest first among equal votes.
+CREATE INDEX IF NOT EXISTS idx_suggestions_rank ON suggestions (status, votes, id);
+
+CREATE TABLE IF NOT EXISTS ex_guardians (
+    email TEXT PRIMARY KEY,
+    id INTEGER,
+    name TEXT,
+    tier TEXT NOT NULL,
+    token TEXT NOT NULL,
+    joined_at DATETIME NOT NULL,
+    last_paid_at DATETIME,
+    lapsed_at DATETIME NOT NULL
+);
+
+-- Onboarding matches emails case-insensitively; lower() folds ASCII only, as services.EMAIL_CASE does.
+CREATE INDEX IF NOT EXISTS idx_guardians_email_lower ON guardians (lower(email));
+CREATE INDEX IF NOT EXISTS idx_ex_guardians_email_lower ON ex_guardians (lower(email));
+
+-- Every film a guardian held when they lapsed. restored_at is set once they come back, and the
+-- row is kept as history; only rows with restored_at NULL are re-adopted on a restore.
+CREATE TABLE IF NOT EXISTS ex_guardian_films (
+    email TEXT NOT NULL,
+    film_id INTEGER NOT NULL,
+    restored_at DATETIME,
+    PRIMARY KEY (email, film_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS scheduler_leases (
+    job TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    duration_ms REAL,
+    status TEXT CHECK (status IN ('running', 'success', 'error')) NOT NULL,
+    detail TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_runs_job_started_at ON job_runs (job, started_at);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_films_info_hash ON films (info_hash) WHERE info_hash IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_films_title_year ON films (title COLLATE NOCASE, year);
+-- Every index ends in the rowid, so these also serve `WHERE status = ? AND id > ? ORDER BY id` page scans.
+CREATE INDEX IF NOT EXISTS idx_films_status ON films (status);
+CREATE INDEX IF NOT EXISTS idx_films_region ON films (region);
+
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_email TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    template_name TEXT NOT NULL,
+    template_data TEXT,
+    status TEXT CHECK (status IN ('pending', 'sent', 'failed')) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    sent_at DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox (status, id);
+
+CREATE TABLE IF NOT EXISTS posters (
+    id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE,
+    phash TEXT NOT NULL,
+    url TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Single uploads accepted by /admin/upload-poster and rendered after the request returns.
+CREATE TABLE IF NOT EXISTS poster_jobs (
+    id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    status TEXT CHECK (status IN ('pending', 'rendering', 'ready', 'failed')) NOT NULL DEFAULT 'pending',
+    url TEXT,
+    error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    claimed_at REAL,
+    finished_at DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS idx_poster_jobs_sha256 ON poster_jobs (sha256);
+CREATE INDEX IF NOT EXISTS idx_poster_jobs_status ON poster_jobs (status);
+
+-- Append-only feed of public-visible changes to films and guardians, read by /changes.
+-- AUTOINCREMENT keeps seq strictly increasing even after compaction deletes the newest rows.
+CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity TEXT CHECK (entity IN ('film', 'guardian')) NOT NULL,
+    entity_id TEXT NOT NULL,
+    op TEXT CHECK (op IN ('upsert', 'delete')) NOT NULL,
+    changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_change_log_entity ON change_log (entity, entity_id);
+
+-- Each compaction records the highest seq whose tombstones it dropped; clients behind that must resync.
+CREATE TABLE IF NOT EXISTS change_log_compactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    compacted_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    horizon_seq INTEGER NOT NULL,
+    removed INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_films_change_insert AFTER INSERT ON films
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('film', NEW.id, 'upsert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_films_change_update AFTER UPDATE ON films
+WHEN OLD.title IS NOT NEW.title OR OLD.year IS NOT NEW.year OR OLD.plot IS NOT NEW.plot
+  OR OLD.poster_url IS NOT NEW.poster_url OR OLD.region IS NOT NEW.region
+  OR OLD.guardian_id IS NOT NEW.guardian_id OR OLD.status IS NOT NEW.status
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('film', NEW.id, 'upsert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_films_change_delete AFTER DELETE ON films
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('film', OLD.id, 'delete');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_guardians_change_insert AFTER INSERT ON guardians
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('guardian', NEW.id, 'upsert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_guardians_change_update AFTER UPDATE ON guardians
+WHEN OLD.name IS NOT NEW.name OR OLD.tier IS NOT NEW.tier OR OLD.joined_at IS NOT NEW.joined_at
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('guardian', NEW.id, 'upsert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_guardians_change_delete AFTER DELETE ON guardians
+BEGIN
+    INSERT INTO change_log (entity, entity_id, op) VALUES ('guardian', OLD.id, 'delete');
+END;
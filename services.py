@@ -1,22 +1,95 @@
 import os
 import logging
 import sqlite3
-import csv
 import hashlib
+import csv
+import io
+import zlib
+import time
+import json
+import uuid
+import string
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
-from database import get_db
+from config import settings
+from database import get_db, get_read_db
+import utils
+import snapshots
 from utils import generate_api_token
 from mail import EmailService
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 TIER_LIMITS = {'lover': 1, 'keeper': 5, 'savior': 10}
 TIER_MAP = {"lover": "lover", "keeper": "keeper", "savior": "savior"}
 
+def _event_day(payload):
+    return str(payload.get('timestamp') or datetime.now().isoformat())[:10]
+
+def _bump_revenue_rollup(db, payload):
+    if payload.get('is_first_subscription_payment'):
+        kind = 'new'
+    elif payload.get('is_subscription_payment'):
+        kind = 'renewal'
+    else:
+        kind = 'donation'
+    db.execute(
+        """
+        INSERT INTO stats_daily_revenue (day, currency, tier, kind, amount, events)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT (day, currency, tier, kind) DO UPDATE SET
+            amount = amount + excluded.amount, events = events + 1
+        """,
+        (_event_day(payload), payload.get('currency') or '', (payload.get('tier_name') or '').lower(),
+         kind, float(payload['amount']))
+    )
+
+def _bump_member_rollup(db, day, tier, joined=0, renewed=0, lapsed=0):
+    db.execute(
+        """
+        INSERT INTO stats_daily_members (day, tier, joined, renewed, lapsed)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day, tier) DO UPDATE SET
+            joined = joined + excluded.joined,
+            renewed = renewed + excluded.renewed,
+            lapsed = lapsed + excluded.lapsed
+        """,
+        (day, tier, joined, renewed, lapsed)
+    )
+
+def _bump_payment_rollup(db, payload, tier):
+    """Counts a membership payment as a renewal if the same email paid for a membership before.
+
+    Earlier means earlier in (timestamp, id) order among the logged Ko-fi events, which is
+    exactly what rebuild_stats counts, so a guardian's first Ko-fi payment is never a renewal,
+    however they joined.
+    """
+    earlier = db.execute(
+        """
+        SELECT 1 FROM kofi_events
+        WHERE email = ?1 AND type = 'Subscription' AND is_subscription_payment AND tier_name IS NOT NULL
+          AND (timestamp < ?2 OR (timestamp = ?2 AND id < ?3))
+        LIMIT 1
+        """,
+        (payload.get('email'), payload.get('timestamp'), payload.get('message_id'))
+    ).fetchone()
+    if earlier:
+        _bump_member_rollup(db, _event_day(payload), tier, renewed=1)
+
+def _bump_active_tier(db, tier, delta):
+    db.execute(
+        """
+        INSERT INTO stats_active_tiers (tier, active) VALUES (?, ?)
+        ON CONFLICT (tier) DO UPDATE SET active = active + excluded.active
+        """,
+        (tier, delta)
+    )
+
 def log_kofi_event(payload):
     db = get_db()
-    db.execute(
+    cursor = db.execute(
         """
         INSERT OR IGNORE INTO kofi_events (id, timestamp, type, is_public, from_name, email, message,
         amount, currency, url, is_subscription_payment, is_first_subscription_payment,
@@ -32,8 +105,10 @@ def log_kofi_event(payload):
             payload.get('kofi_transaction_id'), str(payload)
         )
     )
+    if cursor.rowcount:
+        _bump_revenue_rollup(db, payload)
     db.commit()
-    logging.info(f"Logged (or ignored duplicate) Ko-fi event: {payload['message_id']}")
+    logger.info("Logged (or ignored duplicate) Ko-fi event: %s", payload['message_id'])
 
 def process_subscription_payment(payload):
     email = payload.get('email')
@@ -51,10 +126,14 @@ def process_subscription_payment(payload):
     if guardian:
         current_tier, guardian_id, guardian_token = guardian['tier'], guardian['id'], guardian['token']
         db.execute("UPDATE guardians SET last_paid_at = ?, tier = ? WHERE id = ?", (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), app_tier, guardian_id))
+        _bump_payment_rollup(db, payload, app_tier)
+        if app_tier != current_tier:
+            _bump_active_tier(db, current_tier, -1)
+            _bump_active_tier(db, app_tier, 1)
         db.commit()
 
         if app_tier != current_tier:
-            logging.info(f"Guardian {guardian_id} upgraded from '{current_tier}' to '{app_tier}'.")
+            logger.info("Guardian %s upgraded from '%s' to '%s'.", guardian_id, current_tier, app_tier)
             email_service.send_email(
                 to_email=email, subject="Your Shiosayi Tier has been Upgraded!",
                 template_name="guardian_welcome_email",
@@ -64,10 +143,15 @@ def process_subscription_payment(payload):
                 }
             )
         else:
-            logging.info(f"Processed renewal for existing guardian {guardian_id}.")
+            logger.info("Processed renewal for existing guardian %s.", guardian_id)
     else:
-        logging.info(f"Creating new guardian for {email}.")
-        _create_new_guardian(payload, app_tier, email_service)
+        ex_guardian = db.execute("SELECT * FROM ex_guardians WHERE email = ?", (email,)).fetchone()
+        if ex_guardian:
+            logger.info("Restoring archived guardian for %s.", email)
+            _restore_ex_guardian(payload, app_tier, ex_guardian, email_service)
+        else:
+            logger.info("Creating new guardian for %s.", email)
+            _create_new_guardian(payload, app_tier, email_service)
 
 def _create_new_guardian(payload, app_tier, email_service):
     db = get_db()
@@ -88,9 +172,13 @@ def _create_new_guardian(payload, app_tier, email_service):
         VALUES (:name, :email, :tier, :token, :joined_at, :last_paid_at)
         """, guardian_data
     )
+    # Joins are counted on joined_at, as rebuild_stats counts them.
+    _bump_member_rollup(db, guardian_data['joined_at'][:10], app_tier, joined=1)
+    _bump_payment_rollup(db, payload, app_tier)
+    _bump_active_tier(db, app_tier, 1)
     db.commit()
     new_id = cursor.lastrowid
-    logging.info(f"Created new guardian: {new_id} ({email}) with tier '{app_tier}'")
+    logger.info("Created new guardian: %s (%s) with tier '%s'", new_id, email, app_tier)
 
     email_service.send_email(
         to_email=email, subject="Welcome to the Shiosayi Community!",
@@ -98,46 +186,393 @@ def _create_new_guardian(payload, app_tier, email_service):
         template_data={"user_name": guardian_data['name'], "tier_name": app_tier, "api_key": new_token}
     )
 
-def perform_housekeeping(days_lapsed=35, archive_file="ex_guardians.csv"):
+def _readopt_ex_guardian_films(db, email, guardian_id, tier, now):
+    """Gives a returning guardian back the films they had, if still orphaned and within their tier's limit.
+
+    Their ex_guardian_films rows are kept as the record of what they adopted, marked with
+    restored_at so a later restore does not offer them again; the caller commits.
+    Returns (restored ids, previous ids).
+    """
+    previous_film_ids = [row['film_id'] for row in db.execute(
+        "SELECT film_id FROM ex_guardian_films WHERE email = ? AND restored_at IS NULL ORDER BY film_id", (email,)
+    )]
+    restored_film_ids = []
+    if previous_film_ids:
+        placeholders = ", ".join("?" * len(previous_film_ids))
+        restored_film_ids = [row['id'] for row in db.execute(
+            f"SELECT id FROM films WHERE id IN ({placeholders}) AND status = 'orphan' ORDER BY id LIMIT ?",
+            (*previous_film_ids, TIER_LIMITS.get(tier, 0))
+        )]
+    if restored_film_ids:
+        placeholders = ", ".join("?" * len(restored_film_ids))
+        db.execute(
+            f"UPDATE films SET guardian_id = ?, status = 'adopted', updated_at = ? WHERE id IN ({placeholders})",
+            (guardian_id, now, *restored_film_ids)
+        )
+    db.execute("UPDATE ex_guardian_films SET restored_at = ? WHERE email = ? AND restored_at IS NULL", (now, email))
+    return restored_film_ids, previous_film_ids
+
+def _restore_ex_guardian(payload, app_tier, ex_guardian, email_service):
+    db = get_db()
+    email = ex_guardian['email']
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    id_taken = db.execute("SELECT 1 FROM guardians WHERE id = ?", (ex_guardian['id'],)).fetchone()
+    cursor = db.execute(
+        """
+        INSERT INTO guardians (id, name, email, tier, token, joined_at, last_paid_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (None if id_taken else ex_guardian['id'], payload.get('from_name') or ex_guardian['name'],
+         email, app_tier, ex_guardian['token'], ex_guardian['joined_at'], now)
+    )
+    guardian_id = cursor.lastrowid
+
+    restored_film_ids, previous_film_ids = _readopt_ex_guardian_films(db, email, guardian_id, app_tier, now)
+    db.execute("DELETE FROM ex_guardians WHERE email = ?", (email,))
+    # A returning guardian keeps their joined_at, so this payment is not another join.
+    _bump_payment_rollup(db, payload, app_tier)
+    _bump_active_tier(db, app_tier, 1)
+    db.commit()
+    logger.info(
+        "Restored guardian %s (%s) with tier '%s'. Re-adopted %s of %s previously adopted films.",
+        guardian_id, email, app_tier, len(restored_film_ids), len(previous_film_ids)
+    )
+
+    email_service.send_email(
+        to_email=email, subject="Welcome back to the Shiosayi Community!",
+        template_name="guardian_welcome_email",
+        template_data={
+            "title": "Welcome back to the Shiosayi Community!",
+            "user_name": payload.get('from_name') or ex_guardian['name'], "tier_name": app_tier,
+            "api_key": ex_guardian['token']
+        }
+    )
+
+def import_ex_guardians_csv(csv_path):
+    """Loads a legacy ex_guardians.csv archive into the ex_guardians table."""
+    db = get_db()
+    imported = 0
+    with open(csv_path, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            cursor = db.execute(
+                """
+                INSERT OR IGNORE INTO ex_guardians (email, id, name, tier, token, joined_at, last_paid_at, lapsed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                """,
+                (row['email'], row.get('id') or None, row.get('name'), row['tier'], row['token'],
+                 row['joined_at'], row.get('last_paid_at') or None, row.get('last_paid_at') or None)
+            )
+            imported += cursor.rowcount
+    db.commit()
+    logger.info("Imported %s archived guardians from '%s'.", imported, csv_path)
+    return imported
+
+ONBOARDING_BATCH_SIZE = 500
+# SQLite's lower() only folds ASCII letters; emails are matched the same way in Python and in SQL.
+EMAIL_CASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class OnboardingConflictError(Exception):
+    """A guardian in the current batch was added concurrently; earlier batches stay committed."""
+
+    def __init__(self, result):
+        super().__init__("A guardian in this batch was added concurrently; the batch was rolled back.")
+        self.result = result
+
+EMAIL_MAX_ATTEMPTS = 5
+
+def onboard_guardians(members, batch_size=ONBOARDING_BATCH_SIZE):
+    """Creates guardians in bulk from dicts with 'name', 'email' and 'tier'.
+
+    Tokens are generated up front and each batch is inserted in one transaction. Welcome
+    emails are queued in email_outbox rather than sent inline. Emails that already belong
+    to a guardian are skipped; archived guardians get their old token back, and the films
+    they had that are still orphaned, up to their tier's limit.
+    """
+    db = get_db()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    today = now[:10]
+    result = {"created": 0, "restored": 0, "films_readopted": 0, "skipped_existing": 0, "invalid": 0, "errors": []}
+    seen_emails = set()
+    batch = []
+
+    def flush():
+        emails = [member['key'] for member in batch]
+        placeholders = ", ".join("?" * len(emails))
+        # Keyed by lower(email), so 'Foo@x.com' and 'foo@x.com' are the same guardian across batches too.
+        existing = {row['email'].translate(EMAIL_CASE) for row in db.execute(
+            f"SELECT email FROM guardians WHERE lower(email) IN ({placeholders})", emails
+        )}
+        archived = {row['email'].translate(EMAIL_CASE): row for row in db.execute(
+            f"SELECT email, id, token, joined_at FROM ex_guardians WHERE lower(email) IN ({placeholders})", emails
+        )}
+        if archived:
+            archived_ids = [row['id'] for row in archived.values()]
+            taken_ids = {row['id'] for row in db.execute(
+                f"SELECT id FROM guardians WHERE id IN ({', '.join('?' * len(archived_ids))})", archived_ids
+            )}
+        else:
+            taken_ids = set()
+
+        # Counted into result only once the batch commits, so a conflict leaves it describing what was saved.
+        counts = {"created": 0, "restored": 0, "films_readopted": 0, "skipped_existing": 0}
+        guardian_rows, outbox_rows, joined_by_tier, active_by_tier = [], [], {}, {}
+        for member in batch:
+            if member['key'] in existing:
+                counts["skipped_existing"] += 1
+                continue
+            ex_guardian = archived.get(member['key'])
+            token = ex_guardian['token'] if ex_guardian else generate_api_token()
+            guardian_rows.append((
+                ex_guardian['id'] if ex_guardian and ex_guardian['id'] not in taken_ids else None, member['name'], member['email'], member['tier'],
+                token, ex_guardian['joined_at'] if ex_guardian else now, now
+            ))
+            outbox_rows.append((
+                member['email'], "Welcome to the Shiosayi Community!", "guardian_welcome_email",
+                json.dumps({"user_name": member['name'], "tier_name": member['tier'], "api_key": token})
+            ))
+            # Restored guardians keep their joined_at, so only new ones count as joins.
+            if not ex_guardian:
+                joined_by_tier[member['tier']] = joined_by_tier.get(member['tier'], 0) + 1
+            active_by_tier[member['tier']] = active_by_tier.get(member['tier'], 0) + 1
+            counts["restored" if ex_guardian else "created"] += 1
+
+        try:
+            write_batch(existing, archived, guardian_rows, outbox_rows, joined_by_tier, active_by_tier, counts)
+        except sqlite3.IntegrityError:
+            # Another writer added one of these guardians since the check above.
+            db.rollback()
+            raise OnboardingConflictError(result)
+        for key, count in counts.items():
+            result[key] += count
+        batch.clear()
+
+    def write_batch(existing, archived, guardian_rows, outbox_rows, joined_by_tier, active_by_tier, counts):
+        db.executemany(
+            "INSERT INTO guardians (id, name, email, tier, token, joined_at, last_paid_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            guardian_rows
+        )
+        restoring = [member for member in batch if member['key'] in archived and member['key'] not in existing]
+        if restoring:
+            restoring_emails = [member['email'] for member in restoring]
+            restoring_placeholders = ", ".join("?" * len(restoring_emails))
+            guardian_ids = {row['email']: row['id'] for row in db.execute(
+                f"SELECT email, id FROM guardians WHERE email IN ({restoring_placeholders})", restoring_emails
+            )}
+            # The archive may spell the address differently from this upload.
+            archived_emails = [archived[member['key']]['email'] for member in restoring]
+            for member, archived_email in zip(restoring, archived_emails):
+                restored_film_ids, _ = _readopt_ex_guardian_films(
+                    db, archived_email, guardian_ids[member['email']], member['tier'], now
+                )
+                counts["films_readopted"] += len(restored_film_ids)
+            db.execute(f"DELETE FROM ex_guardians WHERE email IN ({restoring_placeholders})", archived_emails)
+        db.executemany(
+            "INSERT INTO email_outbox (to_email, subject, template_name, template_data) VALUES (?, ?, ?, ?)",
+            outbox_rows
+        )
+        for tier, count in joined_by_tier.items():
+            _bump_member_rollup(db, today, tier, joined=count)
+        for tier, count in active_by_tier.items():
+            _bump_active_tier(db, tier, count)
+        db.commit()
+
+    for line_number, member in enumerate(members, start=1):
+        email = (member.get('email') or '').strip()
+        name = (member.get('name') or '').strip() or None
+        tier = (member.get('tier') or 'lover').strip().lower()
+        if '@' not in email or tier not in TIER_LIMITS:
+            result["invalid"] += 1
+            result["errors"].append(f"Row {line_number}: invalid email '{email}' or tier '{tier}'.")
+            continue
+        key = email.translate(EMAIL_CASE)
+        if key in seen_emails:
+            result["skipped_existing"] += 1
+            continue
+        seen_emails.add(key)
+
+        batch.append({"name": name, "email": email, "key": key, "tier": tier})
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    logger.info(
+        "Onboarded guardians: %s created, %s restored, %s skipped, %s invalid.",
+        result['created'], result['restored'], result['skipped_existing'], result['invalid']
+    )
+    return result
+
+def send_queued_emails(limit=1000, to_emails=None):
+    """Sends pending emails from email_outbox in batches. Failed batches are retried on later runs.
+
+    to_emails restricts the run to those recipients, e.g. the guardian who just joined.
+    """
+    db = get_db()
+    if to_emails is None:
+        pending = db.execute(
+            "SELECT * FROM email_outbox WHERE status = 'pending' ORDER BY id LIMIT ?", (-1 if limit is None else limit,)
+        ).fetchall()
+    else:
+        placeholders = ", ".join("?" * len(to_emails))
+        pending = db.execute(
+            f"SELECT * FROM email_outbox WHERE status = 'pending' AND to_email IN ({placeholders}) ORDER BY id LIMIT ?",
+            (*to_emails, -1 if limit is None else limit)
+        ).fetchall()
+    if not pending:
+        return {"sent": 0, "failed": 0}
+
+    email_service = EmailService()
+    sent, failed = 0, 0
+    for start in range(0, len(pending), EmailService.BATCH_LIMIT):
+        chunk = pending[start:start + EmailService.BATCH_LIMIT]
+        ids = [row['id'] for row in chunk]
+        placeholders = ", ".join("?" * len(ids))
+        accepted = email_service.send_batch([{
+            "to_email": row['to_email'], "subject": row['subject'], "template_name": row['template_name'],
+            "template_data": json.loads(row['template_data']) if row['template_data'] else {}
+        } for row in chunk])
+
+        if accepted:
+            db.execute(
+                f"UPDATE email_outbox SET status = 'sent', attempts = attempts + 1, sent_at = ? WHERE id IN ({placeholders})",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), *ids)
+            )
+            sent += len(ids)
+        else:
+            db.execute(
+                f"""
+                UPDATE email_outbox SET attempts = attempts + 1,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE id IN ({placeholders})
+                """,
+                (EMAIL_MAX_ATTEMPTS, *ids)
+            )
+            failed += len(ids)
+        db.commit()
+
+    logger.info("Email outbox: %s sent, %s failed.", sent, failed)
+    return {"sent": sent, "failed": failed}
+
+def count_pending_emails():
+    db = get_db()
+    return db.execute("SELECT COUNT(*) FROM email_outbox WHERE status = 'pending'").fetchone()[0]
+
+HOUSEKEEPING_CHUNK_SIZE = 500
+
+def _archive_guardians(db, guardian_ids, placeholders, lapsed_at):
+    db.execute(
+        f"""
+        INSERT OR REPLACE INTO ex_guardians (email, id, name, tier, token, joined_at, last_paid_at, lapsed_at)
+        SELECT email, id, name, tier, token, joined_at, last_paid_at, ? FROM guardians WHERE id IN ({placeholders})
+        """,
+        (lapsed_at, *guardian_ids)
+    )
+    # Rows from an earlier lapse stay as history; a film they hold again is pending restore again.
+    db.execute(
+        f"""
+        INSERT INTO ex_guardian_films (email, film_id)
+        SELECT guardians.email, films.id FROM films JOIN guardians ON guardians.id = films.guardian_id
+        WHERE films.guardian_id IN ({placeholders})
+        ON CONFLICT (email, film_id) DO UPDATE SET restored_at = NULL
+        """,
+        guardian_ids
+    )
+
+def perform_housekeeping(days_lapsed=35, chunk_size=HOUSEKEEPING_CHUNK_SIZE, dry_run=False):
+    """Archives lapsed guardians and orphans their films, one bounded chunk at a time.
+
+    Each chunk runs in its own short write transaction so webhooks and adoptions can
+    interleave with a large run. With dry_run, nothing is written and the counts report
+    what would have been done.
+    """
     db = get_db()
-    cutoff_date = datetime.now() - timedelta(days=days_lapsed)
-    logging.info(f"Housekeeping: Checking for guardians with no payment since {cutoff_date.strftime('%Y-%m-%d')}.")
-
-    cursor = db.execute("SELECT * FROM guardians WHERE last_paid_at < ?", (cutoff_date,))
-    lapsed_guardians = cursor.fetchall()
-
-    if not lapsed_guardians:
-        logging.info("Housekeeping: No lapsed guardians found.")
-        return {"message": "No lapsed guardians to process."}
-
-    logging.info(f"Housekeeping: Found {len(lapsed_guardians)} lapsed guardians to process.")
-    archived_count, films_orphaned_count = 0, 0
-    file_exists = os.path.isfile(archive_file)
-
-    with open(archive_file, 'a', newline='') as csvfile:
-        fieldnames = lapsed_guardians[0].keys()
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-
-        for guardian in lapsed_guardians:
-            guardian_id = guardian['id']
-            writer.writerow(dict(guardian))
-            archived_count += 1
-            
+    cutoff = (datetime.now() - timedelta(days=days_lapsed)).strftime("%Y-%m-%d %H:%M:%S")
+    logger.info("Housekeeping: Checking for guardians with no payment since %s (dry run: %s).", cutoff[:10], dry_run)
+
+    timings = {"select": 0.0, "archive": 0.0, "orphan_films": 0.0, "delete": 0.0, "commit": 0.0}
+    archived_count, films_orphaned_count, chunks = 0, 0, 0
+    today = datetime.now().strftime("%Y-%m-%d")
+    last_id = 0
+
+    try:
+        while True:
+            started = time.perf_counter()
+            if not dry_run:
+                db.execute("BEGIN IMMEDIATE")
+            lapsed_guardians = db.execute(
+                "SELECT * FROM guardians WHERE last_paid_at < ? AND id > ? ORDER BY id LIMIT ?",
+                (cutoff, last_id, chunk_size)
+            ).fetchall()
+            timings["select"] += time.perf_counter() - started
+
+            if not lapsed_guardians:
+                if not dry_run:
+                    db.rollback()
+                break
+
+            chunks += 1
+            last_id = lapsed_guardians[-1]['id']
+            guardian_ids = [guardian['id'] for guardian in lapsed_guardians]
+            placeholders = ", ".join("?" * len(guardian_ids))
+
+            if dry_run:
+                started = time.perf_counter()
+                films_orphaned_count += db.execute(
+                    f"SELECT COUNT(*) FROM films WHERE guardian_id IN ({placeholders})", guardian_ids
+                ).fetchone()[0]
+                timings["orphan_films"] += time.perf_counter() - started
+                archived_count += len(lapsed_guardians)
+                continue
+
+            started = time.perf_counter()
+            _archive_guardians(db, guardian_ids, placeholders, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            timings["archive"] += time.perf_counter() - started
+
+            started = time.perf_counter()
             update_cursor = db.execute(
-                "UPDATE films SET status = 'orphan', guardian_id = NULL WHERE guardian_id = ?", (guardian_id,)
+                f"UPDATE films SET status = 'orphan', guardian_id = NULL WHERE guardian_id IN ({placeholders})",
+                guardian_ids
             )
             films_orphaned_count += update_cursor.rowcount
-            db.execute("DELETE FROM guardians WHERE id = ?", (guardian_id,))
-    
-    db.commit()
-    logging.info(f"Housekeeping complete. Archived: {archived_count}, Films returned to orphan: {films_orphaned_count}.")
-    
+            timings["orphan_films"] += time.perf_counter() - started
+
+            started = time.perf_counter()
+            db.execute(f"DELETE FROM guardians WHERE id IN ({placeholders})", guardian_ids)
+            lapsed_by_tier = {}
+            for guardian in lapsed_guardians:
+                lapsed_by_tier[guardian['tier']] = lapsed_by_tier.get(guardian['tier'], 0) + 1
+            for tier, count in lapsed_by_tier.items():
+                _bump_member_rollup(db, today, tier, lapsed=count)
+                _bump_active_tier(db, tier, -count)
+            timings["delete"] += time.perf_counter() - started
+
+            started = time.perf_counter()
+            db.commit()
+            timings["commit"] += time.perf_counter() - started
+            archived_count += len(lapsed_guardians)
+    except Exception:
+        if db.in_transaction:
+            db.rollback()
+        raise
+
+    if archived_count == 0:
+        message = "No lapsed guardians to process."
+        logger.info("Housekeeping: No lapsed guardians found.")
+    elif dry_run:
+        message = "Housekeeping dry run completed. No changes were made."
+        logger.info("Housekeeping dry run: would archive %s, would orphan %s films.", archived_count, films_orphaned_count)
+    else:
+        message = "Housekeeping process completed successfully."
+        logger.info("Housekeeping complete. Archived: %s, Films returned to orphan: %s, Chunks: %s.", archived_count, films_orphaned_count, chunks)
+
     return {
-        "message": "Housekeeping process completed successfully.",
+        "message": message,
+        "dry_run": dry_run,
         "archived_guardians": archived_count,
-        "films_orphaned": films_orphaned_count
+        "films_orphaned": films_orphaned_count,
+        "chunks": chunks,
+        "timings_ms": {phase: round(seconds * 1000, 2) for phase, seconds in timings.items()}
     }
 
 def get_guardian_by_token(token):
@@ -163,6 +598,154 @@ def get_film_magnet(film_id):
         return ":( No magnet link found for this film."
     
 
+PUBLIC_FILM_FIELDS = ('id', 'title', 'year', 'plot', 'poster_url', 'region', 'guardian_id', 'status', 'updated_at')
+FILMS_PAGE_SIZE = 50
+FILMS_MAX_PAGE_SIZE = 500
+
+def list_films(after_id=0, limit=FILMS_PAGE_SIZE, fields=None, status=None, region=None,
+               year_min=None, year_max=None, guardian_id=None, title=None):
+    """
+    Returns one page of films in id order, starting after `after_id`.
+
+    Pages are found with `id > after_id` rather than OFFSET, so every page costs an index
+    seek plus `limit` rows however deep it is. `title` is a case-insensitive prefix match,
+    which idx_films_title_year can serve. Returns {'films': [...], 'next_after_id': id or None}.
+    """
+    fields = [field for field in (fields or PUBLIC_FILM_FIELDS) if field in PUBLIC_FILM_FIELDS]
+    # The id is always read, as the cursor, even when the caller did not ask for it.
+    columns = fields if 'id' in fields else ['id'] + fields
+
+    conditions, params = ["id > ?"], [after_id]
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if region:
+        conditions.append("region = ?")
+        params.append(region)
+    if year_min is not None:
+        conditions.append("year >= ?")
+        params.append(year_min)
+    if year_max is not None:
+        conditions.append("year <= ?")
+        params.append(year_max)
+    if guardian_id:
+        conditions.append("guardian_id = ?")
+        params.append(guardian_id)
+    if title:
+        escaped = title.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("title LIKE ? ESCAPE '\\'")
+        params.append(f"{escaped}%")
+
+    # With a bound `id > ?` the planner tends to walk the rowid and test every title, which is
+    # a full scan for a rare prefix; the title index bounds the work by the number of matches.
+    source = "films INDEXED BY idx_films_title_year" if title else "films"
+    # One extra row tells us whether there is a next page without a COUNT.
+    params.append(limit + 1)
+    rows = get_read_db().execute(
+        f"SELECT {', '.join(columns)} FROM {source} WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+        params
+    ).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "films": [{field: row[field] for field in fields} for row in rows],
+        "next_after_id": rows[-1]['id'] if has_more else None
+    }
+
+PUBLIC_GUARDIAN_FIELDS = ('id', 'name', 'tier', 'joined_at')
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 5000
+CHANGE_LOG_TOMBSTONE_DAYS = 30
+
+class ChangesCompactedError(Exception):
+    """The requested position is older than the last compaction; the client must resync from public.db."""
+
+    def __init__(self, horizon):
+        super().__init__(f"Changes up to seq {horizon} have been compacted.")
+        self.horizon = horizon
+
+def get_changes(since=0, limit=CHANGES_PAGE_SIZE):
+    """
+    Returns the public changes after sequence number `since`, with each row's current state.
+
+    Each entry is {'seq', 'entity', 'id', 'op', 'data'}; 'data' is None for deletes, and for
+    rows deleted again later, whose delete follows further on in the feed.
+    """
+    db = get_read_db()
+    # One read transaction, so the log page and the rows it points to come from the same snapshot.
+    db.execute("BEGIN")
+    try:
+        horizon = db.execute("SELECT COALESCE(MAX(horizon_seq), 0) FROM change_log_compactions").fetchone()[0]
+        if since < horizon:
+            raise ChangesCompactedError(horizon)
+
+        entries = db.execute(
+            "SELECT seq, entity, entity_id, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (since, limit + 1)
+        ).fetchall()
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+
+        current = {}
+        for entity, table, fields in (('film', 'films', PUBLIC_FILM_FIELDS), ('guardian', 'guardians', PUBLIC_GUARDIAN_FIELDS)):
+            ids = list({entry['entity_id'] for entry in entries if entry['entity'] == entity and entry['op'] == 'upsert'})
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                for row in db.execute(f"SELECT {', '.join(fields)} FROM {table} WHERE id IN ({placeholders})", chunk):
+                    current[(entity, str(row['id']))] = dict(row)
+    finally:
+        db.rollback()
+
+    changes = [{
+        "seq": entry['seq'],
+        "entity": entry['entity'],
+        "id": int(entry['entity_id']),
+        "op": entry['op'],
+        "data": current.get((entry['entity'], entry['entity_id'])) if entry['op'] == 'upsert' else None
+    } for entry in entries]
+    return {
+        "changes": changes,
+        "next_since": changes[-1]['seq'] if changes else since,
+        "has_more": has_more
+    }
+
+def compact_changes(tombstone_days=CHANGE_LOG_TOMBSTONE_DAYS):
+    """
+    Drops log entries that a newer entry for the same row supersedes, which loses nothing for
+    clients since they only read each row's current state, then drops deletes older than
+    `tombstone_days`. The second step moves the horizon clients must be past.
+    """
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        superseded = db.execute("""
+            DELETE FROM change_log
+            WHERE seq NOT IN (SELECT MAX(seq) FROM change_log GROUP BY entity, entity_id)
+        """).rowcount
+        horizon = db.execute(
+            # changed_at is CURRENT_TIMESTAMP (UTC), so compare against SQLite's clock too.
+            "SELECT MAX(seq) FROM change_log WHERE op = 'delete' AND changed_at <= datetime('now', ?)",
+            (f"-{tombstone_days} days",)
+        ).fetchone()[0]
+        tombstones = 0
+        if horizon:
+            tombstones = db.execute(
+                "DELETE FROM change_log WHERE op = 'delete' AND seq <= ?", (horizon,)
+            ).rowcount
+            db.execute(
+                "INSERT INTO change_log_compactions (horizon_seq, removed) VALUES (?, ?)",
+                (horizon, superseded + tombstones)
+            )
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+    logger.info("Compacted change log: %s superseded entries and %s old deletes removed.", superseded, tombstones)
+    return {"superseded_removed": superseded, "tombstones_removed": tombstones, "horizon": horizon or 0}
+
 def adopt_film(guardian, film_id):
     db = get_db()
     guardian_id = guardian['id']
@@ -192,7 +775,7 @@ def adopt_film(guardian, film_id):
         (guardian_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), film_id)
     )
     db.commit()
-    logging.info(f"Guardian {guardian_id} adopted film {film_id}.")
+    logger.info("Guardian %s adopted film %s.", guardian_id, film_id)
     
     return {"message": "Adoption request sent!", "film_title": film['title']}, 200
 
@@ -214,9 +797,9 @@ def generate_public_database(main_db_path, public_db_path="public.db"):
         backup_path = f"{public_db_path}.{timestamp}.bak"
         try:
             os.rename(public_db_path, backup_path)
-            logging.info(f"Backed up existing public database to {backup_path}")
+            logger.info("Backed up existing public database to %s", backup_path)
         except OSError as e:
-            logging.error(f"Failed to back up database: {e}")
+            logger.error("Failed to back up database: %s", e)
             return {"status": "error", "message": f"Failed to back up database: {e}"}
 
     main_db = None
@@ -228,6 +811,13 @@ def generate_public_database(main_db_path, public_db_path="public.db"):
         main_cursor = main_db.cursor()
         public_cursor = public_db.cursor()
 
+        # Read everything in one snapshot so the recorded change_seq matches the copied rows:
+        # a client that loads this file then follows /changes?since=<change_seq>.
+        main_cursor.execute("BEGIN")
+        change_seq = main_cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+        public_cursor.execute("CREATE TABLE sync_state (change_seq INTEGER NOT NULL)")
+        public_cursor.execute("INSERT INTO sync_state (change_seq) VALUES (?)", (change_seq,))
+
         public_cursor.execute("""
         CREATE TABLE guardians (
             id TEXT PRIMARY KEY,
@@ -271,7 +861,8 @@ def generate_public_database(main_db_path, public_db_path="public.db"):
             )
 
         public_db.commit()
-        logging.info(f"Successfully created public database '{public_db_path}'.")
+        main_db.rollback()
+        logger.info("Successfully created public database '%s'.", public_db_path)
 
         sha256_path = f"{public_db_path}.sha256"
         try:
@@ -279,18 +870,28 @@ def generate_public_database(main_db_path, public_db_path="public.db"):
                 sha256 = hashlib.sha256(f.read()).hexdigest()
             with open(sha256_path, "w") as f:
                 f.write(f"{sha256}\n")
-            logging.info(f"Checksum written to '{sha256_path}'")
+            logger.info("Checksum written to '%s'", sha256_path)
+        except Exception as e:
+            logger.warning("Failed to generate SHA256 file: %s", e)
+
+        # The other formats are written from the same rows, so they match public.db exactly.
+        try:
+            formats = snapshots.write_all(os.path.dirname(os.path.abspath(public_db_path)), change_seq,
+                                          guardians_to_copy, films_to_copy)
         except Exception as e:
-            logging.warning(f"Failed to generate SHA256 file: {e}")
+            logger.warning("Failed to write snapshot formats: %s", e)
+            formats = {}
 
         return {
             "status": "success",
             "message": f"Public database '{public_db_path}' created successfully.",
             "guardians_published": len(guardians_to_copy),
-            "films_published": len(films_to_copy)
+            "films_published": len(films_to_copy),
+            "change_seq": change_seq,
+            "formats": formats
         }
     except sqlite3.Error as e:
-        logging.error(f"SQLite error during public DB generation: {e}")
+        logger.error("SQLite error during public DB generation: %s", e)
         return {"status": "error", "message": str(e)}
     finally:
         if main_db:
@@ -298,17 +899,643 @@ def generate_public_database(main_db_path, public_db_path="public.db"):
         if public_db:
             public_db.close()
 
+POSTER_INGEST_BATCH_SIZE = 256
+POSTER_PHASH_DISTANCE = 4
+
+def find_poster(sha256):
+    row = get_db().execute("SELECT * FROM posters WHERE sha256 = ?", (sha256,)).fetchone()
+    return dict(row) if row else None
+
+def record_poster(poster_id, sha256, phash, url):
+    db = get_db()
+    db.execute(
+        "INSERT INTO posters (id, sha256, phash, url) VALUES (?, ?, ?, ?) ON CONFLICT (sha256) DO NOTHING",
+        (poster_id, sha256, phash, url)
+    )
+    db.commit()
+
+POSTER_JOB_STALE_SECONDS = settings.POSTER_JOB_STALE_SECONDS
+
+def queue_poster_job(poster_id, sha256):
+    db = get_db()
+    db.execute("INSERT INTO poster_jobs (id, sha256) VALUES (?, ?)", (poster_id, sha256))
+    db.commit()
+
+def cancel_poster_job(poster_id):
+    db = get_db()
+    db.execute("DELETE FROM poster_jobs WHERE id = ? AND status = 'pending'", (poster_id,))
+    db.commit()
+
+def get_poster_job(poster_id):
+    row = get_db().execute("SELECT * FROM poster_jobs WHERE id = ?", (poster_id,)).fetchone()
+    return dict(row) if row else None
+
+def find_poster_job(sha256):
+    """An accepted upload of the same file that has not finished rendering, or None."""
+    row = get_db().execute(
+        "SELECT * FROM poster_jobs WHERE sha256 = ? AND status IN ('pending', 'rendering') ORDER BY created_at LIMIT 1",
+        (sha256,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def render_poster_job(poster_id):
+    """
+    Renders an accepted upload and records the outcome in poster_jobs. Needs an app context.
+
+    The job is claimed first, so the render pool and the scheduler's recovery run never render
+    the same upload at once. Returns the render result, or None if the job was not claimable.
+    """
+    db = get_db()
+    now = time.time()
+    claimed = db.execute(
+        """
+        UPDATE poster_jobs SET status = 'rendering', claimed_at = ?
+        WHERE id = ? AND (status = 'pending' OR (status = 'rendering' AND claimed_at < ?))
+        """,
+        (now, poster_id, now - POSTER_JOB_STALE_SECONDS)
+    ).rowcount
+    db.commit()
+    if not claimed:
+        return None
+
+    result = utils.render_staged_poster(poster_id)
+    finished_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if result['success']:
+        sha256 = db.execute("SELECT sha256 FROM poster_jobs WHERE id = ?", (poster_id,)).fetchone()['sha256']
+        record_poster(poster_id, sha256, result['manifest']['phash'], result['url'])
+        db.execute(
+            "UPDATE poster_jobs SET status = 'ready', url = ?, finished_at = ? WHERE id = ?",
+            (result['url'], finished_at, poster_id)
+        )
+    else:
+        db.execute(
+            "UPDATE poster_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (result['error'], finished_at, poster_id)
+        )
+    db.commit()
+    utils.discard_staged_poster(poster_id)
+    return result
+
+def render_pending_posters():
+    """Renders accepted uploads whose worker never got to them (or died rendering them)."""
+    db = get_db()
+    stale_before = time.time() - POSTER_JOB_STALE_SECONDS
+    poster_ids = [row['id'] for row in db.execute(
+        """
+        SELECT id FROM poster_jobs
+        WHERE (status = 'pending' AND created_at < datetime('now', ?))
+           OR (status = 'rendering' AND claimed_at < ?)
+        ORDER BY created_at
+        """,
+        (f"-{POSTER_JOB_STALE_SECONDS} seconds", stale_before)
+    )]
+    result = {"rendered": 0, "failed": 0}
+    for poster_id in poster_ids:
+        rendered = render_poster_job(poster_id)
+        if rendered is not None:
+            result["rendered" if rendered['success'] else "failed"] += 1
+    if poster_ids:
+        logger.info("Recovered poster jobs: %s rendered, %s failed.", result["rendered"], result["failed"])
+    return result
+
+class _PerceptualIndex:
+    """Finds stored hashes within max_distance bits of a new one.
+
+    The 64 bits are split into max_distance + 1 bands; two hashes that close must agree
+    exactly on at least one band, so only hashes sharing a band are compared.
+    """
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = 64 // bands
+        self.bands = [(index * width, 64 if index == bands - 1 else (index + 1) * width) for index in range(bands)]
+        self.buckets = {}
+
+    def _keys(self, value):
+        return [(index, (value >> start) & ((1 << (end - start)) - 1)) for index, (start, end) in enumerate(self.bands)]
+
+    def add(self, phash, poster_id):
+        value = int(phash, 16)
+        for key in self._keys(value):
+            self.buckets.setdefault(key, []).append((value, poster_id))
+
+    def remove(self, phash, poster_id):
+        """Forgets a hash; one that was never added is ignored."""
+        value = int(phash, 16)
+        for key in self._keys(value):
+            bucket = self.buckets.get(key, [])
+            if (value, poster_id) in bucket:
+                bucket.remove((value, poster_id))
+
+    def find(self, phash):
+        value = int(phash, 16)
+        for key in self._keys(value):
+            for candidate, poster_id in self.buckets.get(key, ()):
+                # bin().count rather than int.bit_count(), which needs Python 3.10.
+                if bin(candidate ^ value).count('1') <= self.max_distance:
+                    return poster_id
+        return None
+
+def _resolve_poster_films(db, names):
+    """Maps file names like '123.jpg' (film id) or '<40 hex>.jpg' (info hash) to film ids."""
+    ids, hashes = {}, {}
+    for name in names:
+        stem = os.path.splitext(name)[0].lower()
+        if stem.isdigit():
+            ids[int(stem)] = name
+        elif len(stem) == 40 and all(c in '0123456789abcdef' for c in stem):
+            hashes[stem] = name
+
+    films = {}
+    if ids:
+        placeholders = ', '.join('?' * len(ids))
+        for row in db.execute(f"SELECT id FROM films WHERE id IN ({placeholders})", list(ids)):
+            films[ids[row['id']]] = row['id']
+    if hashes:
+        placeholders = ', '.join('?' * len(hashes))
+        for row in db.execute(f"SELECT id, info_hash FROM films WHERE info_hash IN ({placeholders})", list(hashes)):
+            films[hashes[row['info_hash']]] = row['id']
+    return films
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ingest_posters(sources, workers=None, batch_size=POSTER_INGEST_BATCH_SIZE):
+    """
+    Validates, renders and attaches many posters at once.
+
+    `sources` yields (file name, bytes); the name says which film the poster is for (see
+    _resolve_poster_films). Images already stored, byte for byte or perceptually, are not
+    rendered again: the film gets the existing URL. Decoding and encoding run in a process
+    pool, or in this process with workers=0, and every films.poster_url change is applied in a
+    single transaction at the end. A poster that fails to render is reported as invalid.
+    """
+    started = time.perf_counter()
+    db = get_db()
+    posters_dir = os.path.join(settings.CDN_STORAGE_PATH, 'posters')
+    result = {"files": 0, "unmatched": 0, "invalid": 0, "duplicates_exact": 0, "duplicates_perceptual": 0,
+              "rendered": 0, "films_updated": 0, "errors": []}
+
+    # Dedupe on poster ids; URLs of posters rendered in this run are only known once rendered.
+    by_sha, poster_urls = {}, {}
+    perceptual = _PerceptualIndex(POSTER_PHASH_DISTANCE)
+    for row in db.execute("SELECT id, sha256, phash, url FROM posters"):
+        by_sha[row['sha256']] = row['id']
+        poster_urls[row['id']] = row['url']
+        perceptual.add(row['phash'], row['id'])
+
+    film_posters = {}
+    new_posters = []
+    # spawn rather than fork: the caller may be a threaded gunicorn worker.
+    pool = None if workers == 0 else ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                                         mp_context=multiprocessing.get_context('spawn'))
+    pool_map = pool.map if pool else map
+    failed = set()
+    try:
+        for batch in _batched(sources, batch_size):
+            result["files"] += len(batch)
+            films = _resolve_poster_films(db, [name for name, _ in batch])
+
+            pending = []
+            for name, data in batch:
+                if name not in films:
+                    result["unmatched"] += 1
+                    continue
+                sha256 = hashlib.sha256(data).hexdigest()
+                if sha256 in by_sha:
+                    result["duplicates_exact"] += 1
+                    film_posters[films[name]] = by_sha[sha256]
+                    continue
+                pending.append((name, data, sha256))
+
+            fingerprints = pool_map(utils.fingerprint_poster, [data for _, data, _ in pending])
+            to_render = []
+            for (name, data, sha256), (phash, error) in zip(pending, fingerprints):
+                if error:
+                    result["invalid"] += 1
+                    result["errors"].append(f"{name}: {error}")
+                    continue
+                if sha256 in by_sha:
+                    result["duplicates_exact"] += 1
+                    film_posters[films[name]] = by_sha[sha256]
+                    continue
+                similar = perceptual.find(phash)
+                if similar:
+                    result["duplicates_perceptual"] += 1
+                    film_posters[films[name]] = similar
+                    continue
+                poster_id = uuid.uuid4().hex
+                by_sha[sha256] = poster_id
+                perceptual.add(phash, poster_id)
+                film_posters[films[name]] = poster_id
+                to_render.append((name, data, sha256, phash, poster_id))
+
+            rendered = pool_map(utils.render_poster, [data for _, data, _, _, _ in to_render],
+                                [poster_id for _, _, _, _, poster_id in to_render], [posters_dir] * len(to_render))
+            for (name, _, sha256, phash, poster_id), (manifest, error) in zip(to_render, rendered):
+                if error:
+                    result["invalid"] += 1
+                    result["errors"].append(f"{name}: {error}")
+                    failed.add(poster_id)
+                    del by_sha[sha256]
+                    perceptual.remove(phash, poster_id)
+                    continue
+                url = f"{settings.CDN_BASE_URL}/posters/{manifest['variants']['detail']['files']['jpeg']['file']}"
+                poster_urls[poster_id] = url
+                new_posters.append((poster_id, sha256, phash, url))
+                result["rendered"] += 1
+    finally:
+        if pool:
+            pool.shutdown()
+    # Films in the same batch matched to a poster that then failed keep the poster they had.
+    film_posters = {film_id: poster_id for film_id, poster_id in film_posters.items() if poster_id not in failed}
+
+    now = datetime.now().isoformat()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.executemany(
+            "INSERT INTO posters (id, sha256, phash, url) VALUES (?, ?, ?, ?) ON CONFLICT (sha256) DO NOTHING",
+            new_posters
+        )
+        db.executemany(
+            "UPDATE films SET poster_url = ?, updated_at = ? WHERE id = ?",
+            [(poster_urls[poster_id], now, film_id) for film_id, poster_id in film_posters.items()]
+        )
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+    result["films_updated"] = len(film_posters)
+    elapsed = time.perf_counter() - started
+    result["elapsed_seconds"] = round(elapsed, 3)
+    result["files_per_second"] = round(result["files"] / elapsed, 1) if elapsed else None
+    logger.info(
+        "Poster ingest: %s files, %s rendered, %s exact and %s perceptual duplicates, %s unmatched, %s invalid.",
+        result["files"], result["rendered"], result["duplicates_exact"], result["duplicates_perceptual"],
+        result["unmatched"], result["invalid"]
+    )
+    return result
+
+SUGGESTION_STATUSES = ('pending', 'added', 'ignored')
+SUGGESTIONS_PAGE_SIZE = 50
+# What /suggest may show anyone who submits a title; the email and notes belong to earlier suggesters.
+SUGGESTION_PUBLIC_FIELDS = ('id', 'title', 'year', 'votes', 'status')
+SUGGESTIONS_MAX_PAGE_SIZE = 500
+
 def add_suggestion(email, title, notes=None):
+    """
+    Records a vote for a film and returns the public fields of its suggestion.
+
+    Titles that normalize to the same key (utils.normalize_title) share one row, whose `votes`
+    counts distinct emails: the same email suggesting the same film again is not another vote.
+    Notes are kept from the first suggestion that had any. The row may hold another person's
+    email and notes, so only SUGGESTION_PUBLIC_FIELDS are returned to the caller.
+    """
+    title_key, year = utils.normalize_title(title)
     db = get_db()
-    cursor = db.execute(
-        "INSERT INTO suggestions (email, title, notes) VALUES (?, ?, ?)",
-        (email, title, notes)
+    try:
+        counted = db.execute(
+            "INSERT INTO suggestion_votes (title_key, email) VALUES (?, ?) ON CONFLICT DO NOTHING",
+            (title_key, email.strip().lower())
+        ).rowcount
+        suggestion = dict(db.execute(
+            f"""
+            INSERT INTO suggestions (email, title, notes, title_key, year, votes, last_suggested_at)
+            VALUES (?1, ?2, ?3, ?4, ?5, 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (title_key) DO UPDATE SET
+                votes = votes + ?6,
+                last_suggested_at = CASE WHEN ?6 THEN CURRENT_TIMESTAMP ELSE last_suggested_at END,
+                notes = COALESCE(notes, excluded.notes)
+            RETURNING {', '.join(SUGGESTION_PUBLIC_FIELDS)}
+            """,
+            (email, title, notes, title_key, year, counted)
+        ).fetchone())
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+    logger.info("Suggestion ID %s ('%s') %s by %s; %s votes.", suggestion['id'], title,
+                "voted for" if counted else "repeated", email, suggestion['votes'])
+    return suggestion
+
+def list_suggestions(status='pending', after=None, limit=SUGGESTIONS_PAGE_SIZE):
+    """
+    Returns one page of suggestions with the given status, most votes first and newest first
+    among equal votes.
+
+    `after` is the (votes, id) of the last row of the previous page. `(votes, id) < after` is a
+    seek on idx_suggestions_rank read backwards, so no page sorts or skips rows, however deep.
+    Returns {'suggestions': [...], 'next_after': (votes, id) or None}.
+    """
+    conditions, params = ["status = ?"], [status]
+    if after:
+        conditions.append("(votes, id) < (?, ?)")
+        params.extend(after)
+    params.append(limit + 1)
+    rows = get_read_db().execute(
+        f"""
+        SELECT id, title, year, votes, status, notes, email, suggested_at, last_suggested_at
+        FROM suggestions WHERE {' AND '.join(conditions)}
+        ORDER BY votes DESC, id DESC LIMIT ?
+        """,
+        params
+    ).fetchall()
+
+    has_more = len(rows) > limit
+    suggestions = [dict(row) for row in rows[:limit]]
+    next_after = (suggestions[-1]['votes'], suggestions[-1]['id']) if has_more else None
+    return {'suggestions': suggestions, 'next_after': next_after}
+
+def merge_suggestions():
+    """
+    Gives suggestions stored before titles were merged their title key, folding rows for the
+    same film into the oldest one. Votes are counted per distinct email, the first notes are
+    kept, and a film any of the rows marked 'added' stays added. Rows that already have a key
+    are left alone, so it is safe to run again.
+    """
+    db = get_db()
+    rows = db.execute("SELECT id, title FROM suggestions WHERE title_key IS NULL ORDER BY id").fetchall()
+    result = {"keyed": 0, "merged": 0}
+    try:
+        for row in rows:
+            title_key, year = utils.normalize_title(row['title'])
+            counted = db.execute(
+                """
+                INSERT INTO suggestion_votes (title_key, email, voted_at)
+                SELECT ?, lower(trim(email)), suggested_at FROM suggestions WHERE id = ?
+                ON CONFLICT DO NOTHING
+                """,
+                (title_key, row['id'])
+            ).rowcount
+            survivor = db.execute(
+                """
+                UPDATE suggestions SET
+                    votes = votes + ?3,
+                    notes = COALESCE(suggestions.notes, merged.notes),
+                    status = CASE WHEN merged.status = 'added' THEN 'added' ELSE suggestions.status END,
+                    last_suggested_at = MAX(COALESCE(suggestions.last_suggested_at, suggestions.suggested_at), merged.suggested_at)
+                FROM (SELECT notes, status, suggested_at FROM suggestions WHERE id = ?2) AS merged
+                WHERE suggestions.title_key = ?1
+                """,
+                (title_key, row['id'], counted)
+            ).rowcount
+            if survivor:
+                db.execute("DELETE FROM suggestions WHERE id = ?", (row['id'],))
+                result["merged"] += 1
+            else:
+                db.execute(
+                    "UPDATE suggestions SET title_key = ?, year = ?, votes = 1, last_suggested_at = suggested_at WHERE id = ?",
+                    (title_key, year, row['id'])
+                )
+                result["keyed"] += 1
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+
+    logger.info("Merged suggestions: %s keyed, %s folded into an existing suggestion.", result["keyed"], result["merged"])
+    return result
+
+def rebuild_stats():
+    """Recomputes the revenue and membership rollups from the source tables.
+
+    A join is a guardian's joined_at, whether they are still active or archived. A renewal is
+    a membership payment from an email with an earlier one in kofi_events, as in the
+    incremental path (_bump_payment_rollup). Joins are attributed to the guardian's current (or last) tier. Lapse counts are kept as-is
+    since archived guardians' lapse history is not kept.
+    """
+    db = get_db()
+    db.execute("DELETE FROM stats_daily_revenue")
+    db.execute(
+        """
+        INSERT INTO stats_daily_revenue (day, currency, tier, kind, amount, events)
+        SELECT substr(timestamp, 1, 10), COALESCE(currency, ''), lower(COALESCE(tier_name, '')),
+               CASE WHEN is_first_subscription_payment THEN 'new'
+                    WHEN is_subscription_payment THEN 'renewal'
+                    ELSE 'donation' END,
+               SUM(amount), COUNT(*)
+        FROM kofi_events
+        GROUP BY 1, 2, 3, 4
+        """
+    )
+
+    db.execute("UPDATE stats_daily_members SET joined = 0, renewed = 0")
+    db.execute(
+        """
+        WITH members AS (
+            SELECT joined_at, tier FROM guardians
+            UNION ALL
+            SELECT joined_at, tier FROM ex_guardians WHERE email NOT IN (SELECT email FROM guardians)
+        )
+        INSERT INTO stats_daily_members (day, tier, joined)
+        SELECT substr(joined_at, 1, 10), tier, COUNT(*) FROM members WHERE joined_at IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (day, tier) DO UPDATE SET joined = excluded.joined
+        """
     )
+    db.execute(
+        """
+        WITH payments AS (
+            SELECT substr(timestamp, 1, 10) AS day,
+                   CASE WHEN lower(tier_name) IN ('lover', 'keeper', 'savior') THEN lower(tier_name)
+                        ELSE 'lover' END AS tier,
+                   ROW_NUMBER() OVER (PARTITION BY email ORDER BY timestamp, id) AS n
+            FROM kofi_events
+            WHERE type = 'Subscription' AND is_subscription_payment AND tier_name IS NOT NULL
+        )
+        INSERT INTO stats_daily_members (day, tier, renewed)
+        SELECT day, tier, SUM(n > 1) FROM payments WHERE true GROUP BY day, tier
+        ON CONFLICT (day, tier) DO UPDATE SET renewed = excluded.renewed
+        """
+    )
+
+    db.execute("DELETE FROM stats_active_tiers")
+    db.execute("INSERT INTO stats_active_tiers (tier, active) SELECT tier, COUNT(*) FROM guardians GROUP BY tier")
     db.commit()
-    
-    new_suggestion_id = cursor.lastrowid
-    new_suggestion_cursor = db.execute("SELECT * FROM suggestions WHERE id = ?", (new_suggestion_id,))
-    created_suggestion = dict(new_suggestion_cursor.fetchone())
-    
-    logging.info(f"New suggestion added: ID {new_suggestion_id} for title '{title}' by {email}.")
-    return created_suggestion
+
+    revenue_rows = db.execute("SELECT COUNT(*) FROM stats_daily_revenue").fetchone()[0]
+    member_rows = db.execute("SELECT COUNT(*) FROM stats_daily_members").fetchone()[0]
+    logger.info("Rebuilt stats rollups: %s revenue rows, %s membership rows.", revenue_rows, member_rows)
+    return {"revenue_rows": revenue_rows, "member_rows": member_rows}
+
+def get_stats(since=None, until=None):
+    """The rollups for days from `since` to `until` (YYYY-MM-DD, inclusive). Raises ValueError for other formats."""
+    for name, value in (('since', since), ('until', until)):
+        if value:
+            try:
+                # Days are compared as strings, so '2024-1-5' must not pass for '2024-01-05'.
+                valid = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d") == value
+            except ValueError:
+                valid = False
+            if not valid:
+                raise ValueError(f"'{name}' must be a date in YYYY-MM-DD format.")
+
+    db = get_db()
+    day_filter, params = "", []
+    if since:
+        day_filter += " AND day >= ?"
+        params.append(since)
+    if until:
+        day_filter += " AND day <= ?"
+        params.append(until)
+
+    active = {row['tier']: row['active'] for row in db.execute("SELECT tier, active FROM stats_active_tiers")}
+    revenue = db.execute(
+        f"SELECT day, currency, tier, kind, amount, events FROM stats_daily_revenue WHERE 1 = 1{day_filter} ORDER BY day",
+        params
+    ).fetchall()
+    members = db.execute(
+        f"SELECT day, tier, joined, renewed, lapsed FROM stats_daily_members WHERE 1 = 1{day_filter} ORDER BY day",
+        params
+    ).fetchall()
+
+    return {
+        "active_guardians": active,
+        "total_active_guardians": sum(active.values()),
+        "revenue": [dict(row) for row in revenue],
+        "members": [dict(row) for row in members]
+    }
+
+EXPORT_BATCH_SIZE = 5000
+# Each export reads one table in (date column, rowid) order. Secrets (guardian tokens and the raw
+# Ko-fi payloads, which carry the verification token) are never exported.
+EXPORTS = {
+    'guardians': {
+        'date_column': 'joined_at',
+        'date_separator': ' ',
+        'columns': ('id', 'name', 'email', 'tier', 'joined_at', 'last_paid_at'),
+    },
+    'suggestions': {
+        'date_column': 'suggested_at',
+        'date_separator': ' ',
+        'columns': ('id', 'email', 'title', 'year', 'notes', 'status', 'votes', 'suggested_at', 'last_suggested_at'),
+    },
+    'kofi_events': {
+        'date_column': 'timestamp',
+        'date_separator': 'T',
+        'columns': ('id', 'timestamp', 'type', 'is_public', 'from_name', 'email', 'message', 'amount', 'currency',
+                    'url', 'is_subscription_payment', 'is_first_subscription_payment', 'tier_name', 'kofi_transaction_id'),
+    },
+}
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+def _export_bound(value, separator):
+    """Normalizes a date or datetime filter to the way the column stores it, so string comparison works."""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if len(value) == 10:
+        return parsed.strftime("%Y-%m-%d")
+    return parsed.strftime(f"%Y-%m-%d{separator}%H:%M:%S")
+
+def export_rows(name, since=None, until=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the rows of an export table with `since <= date < until`, oldest first.
+
+    Rows are read in keyset batches of `batch_size`, each a separate statement, so no read
+    transaction stays open while a slow client downloads; with the rollback journal that would
+    hold off every writer until the export finished.
+    """
+    export = EXPORTS[name]
+    date_column = export['date_column']
+    columns = ', '.join(export['columns'])
+
+    conditions, params = [], []
+    if until:
+        conditions.append(f"{date_column} < ?")
+        params.append(until)
+
+    last = None
+    while True:
+        page_conditions, page_params = list(conditions), list(params)
+        # After the first page the keyset alone is the lower bound: given `date >= since` as
+        # well, the planner seeks to `since` and walks every earlier page again.
+        if last is not None:
+            page_conditions.append(f"({date_column}, rowid) > (?, ?)")
+            page_params.extend(last)
+        elif since:
+            page_conditions.append(f"{date_column} >= ?")
+            page_params.append(since)
+        where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+        cursor = get_read_db().execute(
+            f"SELECT rowid, {columns} FROM {name} {where} ORDER BY {date_column}, rowid LIMIT ?",
+            page_params + [batch_size]
+        )
+        rows = cursor.fetchmany(batch_size)
+        cursor.close()
+        if not rows:
+            return
+        for row in rows:
+            yield tuple(row)[1:]
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][date_column], rows[-1]['rowid'])
+
+def export_table(name, fmt='csv', since=None, until=None, compress=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Returns a generator of encoded chunks (CSV with a header row, or NDJSON), gzipped if `compress`.
+
+    Arguments are checked here, before anything is streamed, and raise ValueError. Memory use
+    is bounded by one batch however large the table is.
+    """
+    if name not in EXPORTS:
+        raise ValueError(f"Unknown export '{name}'. Choose one of: {', '.join(EXPORTS)}.")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_FORMATS)}.")
+    export = EXPORTS[name]
+    try:
+        since = _export_bound(since, export['date_separator'])
+        until = _export_bound(until, export['date_separator'])
+    except ValueError:
+        raise ValueError("since and until must be ISO dates (YYYY-MM-DD) or datetimes.")
+
+    columns = export['columns']
+
+    def encode():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        batch = []
+        for row in export_rows(name, since, until, batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield _encode_export_batch(fmt, columns, batch, buffer, writer)
+                batch = []
+        if batch:
+            yield _encode_export_batch(fmt, columns, batch, buffer, writer)
+
+    def chunks():
+        if not compress:
+            for text in encode():
+                yield text.encode('utf-8')
+            return
+        # wbits=31 writes a gzip header and trailer. The first chunk (the CSV header) is flushed
+        # straight away so the client sees bytes before the first batch is read.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for index, text in enumerate(encode()):
+            data = compressor.compress(text.encode('utf-8'))
+            if index == 0:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    return chunks()
+
+def _encode_export_batch(fmt, columns, rows, buffer, writer):
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict(zip(columns, row)), separators=(',', ':'), default=str) + '\n' for row in rows)
+    buffer.seek(0)
+    buffer.truncate()
+    writer.writerows(rows)
+    return buffer.getvalue()
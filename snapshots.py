@@ -0,0 +1,169 @@
+# snapshots.py
+"""
+Alternative encodings of the public catalog, written next to public.db from the same rows.
+
+- public.ndjson.gz: one JSON object per line, so clients can parse it as it downloads.
+  The first line is {"type": "meta", ...}; then "guardian" and "film" records.
+- public.columns.json.gz: one JSON document holding each table column by column, with
+  low-cardinality columns dictionary-encoded as {"dictionary": [...], "indices": [...]}.
+  Any JSON parser can read it, and it skips the repeated keys of the row formats.
+- public.films.arrow / public.guardians.arrow: Arrow IPC files with dictionary-encoded
+  columns, written only when pyarrow is installed (pip install -r requirements-arrow.txt).
+  Without it, Arrow files left by an earlier publish are removed so they cannot go stale.
+
+Each file gets a '<name>.sha256' next to it, like public.db.
+"""
+import os
+import gzip
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+GUARDIAN_FIELDS = ('id', 'name', 'tier', 'joined_at')
+FILM_FIELDS = ('id', 'title', 'year', 'plot', 'poster_url', 'region', 'guardian_id', 'status', 'updated_at')
+DICTIONARY_FIELDS = {'tier', 'region', 'status'}
+FORMAT_VERSION = 1
+
+NDJSON_FILENAME = "public.ndjson.gz"
+COLUMNS_FILENAME = "public.columns.json.gz"
+ARROW_FILENAMES = {'films': "public.films.arrow", 'guardians': "public.guardians.arrow"}
+
+
+def _write_atomically(path, write):
+    """Calls write(tmp_path), moves the result into place, then publishes its checksum.
+
+    The file goes first, as public.db does, so a client that sees a new checksum always finds
+    the file it describes; one that polls in between sees the old checksum and fetches again later.
+    """
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+
+    sha256 = hashlib.sha256()
+    with open(tmp_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)
+
+    with open(f"{path}.sha256.tmp", "w") as f:
+        f.write(f"{sha256.hexdigest()}\n")
+    os.replace(f"{path}.sha256.tmp", f"{path}.sha256")
+    return {"path": path, "bytes": size, "sha256": sha256.hexdigest()}
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def write_ndjson(path, change_seq, guardians, films):
+    def write(tmp_path):
+        # mtime=0 keeps the gzip header, and so the checksum, stable for identical content.
+        with gzip.GzipFile(tmp_path, "wb", compresslevel=6, mtime=0) as raw:
+            raw.write((_dumps({"type": "meta", "version": FORMAT_VERSION, "change_seq": change_seq,
+                               "guardians": len(guardians), "films": len(films)}) + "\n").encode())
+            for kind, fields, rows in (('guardian', GUARDIAN_FIELDS, guardians), ('film', FILM_FIELDS, films)):
+                lines = []
+                for row in rows:
+                    record = {"type": kind}
+                    record.update(zip(fields, row))
+                    lines.append(_dumps(record))
+                    if len(lines) >= 5000:
+                        raw.write(("\n".join(lines) + "\n").encode())
+                        lines = []
+                if lines:
+                    raw.write(("\n".join(lines) + "\n").encode())
+    return _write_atomically(path, write)
+
+
+def _columns(fields, rows):
+    columns = {}
+    for index, field in enumerate(fields):
+        values = [row[index] for row in rows]
+        if field in DICTIONARY_FIELDS:
+            dictionary, indices, positions = [], [], {}
+            for value in values:
+                if value not in positions:
+                    positions[value] = len(dictionary)
+                    dictionary.append(value)
+                indices.append(positions[value])
+            columns[field] = {"dictionary": dictionary, "indices": indices}
+        else:
+            columns[field] = values
+    return {"count": len(rows), "columns": columns}
+
+
+def write_columns(path, change_seq, guardians, films):
+    def write(tmp_path):
+        document = {
+            "version": FORMAT_VERSION,
+            "change_seq": change_seq,
+            "guardians": _columns(GUARDIAN_FIELDS, guardians),
+            "films": _columns(FILM_FIELDS, films),
+        }
+        with gzip.GzipFile(tmp_path, "wb", compresslevel=6, mtime=0) as raw:
+            raw.write(_dumps(document).encode())
+    return _write_atomically(path, write)
+
+
+def write_arrow(path, change_seq, fields, rows, types):
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    def write(tmp_path):
+        arrays = {}
+        for index, field in enumerate(fields):
+            array = pa.array([row[index] for row in rows], type=types[field])
+            arrays[field] = array.dictionary_encode() if field in DICTIONARY_FIELDS else array
+        table = pa.table(arrays).replace_schema_metadata({"change_seq": str(change_seq), "version": str(FORMAT_VERSION)})
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    return _write_atomically(path, write)
+
+
+def _arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def write_all(directory, change_seq, guardians, films):
+    """Writes every format into `directory`. Rows are tuples in GUARDIAN_FIELDS / FILM_FIELDS order."""
+    guardians = [tuple(row) for row in guardians]
+    films = [tuple(row) for row in films]
+    written = {
+        "ndjson": write_ndjson(os.path.join(directory, NDJSON_FILENAME), change_seq, guardians, films),
+        "columns": write_columns(os.path.join(directory, COLUMNS_FILENAME), change_seq, guardians, films),
+    }
+
+    if _arrow_available():
+        import pyarrow as pa
+        written["arrow_guardians"] = write_arrow(
+            os.path.join(directory, ARROW_FILENAMES['guardians']), change_seq, GUARDIAN_FIELDS, guardians,
+            {'id': pa.int64(), 'name': pa.string(), 'tier': pa.string(), 'joined_at': pa.string()}
+        )
+        written["arrow_films"] = write_arrow(
+            os.path.join(directory, ARROW_FILENAMES['films']), change_seq, FILM_FIELDS, films,
+            {'id': pa.int64(), 'title': pa.string(), 'year': pa.int64(), 'plot': pa.string(),
+             'poster_url': pa.string(), 'region': pa.string(), 'guardian_id': pa.string(),
+             'status': pa.string(), 'updated_at': pa.string()}
+        )
+    else:
+        logger.info("pyarrow is not installed; skipping the Arrow snapshot files.")
+        for filename in ARROW_FILENAMES.values():
+            for name in (filename, f"{filename}.sha256"):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+    return {name: {"bytes": info["bytes"], "sha256": info["sha256"]} for name, info in written.items()}
+
+
+def published_filenames():
+    names = [NDJSON_FILENAME, COLUMNS_FILENAME, *ARROW_FILENAMES.values()]
+    return set(names) | {f"{name}.sha256" for name in names}
@@ -0,0 +1,371 @@
+# benchmark.py
+"""
+Repeatable in-process benchmarks for the service layer and routes.
+
+Generates (and caches) synthetic databases of several sizes with tools/generate_test_db.py,
+then times the hot paths through the Flask test client and the service functions.
+Results are written as JSON so two commits can be compared:
+
+    python tests/benchmark.py --sizes small,medium --output baseline.json
+    # ... make a change ...
+    python tests/benchmark.py --sizes small,medium --output current.json --compare baseline.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+SIZES = {
+    'small': {'guardians': 1_000, 'films': 10_000, 'donations': 2_000},
+    'medium': {'guardians': 10_000, 'films': 100_000, 'donations': 20_000},
+    'large': {'guardians': 100_000, 'films': 1_000_000, 'donations': 200_000},
+}
+SEED = 42
+
+
+def configure_environment(workdir):
+    """Sets the variables app.py needs before it is imported, and keeps emails off the network."""
+    os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+    os.environ.setdefault("KOFI_VERIFICATION_TOKEN", "benchmark-kofi-token")
+    os.environ.setdefault("ADMIN_API_TOKEN", "benchmark-admin-token")
+    os.environ.setdefault("RESEND_API_KEY", "re_benchmark")
+    os.environ["CDN_STORAGE_PATH"] = os.path.join(workdir, "cdn")
+    os.environ["CDN_BASE_URL"] = "http://cdn.benchmark.local"
+    os.environ["DATABASE_FILENAME"] = os.path.join(workdir, "unused.db")
+    # Every request comes from one test client; with limits on, most timings would be of 429s.
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+
+    import mail
+    mail.EmailService.send_email = lambda self, *args, **kwargs: None
+    mail.EmailService.send_batch = lambda self, messages: True
+
+
+def summarize(samples):
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    total = sum(samples_ms)
+    return {
+        "iterations": len(samples_ms),
+        "mean_ms": round(statistics.fmean(samples_ms), 4),
+        "p50_ms": round(samples_ms[len(samples_ms) // 2], 4),
+        "p95_ms": round(samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.95))], 4),
+        "min_ms": round(samples_ms[0], 4),
+        "max_ms": round(samples_ms[-1], 4),
+        "ops_per_sec": round(len(samples_ms) / (total / 1000), 2) if total else None,
+    }
+
+
+def timed(func, args_list, expected_statuses=None):
+    """Times func over args_list; responses must be 2xx (or in expected_statuses) to count."""
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        result = func(*args)
+        samples.append(time.perf_counter() - started)
+        status = getattr(result, 'status_code', None)
+        if status is not None and not (status in expected_statuses if expected_statuses else 200 <= status < 300):
+            raise RuntimeError(f"Benchmark request returned {status}, not a timing of the intended path.")
+    return summarize(samples)
+
+
+def prepare_database(size, cache_dir):
+    """Returns the path of a cached generated database for the given size."""
+    import generate_test_db
+
+    # Timestamps are relative to today so the lapsed fraction matches what housekeeping sees.
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    # A schema change invalidates the cache too, so the copy always has every table the code expects.
+    with open(generate_test_db.SCHEMA_PATH, "rb") as f:
+        schema_hash = hashlib.sha256(f.read()).hexdigest()[:8]
+    path = os.path.join(cache_dir, f"bench_{size}_seed{SEED}_{today:%Y%m%d}_{schema_hash}.db")
+    if not os.path.exists(path):
+        print(f"Generating '{size}' dataset into {path}...")
+        with open(os.devnull, "w") as devnull:
+            generate_test_db.generate(path, seed=SEED, now=today, out=devnull, **SIZES[size])
+    return path
+
+
+def fresh_copy(source, workdir, name):
+    target = os.path.join(workdir, name)
+    shutil.copyfile(source, target)
+    return target
+
+
+def timed_on_fresh_copies(app, func, source, workdir, name, iterations):
+    """Like timed, but each run gets its own untimed copy of `source`, so work that changes the
+    database (housekeeping) always starts from the same data."""
+    previous = app.config['DATABASE']
+    samples = []
+    try:
+        for n in range(iterations):
+            app.config['DATABASE'] = fresh_copy(source, workdir, f"{name}_{n}.db")
+            with app.app_context():
+                started = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - started)
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                try:
+                    os.remove(f"{app.config['DATABASE']}{suffix}")
+                except FileNotFoundError:
+                    pass
+    finally:
+        app.config['DATABASE'] = previous
+    return summarize(samples)
+
+
+def make_poster(width=1000, height=1500):
+    from PIL import Image
+    image = Image.new('RGB', (width, height))
+    pixels = image.load()
+    rng = random.Random(SEED)
+    for y in range(0, height, 10):
+        for x in range(0, width, 10):
+            pixels[x, y] = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def run_size(size, db_path, workdir, iterations, housekeeping_iterations):
+    import app as app_module
+    import services
+    import utils
+    import fake_kofi_event
+    from werkzeug.datastructures import FileStorage
+
+    app = app_module.app
+    client = app.test_client()
+    rng = random.Random(SEED)
+    fake_kofi_event.KOFI_TOKEN = os.environ["KOFI_VERIFICATION_TOKEN"]
+    results = {}
+
+    source = sqlite3.connect(db_path)
+    tokens = [row[0] for row in source.execute("SELECT token FROM guardians ORDER BY random() LIMIT ?", (iterations,))]
+    emails = [row[0] for row in source.execute("SELECT email FROM guardians ORDER BY random() LIMIT ?", (iterations,))]
+    film_ids = [row[0] for row in source.execute("SELECT id FROM films WHERE status = 'adopted' ORDER BY random() LIMIT ?", (iterations,))]
+    source.close()
+
+    work_db = fresh_copy(db_path, workdir, f"work_{size}.db")
+    app.config['DATABASE'] = work_db
+
+    with app.app_context():
+        results["services.get_guardian_by_token"] = timed(services.get_guardian_by_token, [(token,) for token in tokens])
+    results["GET /auth"] = timed(lambda token: client.get(f"/auth?token={token}"), [(token,) for token in tokens])
+    results["GET /magnet"] = timed(
+        lambda token, film_id: client.get(f"/magnet/{film_id}?TOKEN={token}"),
+        [(tokens[n % len(tokens)], film_id) for n, film_id in enumerate(film_ids)]
+    )
+
+    with app.app_context():
+        db = services.get_db()
+        adopters = db.execute(
+            """
+            SELECT g.* FROM guardians g
+            WHERE g.tier = 'savior'
+              AND (SELECT COUNT(*) FROM films f WHERE f.guardian_id = g.id AND f.status = 'adopted') < 10
+            LIMIT ?
+            """, (iterations,)
+        ).fetchall()
+        orphans = [row['id'] for row in db.execute("SELECT id FROM films WHERE status = 'orphan' LIMIT ?", (iterations,))]
+        pairs = [(guardian, film_id) for guardian, film_id in zip(adopters, orphans)]
+        if pairs:
+            results["services.adopt_film"] = timed(services.adopt_film, pairs)
+
+    renewals = [fake_kofi_event.generate_payload(email, rng.choice(('lover', 'keeper', 'savior')), is_first_payment=False)
+                for email in emails]
+    joins = [fake_kofi_event.generate_payload(f"bench-new-{n}@example.com", 'lover') for n in range(iterations)]
+    webhook = lambda payload: client.post('/webhook', data={'data': json.dumps(payload)})
+    results["POST /webhook (renewal)"] = timed(webhook, [(payload,) for payload in renewals])
+    results["POST /webhook (new guardian)"] = timed(webhook, [(payload,) for payload in joins])
+
+    results["services.perform_housekeeping (dry run)"] = timed_on_fresh_copies(
+        app, lambda: services.perform_housekeeping(dry_run=True), db_path, workdir, f"housekeeping_{size}",
+        housekeeping_iterations
+    )
+    results["services.perform_housekeeping"] = timed_on_fresh_copies(
+        app, services.perform_housekeeping, db_path, workdir, f"housekeeping_{size}", housekeeping_iterations
+    )
+
+    publish_dir = os.path.join(workdir, "publish")
+    os.makedirs(publish_dir, exist_ok=True)
+    results["services.generate_public_database"] = timed(
+        lambda n: services.generate_public_database(work_db, os.path.join(publish_dir, f"public_{size}_{n}.db")),
+        [(n,) for n in range(3)]
+    )
+
+    results.update(snapshot_load_benchmarks(publish_dir, os.path.join(publish_dir, f"public_{size}_0.db")))
+
+    poster_bytes = make_poster()
+
+    def stage_and_render():
+        staged = utils.stage_poster(FileStorage(io.BytesIO(poster_bytes), filename="poster.jpg"))
+        utils.render_staged_poster(staged['id'])
+        utils.discard_staged_poster(staged['id'])
+
+    # The upload route only stages; the render pool does the rest. Both are timed together here.
+    results["utils.stage_and_render_poster"] = timed(stage_and_render, [() for _ in range(max(3, iterations // 20))])
+
+    return results
+
+
+def snapshot_files(publish_dir, public_db):
+    import snapshots
+    files = {"public.db": public_db}
+    for name in (snapshots.NDJSON_FILENAME, snapshots.COLUMNS_FILENAME, *snapshots.ARROW_FILENAMES.values()):
+        if os.path.exists(os.path.join(publish_dir, name)):
+            files[name] = os.path.join(publish_dir, name)
+    return files
+
+
+def load_public_db(path):
+    conn = sqlite3.connect(path)
+    guardians = conn.execute("SELECT * FROM guardians").fetchall()
+    films = conn.execute("SELECT * FROM films").fetchall()
+    conn.close()
+    return guardians, films
+
+
+def load_ndjson(path):
+    import gzip
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def load_columns(path):
+    import gzip
+    with gzip.open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+def load_arrow(path):
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def snapshot_load_benchmarks(publish_dir, public_db):
+    """Times a full load of each published format into Python objects."""
+    loaders = {"public.db": load_public_db, "public.ndjson.gz": load_ndjson,
+               "public.columns.json.gz": load_columns, "public.films.arrow": load_arrow,
+               "public.guardians.arrow": load_arrow}
+    return {f"load {name}": timed(loaders[name], [(path,) for _ in range(3)])
+            for name, path in snapshot_files(publish_dir, public_db).items()}
+
+
+def snapshot_sizes(publish_dir, public_db):
+    """Bytes on disk, and for public.db also gzipped, as a CDN would usually serve it."""
+    import gzip
+    sizes = {name: os.path.getsize(path) for name, path in snapshot_files(publish_dir, public_db).items()}
+    with open(public_db, "rb") as f:
+        sizes["public.db (gzip)"] = len(gzip.compress(f.read(), compresslevel=6))
+    return sizes
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(current, baseline, threshold):
+    """Prints the p50 ratio of every benchmark against the baseline. Returns the regressions."""
+    regressions = []
+    print(f"\n{'size':<8} {'benchmark':<45} {'baseline p50':>13} {'current p50':>12} {'ratio':>7}")
+    for size, benchmarks in current["results"].items():
+        for name, stats in benchmarks.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if not before or not before["p50_ms"]:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"]
+            flag = "  <-- regression" if ratio > threshold else ""
+            print(f"{size:<8} {name:<45} {before['p50_ms']:>13.3f} {stats['p50_ms']:>12.3f} {ratio:>7.2f}{flag}")
+            if ratio > threshold:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Shiosayi in-process benchmark suite.")
+    parser.add_argument("--sizes", default="small", help=f"Comma-separated dataset sizes ({', '.join(SIZES)}).")
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations for per-request benchmarks.")
+    parser.add_argument("--housekeeping-iterations", type=int, default=5,
+                        help="Housekeeping runs, each on a fresh copy of the dataset.")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "shiosayi-bench"),
+                        help="Where generated datasets are cached between runs.")
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    parser.add_argument("--compare", help="Baseline JSON results to compare against.")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Fail if any p50 is slower than the baseline by more than this ratio.")
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        sys.exit(f"Unknown size(s): {', '.join(unknown)}")
+
+    cache_dir = os.path.abspath(args.cache_dir)
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    os.makedirs(cache_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="shiosayi-bench-")
+    os.chdir(workdir)
+    configure_environment(workdir)
+    import logging
+    logging.disable(logging.INFO)
+
+    output = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "housekeeping_iterations": args.housekeeping_iterations,
+            "seed": SEED,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": {},
+        "snapshot_bytes": {},
+    }
+    try:
+        for size in sizes:
+            db_path = prepare_database(size, cache_dir)
+            print(f"Running benchmarks against '{size}'...")
+            output["results"][size] = run_size(size, db_path, workdir, args.iterations, args.housekeeping_iterations)
+            for name, stats in output["results"][size].items():
+                print(f"  {name:<45} p50 {stats['p50_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms  ({stats['iterations']} runs)")
+            publish_dir = os.path.join(workdir, "publish")
+            output["snapshot_bytes"][size] = snapshot_sizes(publish_dir, os.path.join(publish_dir, f"public_{size}_0.db"))
+            for name, size_bytes in output["snapshot_bytes"][size].items():
+                print(f"  {'size ' + name:<45} {size_bytes / 1024:>12.1f} KiB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"\nResults written to {output_path}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} benchmark(s) regressed by more than {args.threshold:.2f}x.")
+            sys.exit(1)
+        print("\n✅ No regressions against the baseline.")
@@ -0,0 +1,111 @@
+# import_time.py
+"""
+Checks how long `import app` takes, the work every gunicorn worker and `flask` command does first.
+
+Runs `python -X importtime -c "import app"` a few times in fresh interpreters and fails if a
+module that should only load on first use (the image and email stacks) is imported at startup,
+or if the app got slow to import. Absolute times vary too much between machines for a fixed
+budget, so the check is relative: in each run, `import app` is divided by the `import flask`
+it contains, and the median of that ratio must stay under --max-ratio. --budget-ms adds an
+absolute limit for a known machine:
+
+    python tests/import_time.py
+    python tests/import_time.py --max-ratio 1.8 --budget-ms 250
+    python tests/import_time.py --top 15          # also list the slowest imports
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `import app` over the `import flask` inside it; about 1.7 when this was written.
+DEFAULT_MAX_RATIO = 2.0
+# Imported on first use only; seeing one at startup means an eager import crept back in.
+LAZY_MODULES = ('PIL', 'resend', 'requests')
+
+
+def environment():
+    env = dict(os.environ)
+    env.setdefault("FLASK_SECRET_KEY", "import-time")
+    env.setdefault("KOFI_VERIFICATION_TOKEN", "import-time")
+    env.setdefault("ADMIN_API_TOKEN", "import-time")
+    env.setdefault("RESEND_API_KEY", "re_import_time")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    # Deployed workers load cached bytecode, so let the warm-up run write it.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def parse_importtime(stderr):
+    """Returns [(module, self_us, cumulative_us, depth)] from -X importtime output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nesting is shown by two spaces of indent per level, after the one separating space.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def measure(runs):
+    env = environment()
+    command = [sys.executable, "-X", "importtime", "-c", "import app"]
+    subprocess.run(command, cwd=ROOT, env=env, capture_output=True, check=True)
+
+    totals, baselines, entries = [], [], []
+    for _ in range(runs):
+        result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+        entries = parse_importtime(result.stderr)
+        totals.append(next(cumulative for name, _, cumulative, depth in entries if name == "app" and depth == 0))
+        baselines.append(next(cumulative for name, _, cumulative, _ in entries if name == "flask"))
+    return totals, baselines, entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if importing the app gets slower than the budget.")
+    parser.add_argument("--max-ratio", type=float, default=float(os.getenv("IMPORT_MAX_RATIO", DEFAULT_MAX_RATIO)),
+                        help=f"Maximum median of import app / import flask in the same run (default {DEFAULT_MAX_RATIO}).")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", 0)) or None,
+                        help="Also fail if the median import time is over this many milliseconds (default: no limit).")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time.")
+    parser.add_argument("--top", type=int, default=0, help="List this many of the slowest imports.")
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    args = parser.parse_args()
+
+    totals, baselines, entries = measure(args.runs)
+    median_ms = statistics.median(totals) / 1000
+    baseline_ms = statistics.median(baselines) / 1000
+    ratio = statistics.median(total / baseline for total, baseline in zip(totals, baselines))
+    modules = {name for name, _, _, _ in entries}
+    eager = sorted(name for name in LAZY_MODULES if name in modules)
+
+    print(f"import app: median {median_ms:.1f} ms over {args.runs} runs "
+          f"(min {min(totals) / 1000:.1f}, max {max(totals) / 1000:.1f}); import flask {baseline_ms:.1f} ms; "
+          f"ratio {ratio:.2f}, limit {args.max_ratio:.2f}")
+    if args.top:
+        for name, self_us, cumulative_us, depth in sorted(entries, key=lambda entry: -entry[1])[:args.top]:
+            print(f"  {self_us / 1000:7.2f} ms self {cumulative_us / 1000:8.2f} ms total  {name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"median_ms": median_ms, "runs_ms": [total / 1000 for total in totals],
+                       "flask_median_ms": baseline_ms, "ratio": ratio, "max_ratio": args.max_ratio,
+                       "budget_ms": args.budget_ms, "eager_modules": eager}, f, indent=2)
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported at startup but should load on first use: {', '.join(eager)}")
+        failed = True
+    if ratio > args.max_ratio:
+        print(f"FAIL: import app takes {ratio:.2f}x import flask, over the {args.max_ratio:.2f}x limit")
+        failed = True
+    if args.budget_ms and median_ms > args.budget_ms:
+        print(f"FAIL: import time {median_ms:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,222 @@
+# load_generator.py
+"""
+Non-interactive, multi-process HTTP load generator.
+
+Drives a running deployment with an open-loop (Poisson) request rate described by a
+scenario file, and reports latency percentiles, throughput and error rates per route.
+Webhook traffic is produced locally with fake_kofi_event.generate_payload, so the
+target should run with TEST_MODE=true to keep welcome emails away from real inboxes.
+All traffic comes from this machine's address, so the target must also run with
+RATE_LIMIT_ENABLED=false; otherwise most requests are answered 429 and counted as errors.
+
+    python tests/load_generator.py tests/load_scenario.json --output load_results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import fake_kofi_event
+
+# Statuses that are a normal outcome for a route, e.g. losing an adoption race.
+EXPECTED_STATUSES = {
+    'health': {200},
+    'auth': {200, 401},
+    'magnet': {200, 404},
+    'adopt': {200, 403, 409},
+    'webhook': {200},
+    'public_db': {200, 404},
+    'public_db_checksum': {200, 404},
+}
+
+
+def load_scenario(path):
+    with open(path) as f:
+        scenario = json.load(f)
+    scenario.setdefault('base_url', os.getenv("BASE_URL", "http://127.0.0.1:5001"))
+    scenario.setdefault('duration', 30)
+    scenario.setdefault('rate', 50)
+    scenario.setdefault('processes', os.cpu_count() or 2)
+    scenario.setdefault('threads_per_process', 32)
+    scenario.setdefault('timeout', 10)
+    scenario.setdefault('webhook_burst', 10)
+    scenario.setdefault('mix', {'auth': 50, 'magnet': 30, 'adopt': 5, 'webhook': 2, 'public_db': 1, 'public_db_checksum': 12})
+
+    unknown = set(scenario['mix']) - set(EXPECTED_STATUSES)
+    if unknown:
+        raise ValueError(f"Unknown route(s) in scenario mix: {', '.join(sorted(unknown))}")
+
+    if scenario.get('database') and not scenario.get('tokens'):
+        conn = sqlite3.connect(scenario['database'])
+        scenario['tokens'] = [row[0] for row in conn.execute("SELECT token FROM guardians ORDER BY random() LIMIT 5000")]
+        scenario.setdefault('film_ids', [row[0] for row in conn.execute("SELECT id FROM films ORDER BY random() LIMIT 5000")])
+        scenario.setdefault('emails', [row[0] for row in conn.execute("SELECT email FROM guardians ORDER BY random() LIMIT 5000")])
+        conn.close()
+    scenario.setdefault('tokens', ['invalid-token'])
+    scenario.setdefault('film_ids', list(range(1, 1001)))
+    scenario.setdefault('emails', [])
+    # A small pool of films that every worker competes for, to exercise adoption races.
+    scenario.setdefault('adopt_film_ids', scenario['film_ids'][:20])
+    return scenario
+
+
+class Worker:
+    def __init__(self, scenario, seed):
+        self.scenario = scenario
+        self.rng = random.Random(seed)
+        self.base_url = scenario['base_url'].rstrip('/')
+        self.timeout = scenario['timeout']
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=scenario['threads_per_process'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, route, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+            status = response.status_code
+            response.content
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return route, status, time.perf_counter() - started
+
+    def run(self, route):
+        token = self.rng.choice(self.scenario['tokens'])
+        if route == 'health':
+            return [self.request(route, 'GET', '/health')]
+        if route == 'auth':
+            return [self.request(route, 'GET', '/auth', params={'token': token})]
+        if route == 'magnet':
+            return [self.request(route, 'GET', f"/magnet/{self.rng.choice(self.scenario['film_ids'])}", params={'TOKEN': token})]
+        if route == 'adopt':
+            return [self.request(route, 'POST', f"/adopt/{self.rng.choice(self.scenario['adopt_film_ids'])}", params={'TOKEN': token})]
+        if route == 'public_db':
+            return [self.request(route, 'GET', '/db/public')]
+        if route == 'public_db_checksum':
+            return [self.request(route, 'GET', '/db/public.sha256')]
+        if route == 'webhook':
+            samples = []
+            for _ in range(self.scenario['webhook_burst']):
+                if self.scenario['emails'] and self.rng.random() < 0.8:
+                    payload = fake_kofi_event.generate_payload(self.rng.choice(self.scenario['emails']),
+                                                               self.rng.choice(('lover', 'keeper', 'savior')),
+                                                               is_first_payment=False)
+                else:
+                    payload = fake_kofi_event.generate_payload(f"load-{self.rng.getrandbits(48):x}@example.com", 'lover')
+                samples.append(self.request(route, 'POST', '/webhook', data={'data': json.dumps(payload)}))
+            return samples
+        raise ValueError(f"Unknown route '{route}'")
+
+
+def run_process(args):
+    """Issues requests at this process's share of the target rate. Returns (route, status, seconds) samples."""
+    scenario, process_index = args
+    fake_kofi_event.KOFI_TOKEN = scenario.get('kofi_token') or os.getenv("KOFI_VERIFICATION_TOKEN")
+    worker = Worker(scenario, seed=scenario.get('seed', 0) * 1000 + process_index)
+    rate = scenario['rate'] / scenario['processes']
+    routes, weights = zip(*scenario['mix'].items())
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=scenario['threads_per_process']) as executor:
+        start = time.perf_counter()
+        next_at = start
+        while next_at - start < scenario['duration']:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(worker.run, worker.rng.choices(routes, weights)[0]))
+            next_at += worker.rng.expovariate(rate)
+
+    samples = []
+    for future in futures:
+        samples.extend(future.result())
+    return samples
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(samples, elapsed):
+    routes = {}
+    for route, status, seconds in samples:
+        routes.setdefault(route, []).append((status, seconds))
+
+    report = {}
+    for route, route_samples in sorted(routes.items()):
+        latencies = sorted(seconds * 1000 for _, seconds in route_samples)
+        statuses = {}
+        for status, _ in route_samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = sum(1 for status, _ in route_samples if status not in EXPECTED_STATUSES[route])
+        report[route] = {
+            "requests": len(route_samples),
+            "throughput_rps": round(len(route_samples) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "max_ms": round(latencies[-1], 2),
+            "error_rate": round(errors / len(route_samples), 4),
+            "statuses": statuses,
+        }
+    return report
+
+
+def run(scenario):
+    started = time.perf_counter()
+    with multiprocessing.Pool(scenario['processes']) as pool:
+        per_process = pool.map(run_process, [(scenario, index) for index in range(scenario['processes'])])
+    elapsed = time.perf_counter() - started
+    samples = [sample for process_samples in per_process for sample in process_samples]
+    return {
+        "scenario": {key: scenario[key] for key in ('base_url', 'duration', 'rate', 'processes', 'threads_per_process', 'mix')},
+        "elapsed_seconds": round(elapsed, 2),
+        "total_requests": len(samples),
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "routes": summarize(samples, elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an HTTP load scenario against a Shiosayi deployment.")
+    parser.add_argument("scenario", help="Scenario JSON file.")
+    parser.add_argument("--base-url", help="Override the scenario's base_url.")
+    parser.add_argument("--rate", type=float, help="Override the target requests per second.")
+    parser.add_argument("--duration", type=float, help="Override the duration in seconds.")
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    for key in ('base_url', 'rate', 'duration'):
+        if getattr(args, key) is not None:
+            scenario[key] = getattr(args, key)
+    if not (scenario.get('kofi_token') or os.getenv("KOFI_VERIFICATION_TOKEN")) and 'webhook' in scenario['mix']:
+        sys.exit("ERROR: KOFI_VERIFICATION_TOKEN is not set and the scenario has no 'kofi_token'.")
+
+    print(f"Running load against {scenario['base_url']} at {scenario['rate']} req/s for {scenario['duration']}s "
+          f"({scenario['processes']} processes)...")
+    report = run(scenario)
+
+    print(f"\n{'route':<20} {'requests':>9} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}")
+    for route, stats in report['routes'].items():
+        print(f"{route:<20} {stats['requests']:>9} {stats['throughput_rps']:>8} {stats['p50_ms']:>9} "
+              f"{stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['error_rate']:>8.2%}")
+    print(f"\nTotal: {report['total_requests']} requests, {report['throughput_rps']} req/s.")
+    throttled = sum(stats['statuses'].get('429', 0) for stats in report['routes'].values())
+    if throttled:
+        print(f"WARNING: {throttled} requests were rate limited (429); run the target with RATE_LIMIT_ENABLED=false.")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
@@ -0,0 +1,219 @@
+# replication_harness.py
+"""
+Runs a primary and a read replica on one machine and checks that replication works:
+
+- the primary app, its shipping loop, the replica's apply loop and the replica app run as
+  separate processes, sharing only REPLICATION_DIR, as they would on two nodes;
+- the replica answers /films, /auth, /magnet and /db/public.sha256 like the primary;
+- adoptions made on the primary show up on the replica, and how long that takes (the lag);
+- the replica refuses writes, and reports replication_lag_seconds in /admin/metrics;
+- with the shipping loop stopped, the replica turns stale (503) within the lag bound and
+  recovers once it is back.
+
+    python tests/replication_harness.py --writes 10 --interval 1 --max-lag 5 --output replication.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+from benchmark import ROOT, SIZES, prepare_database, fresh_copy
+from serving_benchmark import free_port
+
+ADMIN_TOKEN = "harness-admin-token"
+
+
+def http(method, url, headers=None):
+    """Returns (status, body text); status is None if the server could not be reached."""
+    request = urllib.request.Request(url, method=method, headers=headers or {}, data=b"" if method == "POST" else None)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+    except OSError:
+        return None, ""
+
+
+def has_magnet(answer):
+    """True once /magnet answers with the link, which it only gives for adopted films."""
+    status, body = answer
+    return status == 200 and not json.loads(body)["magnet"].startswith(":(")
+
+
+def wait_for(predicate, timeout, poll=0.05):
+    """Polls until predicate() is truthy. Returns the seconds it took, or None on timeout."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if predicate():
+            return time.perf_counter() - started
+        time.sleep(poll)
+    return None
+
+
+class Node:
+    """The processes of one node, started with its own environment."""
+
+    def __init__(self, name, env):
+        self.name = name
+        self.env = env
+        self.processes = {}
+
+    def start(self, kind, command):
+        self.processes[kind] = subprocess.Popen(command, cwd=ROOT, env=self.env,
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self, kind):
+        process = self.processes.pop(kind, None)
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    def stop_all(self):
+        for kind in list(self.processes):
+            self.stop(kind)
+
+
+def node_environment(workdir, name, db_path, replication_dir, role, args):
+    env = dict(os.environ)
+    env.update({
+        "FLASK_SECRET_KEY": "harness", "KOFI_VERIFICATION_TOKEN": "harness-kofi-token",
+        "ADMIN_API_TOKEN": ADMIN_TOKEN, "RESEND_API_KEY": "re_harness",
+        "DATABASE_FILENAME": db_path, "CDN_STORAGE_PATH": os.path.join(workdir, name, "cdn"),
+        "CDN_BASE_URL": "http://cdn.harness.local", "LOG_LEVEL": "WARNING",
+        "RATE_LIMIT_ENABLED": "false",
+        "REPLICATION_ROLE": role, "REPLICATION_DIR": replication_dir,
+        "REPLICATION_INTERVAL_SECONDS": str(args.interval), "REPLICA_MAX_LAG_SECONDS": str(args.max_lag),
+    })
+    os.makedirs(os.path.join(workdir, name, "cdn", "db"), exist_ok=True)
+    return env
+
+
+def adoption_candidates(db_path, count):
+    """(film id, guardian token) pairs: orphan films with a magnet, and guardians below their tier's adoption limit."""
+    db = sqlite3.connect(db_path)
+    films = [row[0] for row in db.execute(
+        "SELECT id FROM films WHERE status = 'orphan' AND magnet IS NOT NULL ORDER BY id LIMIT ?", (count,))]
+    tokens = [row[0] for row in db.execute(
+        """
+        SELECT token FROM guardians
+        WHERE (SELECT COUNT(*) FROM films WHERE guardian_id = guardians.id AND status = 'adopted')
+              < CASE tier WHEN 'savior' THEN 10 WHEN 'keeper' THEN 5 ELSE 1 END
+        ORDER BY id LIMIT ?
+        """, (count,))]
+    db.close()
+    return list(zip(films, tokens))
+
+
+def run(args, workdir):
+    results, failures = {"checks": {}}, []
+
+    def check(name, ok, detail=None):
+        results["checks"][name] = {"ok": bool(ok), "detail": detail}
+        if not ok:
+            failures.append(name)
+        print(f"{'ok  ' if ok else 'FAIL'} {name}{f': {detail}' if detail is not None else ''}", file=sys.stderr)
+
+    source = prepare_database(args.size, args.cache_dir)
+    os.makedirs(os.path.join(workdir, "primary"))
+    os.makedirs(os.path.join(workdir, "replica"))
+    primary_db = fresh_copy(source, os.path.join(workdir, "primary"), "primary.db")
+    replica_db = os.path.join(workdir, "replica", "replica.db")
+    replication_dir = os.path.join(workdir, "shipped")
+
+    primary = Node("primary", node_environment(workdir, "primary", primary_db, replication_dir, "primary", args))
+    replica = Node("replica", node_environment(workdir, "replica", replica_db, replication_dir, "replica", args))
+    with open(os.path.join(workdir, "primary", "cdn", "db", "public.db.sha256"), "w") as f:
+        f.write("1" * 64 + "\n")
+
+    primary_port, replica_port = free_port(), free_port()
+    primary_url, replica_url = f"http://127.0.0.1:{primary_port}", f"http://127.0.0.1:{replica_port}"
+    flask = [sys.executable, "-m", "flask", "--app", "app"]
+    try:
+        primary.start("app", ["gunicorn", "-w", "2", "-b", f"127.0.0.1:{primary_port}", "app:app"])
+        primary.start("ship", flask + ["replicate"])
+        replica.start("apply", flask + ["replicate"])
+        replica.start("app", ["gunicorn", "-w", "2", "-b", f"127.0.0.1:{replica_port}", "app:app"])
+
+        ready = wait_for(lambda: http("GET", f"{replica_url}/health")[0] == 200, 60, poll=0.2)
+        check("replica becomes healthy", ready is not None, f"{ready:.1f}s" if ready else None)
+        if ready is None:
+            return results, failures
+
+        candidates = adoption_candidates(primary_db, args.writes + 1)
+        film_id, token = candidates[0]
+        for path in ("/films?limit=20", "/films?status=adopted&limit=20", f"/auth?token={token}",
+                     f"/magnet/{film_id}?TOKEN={token}", "/db/public.sha256"):
+            primary_answer, replica_answer = http("GET", primary_url + path), http("GET", replica_url + path)
+            check(f"replica matches primary for {path.split('?')[0]}", primary_answer == replica_answer,
+                  None if primary_answer == replica_answer else f"{primary_answer[0]} vs {replica_answer[0]}")
+
+        status, _ = http("POST", f"{replica_url}/adopt/{film_id}?TOKEN={token}")
+        check("replica refuses writes", status == 503, status)
+
+        visible_after = []
+        for film_id, token in candidates[1:]:
+            status, _ = http("POST", f"{primary_url}/adopt/{film_id}?TOKEN={token}")
+            if status != 200:
+                check(f"adoption of film {film_id} on the primary", False, status)
+                continue
+            seconds = wait_for(lambda: has_magnet(http("GET", f"{replica_url}/magnet/{film_id}?TOKEN={token}")), args.max_lag * 2)
+            visible_after.append(seconds)
+        seen = sorted(seconds for seconds in visible_after if seconds is not None)
+        check("adoptions on the primary reach the replica", seen and len(seen) == len(visible_after),
+              f"{len(seen)}/{len(visible_after)}")
+        if seen:
+            results["write_visible_seconds"] = {
+                "p50": round(seen[len(seen) // 2], 3), "max": round(seen[-1], 3), "mean": round(sum(seen) / len(seen), 3)
+            }
+
+        status, body = http("GET", f"{replica_url}/admin/metrics", {"Authorization": f"Bearer {ADMIN_TOKEN}"})
+        lag = next((float(line.split()[-1]) for line in body.splitlines() if line.startswith("replication_lag_seconds ")), None)
+        check("replica reports replication_lag_seconds", status == 200 and lag is not None and 0 <= lag <= args.max_lag, lag)
+
+        primary.stop("ship")
+        stale = wait_for(lambda: http("GET", f"{replica_url}/auth?token={token}")[0] == 503, args.max_lag * 3, poll=0.2)
+        check("replica stops serving once over the lag bound", stale is not None, f"{stale:.1f}s" if stale else None)
+        check("stale replica fails its health check", http("GET", f"{replica_url}/health")[0] == 503)
+
+        primary.start("ship", flask + ["replicate"])
+        recovered = wait_for(lambda: http("GET", f"{replica_url}/auth?token={token}")[0] == 200, args.max_lag * 3, poll=0.2)
+        check("replica recovers when shipping resumes", recovered is not None, f"{recovered:.1f}s" if recovered else None)
+    finally:
+        replica.stop_all()
+        primary.stop_all()
+    return results, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a primary and a read replica on one machine and check replication.")
+    parser.add_argument("--size", default="small", help=f"Dataset size ({', '.join(SIZES)}).")
+    parser.add_argument("--writes", type=int, default=10, help="Adoptions to make on the primary and wait for on the replica.")
+    parser.add_argument("--interval", type=float, default=1, help="REPLICATION_INTERVAL_SECONDS for both loops.")
+    parser.add_argument("--max-lag", type=float, default=5, help="REPLICA_MAX_LAG_SECONDS for the replica.")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "shiosayi-bench"),
+                        help="Where generated datasets are cached.")
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    args = parser.parse_args()
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="shiosayi-replication-")
+    try:
+        results, failures = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results["settings"] = {"size": args.size, "writes": args.writes, "interval": args.interval, "max_lag": args.max_lag}
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    sys.exit(1 if failures else 0)
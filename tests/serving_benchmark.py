@@ -0,0 +1,278 @@
+# serving_benchmark.py
+"""
+Compares the sync (gunicorn), threaded (gunicorn gthread) and ASGI (uvicorn asgi:app)
+deployments on the endpoints clients poll: /auth, /magnet/<id> and /db/public.sha256.
+
+For each mode it starts a real server on a generated database and measures:
+- connections: N clients connect at once, each makes a request, idles for a second and makes
+  another. Reports how many were served, how many kept their connection open, and how long it took.
+- throughput: C keep-alive clients request the polling mix as fast as they can for D seconds.
+  Reports requests/sec, latency percentiles and requests per CPU-second of the server processes,
+  which is requests/sec per core.
+
+    python tests/serving_benchmark.py --connections 500 --concurrency 50 --duration 10
+    python tests/serving_benchmark.py --modes sync,asgi --workers 2 --output serving.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+
+from benchmark import ROOT, SIZES, prepare_database, fresh_copy
+
+MODES = ('sync', 'gthread', 'asgi')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def server_command(mode, port, workers, threads):
+    bind = f"127.0.0.1:{port}"
+    if mode == 'sync':
+        return ["gunicorn", "-w", str(workers), "-b", bind, "app:app"]
+    if mode == 'gthread':
+        return ["gunicorn", "-w", str(workers), "-k", "gthread", "--threads", str(threads), "-b", bind, "app:app"]
+    command = ["uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log"]
+    return command + (["--workers", str(workers)] if workers > 1 else [])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree_cpu(pid):
+    """User plus system CPU seconds of a process and all its descendants, from /proc."""
+    parents, times = {}, {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        parents[int(entry)] = int(fields[1])
+        times[int(entry)] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        for child, child_parent in parents.items():
+            if child_parent == parent and child not in tree:
+                tree.add(child)
+                frontier.append(child)
+    return sum(times.get(member, 0) for member in tree)
+
+
+def start_server(mode, env, workers, threads):
+    port = free_port()
+    process = subprocess.Popen(server_command(mode, port, workers, threads), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+class Client:
+    """A minimal HTTP/1.1 client that keeps its connection open while the server allows it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+        self.reconnects = 0
+
+    async def request(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+            self.reconnects += 1
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: benchmark\r\n\r\n".encode())
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length, close = 0, False
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+            elif name.lower() == "connection" and value.strip().lower() == "close":
+                close = True
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def is_open(self):
+        return self.writer is not None and not self.reader.at_eof()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def connections_phase(port, count, timeout):
+    clients = [Client(port) for _ in range(count)]
+
+    async def first(client):
+        return await asyncio.wait_for(client.request("/db/public.sha256"), timeout)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(first(client) for client in clients), return_exceptions=True)
+    served = sum(1 for result in results if result == 200)
+    first_seconds = time.perf_counter() - started
+
+    await asyncio.sleep(1)
+    still_open = sum(1 for client in clients if client.is_open())
+    results = await asyncio.gather(*(first(client) for client in clients), return_exceptions=True)
+    served_again = sum(1 for result in results if result == 200)
+    reconnects = sum(client.reconnects for client in clients) - count
+    for client in clients:
+        client.close()
+    return {
+        "connections": count,
+        "served": served,
+        "seconds_to_serve_all": round(first_seconds, 3),
+        "held_open_while_idle": still_open,
+        "served_after_idle": served_again,
+        "reconnects": reconnects,
+    }
+
+
+async def throughput_phase(port, paths, concurrency, duration):
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(seed):
+        nonlocal errors
+        client, rng = Client(port), random.Random(seed)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(client.request(rng.choice(paths)), 10)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                errors += 1
+                client.close()
+                continue
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+        client.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3) if latencies else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+    }
+
+
+def polling_paths(db_path):
+    db = sqlite3.connect(db_path)
+    tokens = [row[0] for row in db.execute("SELECT token FROM guardians ORDER BY id LIMIT 50")]
+    film_ids = [row[0] for row in db.execute("SELECT id FROM films WHERE magnet IS NOT NULL ORDER BY id LIMIT 50")]
+    db.close()
+    paths = [f"/auth?token={token}" for token in tokens]
+    paths += [f"/magnet/{film_id}?TOKEN={random.choice(tokens)}" for film_id in film_ids]
+    paths += ["/db/public.sha256"] * len(tokens)
+    return paths
+
+
+def run_mode(mode, args, env, paths):
+    process, port = start_server(mode, env, args.workers, args.threads)
+    try:
+        result = {"connections": asyncio.run(connections_phase(port, args.connections, args.timeout))}
+        cpu_before = process_tree_cpu(process.pid)
+        result["throughput"] = asyncio.run(throughput_phase(port, paths, args.concurrency, args.duration))
+        cpu_seconds = process_tree_cpu(process.pid) - cpu_before
+        result["throughput"]["server_cpu_seconds"] = round(cpu_seconds, 2)
+        result["throughput"]["requests_per_core_second"] = (
+            round(result["throughput"]["requests"] / cpu_seconds, 1) if cpu_seconds else None
+        )
+        return result
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare sync, threaded and ASGI serving of the polling endpoints.")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated modes ({', '.join(MODES)}).")
+    parser.add_argument("--size", default="small", help=f"Dataset size ({', '.join(SIZES)}).")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes.")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per worker for gthread, and ASGI_THREADS.")
+    parser.add_argument("--connections", type=int, default=500, help="Simultaneous connections for the connection phase.")
+    parser.add_argument("--concurrency", type=int, default=50, help="Keep-alive clients for the throughput phase.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of the throughput phase.")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds a connection-phase request may take.")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "shiosayi-bench"),
+                        help="Where generated datasets are cached.")
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        sys.exit(f"Unknown mode(s): {', '.join(unknown)}")
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="shiosayi-serving-")
+    try:
+        db_path = fresh_copy(prepare_database(args.size, args.cache_dir), workdir, "serving.db")
+        os.makedirs(os.path.join(workdir, "cdn", "db"))
+        with open(os.path.join(workdir, "cdn", "db", "public.db.sha256"), "w") as f:
+            f.write("0" * 64 + "\n")
+
+        env = dict(os.environ)
+        env.update({
+            "FLASK_SECRET_KEY": "benchmark", "KOFI_VERIFICATION_TOKEN": "benchmark-kofi-token",
+            "ADMIN_API_TOKEN": "benchmark-admin-token", "RESEND_API_KEY": "re_benchmark",
+            "DATABASE_FILENAME": db_path, "CDN_STORAGE_PATH": os.path.join(workdir, "cdn"),
+            "CDN_BASE_URL": "http://cdn.benchmark.local", "LOG_LEVEL": "WARNING",
+            # The load comes from one address, so per-client limits would measure the limiter.
+            "RATE_LIMIT_ENABLED": "false",
+            "WORKER_THREADS": str(args.threads), "ASGI_THREADS": str(args.threads),
+        })
+        paths = polling_paths(db_path)
+
+        results = {
+            "cpu_count": os.cpu_count(),
+            "settings": {key: getattr(args, key) for key in ("size", "workers", "threads", "connections", "concurrency", "duration")},
+            "modes": {},
+        }
+        for mode in modes:
+            print(f"Running {mode}...", file=sys.stderr)
+            results["modes"][mode] = run_mode(mode, args, env, paths)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
@@ -1,122 +1,284 @@
-
+import os
+import sys
+import json
+import math
+import time
+import string
+import random
 import sqlite3
+import argparse
 from datetime import datetime, timedelta
-import random
-import uuid
-
-# Create SQLite DB
-conn = sqlite3.connect("./shiosayi_test.db")
-c = conn.cursor()
-
-# Create tables
-c.executescript("""
-CREATE TABLE IF NOT EXISTS guardians (
-    id TEXT PRIMARY KEY,
-    name TEXT,
-    email TEXT UNIQUE NOT NULL,
-    tier INTEGER NOT NULL,
-    token TEXT UNIQUE NOT NULL,
-    joined_at DATETIME NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS films (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    year INTEGER,
-    plot TEXT,
-    poster_url TEXT,
-    region TEXT,
-    guardian_id TEXT,
-    status TEXT CHECK (status IN ('orphan', 'adopted', 'abandoned')) NOT NULL DEFAULT 'orphan',
-    magnet TEXT,
-    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-);
-
-CREATE TABLE IF NOT EXISTS suggestions (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    email TEXT NOT NULL,
-    title TEXT NOT NULL,
-    notes TEXT,
-    status TEXT CHECK (status IN ('pending', 'added', 'ignored')) DEFAULT 'pending',
-    suggested_at DATETIME DEFAULT CURRENT_TIMESTAMP
-);
-
-CREATE TABLE IF NOT EXISTS kofi_events (
-    id TEXT PRIMARY KEY,
-    timestamp DATETIME NOT NULL,
-    type TEXT CHECK (type IN ('Donation', 'Subscription')) NOT NULL,
-    is_public BOOLEAN,
-    from_name TEXT,
-    email TEXT NOT NULL,
-    message TEXT,
-    amount REAL,
-    currency TEXT,
-    url TEXT,
-    is_subscription_payment BOOLEAN,
-    is_first_subscription_payment BOOLEAN,
-    tier_name TEXT,
-    kofi_transaction_id TEXT,
-    raw_payload TEXT
-);
-""")
-
-# Sample guardians
-for i in range(1, 6):
-    guardian_id = f"g{i:03d}"
-    name = f"Guardian{i}"
-    email = f"guardian{i}@example.com"
-    tier = random.choice([1, 5, 10])
-    token = str(uuid.uuid4())
-    joined_at = datetime.now() - timedelta(days=random.randint(0, 60))
-    c.execute("INSERT INTO guardians VALUES (?, ?, ?, ?, ?, ?)",
-              (guardian_id, name, email, tier, token, joined_at.isoformat()))
-
-# Sample films
-statuses = ['orphan', 'adopted', 'abandoned']
-for i in range(1, 11):
-    title = f"Rare Film {i}"
-    year = random.randint(1950, 2000)
-    plot = f"Plot of film {i}."
-    poster_url = f"https://example.com/poster{i}.jpg"
-    region = random.choice(['Japan', 'India', 'France', 'Iran'])
-    guardian_id = f"g{random.randint(1, 5):03d}" if i % 3 != 0 else None
-    status = 'adopted' if guardian_id else 'orphan'
-    magnet = f"magnet:?xt=urn:btih:{uuid.uuid4().hex}&dn=Rare+Film+{i}"
-    updated_at = datetime.now().isoformat()
-    c.execute("""INSERT INTO films (title, year, plot, poster_url, region, guardian_id, status, magnet, updated_at)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-              (title, year, plot, poster_url, region, guardian_id, status, magnet, updated_at))
-
-# Sample suggestions
-for i in range(1, 6):
-    email = f"user{i}@mail.com"
-    title = f"Suggested Film {i}"
-    notes = f"This is a suggestion for film {i}"
-    status = random.choice(['pending', 'added', 'ignored'])
-    suggested_at = datetime.now() - timedelta(days=random.randint(1, 20))
-    c.execute("INSERT INTO suggestions (email, title, notes, status, suggested_at) VALUES (?, ?, ?, ?, ?)",
-              (email, title, notes, status, suggested_at.isoformat()))
-
-# Sample kofi events
-for i in range(1, 6):
-    message_id = str(uuid.uuid4())
-    timestamp = datetime.now() - timedelta(days=random.randint(0, 30))
-    type_ = random.choice(['Donation', 'Subscription'])
-    is_public = True
-    from_name = f"Donor{i}"
-    email = f"guardian{i}@example.com"
-    message = f"Support message {i}"
-    amount = random.choice([1.00, 5.00, 10.00])
-    currency = "USD"
-    url = "https://ko-fi.com/tx/123456"
-    is_subscription = type_ == 'Subscription'
-    is_first = bool(random.getrandbits(1))
-    tier_name = "Bronze" if amount <= 5 else "Silver"
-    kofi_tx_id = str(uuid.uuid4())
-    raw_payload = "{}"
-    c.execute("""INSERT INTO kofi_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-              (message_id, timestamp.isoformat(), type_, is_public, from_name, email, message, amount, currency, url,
-               is_subscription, is_first, tier_name, kofi_tx_id, raw_payload))
-
-conn.commit()
-conn.close()
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'schema.sql')
+CHUNK_SIZE = 50_000
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+TIER_WEIGHTS = {'lover': 0.70, 'keeper': 0.22, 'savior': 0.08}
+TIER_LIMITS = {'lover': 1, 'keeper': 5, 'savior': 10}
+TIER_AMOUNTS = {'lover': 3.00, 'keeper': 5.00, 'savior': 10.00}
+REGION_WEIGHTS = {
+    'Japan': 30, 'France': 12, 'India': 12, 'Italy': 8, 'Iran': 6, 'Hong Kong': 6, 'South Korea': 6,
+    'Germany': 5, 'USSR': 5, 'Brazil': 4, 'Taiwan': 3, 'Mexico': 3,
+}
+TITLE_WORDS = (
+    "silent river night summer last house wind autumn stranger city mountain rain dream ghost "
+    "sea floating bridge winter mirror forgotten red tale village sun moon crimson garden journey "
+    "empty station fire storm lantern song distant paper harbor shadow road spring island"
+).split()
+FIRST_NAMES = "Aiko Ravi Chloe Omid Luca Mei Joon Hana Arjun Elise Kenji Sofia Dariush Ana Yuki Marco".split()
+LAST_NAMES = "Tanaka Sharma Martin Karimi Rossi Chen Park Sato Iyer Dubois Mori Costa Ahmadi Silva Ito Weber".split()
+
+
+def weighted_choice(rng, weights):
+    population, cum_weights = list(weights), []
+    total = 0
+    for weight in weights.values():
+        total += weight
+        cum_weights.append(total)
+    return lambda: rng.choices(population, cum_weights=cum_weights)[0]
+
+
+def binomial(rng, n, p):
+    return sum(1 for _ in range(n) if rng.random() < p)
+
+
+def schema_statements():
+    """Splits schema.sql into (tables, indexes and triggers) so the latter run after the bulk load.
+
+    Triggers come last so the generated rows do not fill the change log.
+    """
+    statements, current = [], ""
+    with open(SCHEMA_PATH) as f:
+        for line in f:
+            if not current and (not line.strip() or line.lstrip().startswith('--')):
+                continue
+            current += line
+            if sqlite3.complete_statement(current):
+                statements.append(current.strip())
+                current = ""
+    deferred = [statement for statement in statements
+                if statement.upper().startswith(('CREATE INDEX', 'CREATE UNIQUE INDEX', 'CREATE TRIGGER'))]
+    tables = [statement for statement in statements if statement not in deferred]
+    return tables, deferred
+
+
+def chunked_insert(conn, sql, rows):
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            conn.executemany(sql, chunk)
+            count += len(chunk)
+            chunk.clear()
+    if chunk:
+        conn.executemany(sql, chunk)
+        count += len(chunk)
+    return count
+
+
+class DatasetGenerator:
+    def __init__(self, seed, now, guardians, films, donations, suggestions, lapsed_fraction, adoption_ratio, raw_payloads):
+        self.rng = random.Random(seed)
+        self.now = now
+        self.guardian_count = guardians
+        self.film_count = films
+        self.donation_count = donations
+        self.suggestion_count = suggestions
+        self.lapsed_fraction = lapsed_fraction
+        self.adoption_ratio = adoption_ratio
+        self.raw_payloads = raw_payloads
+        self.pick_tier = weighted_choice(self.rng, TIER_WEIGHTS)
+        self.pick_region = weighted_choice(self.rng, REGION_WEIGHTS)
+        self.guardians = []  # (id, email, name, tier, joined_at, last_paid_at)
+        self.suggestion_votes = {}  # (title key, email) -> first suggested at
+        self.corpus = " ".join(self.rng.choices(TITLE_WORDS, k=20_000))
+
+    def timestamp(self, when):
+        return when.strftime(TIMESTAMP_FORMAT)
+
+    def token(self):
+        alphabet = string.ascii_letters + string.digits
+        return "shio_" + "".join(self.rng.choices(alphabet, k=32))
+
+    def guardian_rows(self):
+        for guardian_id in range(1, self.guardian_count + 1):
+            tier = self.pick_tier()
+            name = f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}"
+            email = f"guardian{guardian_id}@example.com"
+            joined_at = self.now - timedelta(days=self.rng.uniform(1, 3 * 365))
+            if self.rng.random() < self.lapsed_fraction:
+                days_since_paid = self.rng.uniform(36, 400)
+            else:
+                days_since_paid = self.rng.uniform(0, 30)
+            last_paid_at = max(joined_at, self.now - timedelta(days=days_since_paid))
+            self.guardians.append((guardian_id, email, name, tier, joined_at, last_paid_at))
+            yield (guardian_id, name, email, tier, self.token(), self.timestamp(joined_at), self.timestamp(last_paid_at))
+
+    def adoptions(self):
+        """Maps film id -> guardian id, with each guardian using a binomial share of their tier limit."""
+        wanted = []
+        for guardian_id, _, _, tier, _, _ in self.guardians:
+            wanted.extend([guardian_id] * binomial(self.rng, TIER_LIMITS[tier], self.adoption_ratio))
+        wanted = wanted[:self.film_count]
+        film_ids = self.rng.sample(range(1, self.film_count + 1), len(wanted))
+        return dict(zip(film_ids, wanted))
+
+    def title(self):
+        words = [word.capitalize() for word in self.rng.choices(TITLE_WORDS, k=self.rng.choice((1, 2, 2, 3, 3, 4)))]
+        if self.rng.random() < 0.3:
+            words.insert(0, "The")
+        return " ".join(words)
+
+    def plot(self):
+        length = min(2000, max(40, int(self.rng.lognormvariate(math.log(300), 0.6))))
+        start = self.rng.randrange(len(self.corpus) - length)
+        start = self.corpus.index(" ", start) + 1
+        return self.corpus[start:start + length].rsplit(" ", 1)[0].capitalize() + "."
+
+    def film_rows(self, adoptions):
+        for film_id in range(1, self.film_count + 1):
+            title = self.title()
+            year = int(self.rng.triangular(1920, self.now.year, 1975))
+            info_hash = f"{self.rng.getrandbits(160):040x}"
+            magnet = f"magnet:?xt=urn:btih:{info_hash}&dn={title.replace(' ', '+')}"
+            guardian_id = adoptions.get(film_id)
+            status = 'adopted' if guardian_id else 'orphan'
+            updated_at = self.now - timedelta(days=self.rng.uniform(0, 365))
+            yield (film_id, title, year, self.plot(), f"https://cdn.example.com/posters/{film_id}.jpg",
+                   self.pick_region(), str(guardian_id) if guardian_id else None, status, magnet,
+                   self.timestamp(updated_at), info_hash)
+
+    def event_row(self, message_id, when, event_type, email, name, amount, is_subscription, is_first, tier):
+        timestamp = when.strftime("%Y-%m-%dT%H:%M:%SZ")
+        raw_payload = None
+        if self.raw_payloads:
+            raw_payload = json.dumps({
+                "message_id": message_id, "timestamp": timestamp, "type": event_type, "email": email,
+                "from_name": name, "amount": f"{amount:.2f}", "currency": "USD", "tier_name": tier,
+                "is_subscription_payment": is_subscription, "is_first_subscription_payment": is_first,
+            })
+        return (message_id, timestamp, event_type, True, name, email, None, amount, "USD",
+                "https://ko-fi.com/", is_subscription, is_first, tier, f"tx-{message_id}", raw_payload)
+
+    def event_rows(self):
+        """Monthly payments for every guardian from joined_at to last_paid_at, plus one-off donations."""
+        event_number = 0
+        for _, email, name, tier, joined_at, last_paid_at in self.guardians:
+            when = joined_at
+            is_first = True
+            while when <= last_paid_at:
+                event_number += 1
+                yield self.event_row(f"evt-{event_number:09d}", when, "Subscription", email, name,
+                                     TIER_AMOUNTS[tier], True, is_first, tier.capitalize())
+                when += timedelta(days=30)
+                is_first = False
+
+        for _ in range(self.donation_count):
+            event_number += 1
+            when = self.now - timedelta(days=self.rng.uniform(0, 3 * 365))
+            if self.guardians and self.rng.random() < 0.5:
+                _, email, name, _, _, _ = self.rng.choice(self.guardians)
+            else:
+                email, name = f"donor{self.rng.randrange(10 * max(1, self.guardian_count))}@example.com", None
+            amount = self.rng.choice((3.00, 5.00, 10.00, 15.00, 25.00, 50.00))
+            yield self.event_row(f"evt-{event_number:09d}", when, "Donation", email, name, amount, False, False, None)
+
+    def suggestion_rows(self):
+        """Suggestions merged by title as /suggest merges them, with one vote per distinct email."""
+        merged = {}
+        for n in range(self.suggestion_count):
+            suggested_at = self.now - timedelta(days=self.rng.uniform(0, 365))
+            status = self.rng.choices(('pending', 'added', 'ignored'), weights=(70, 20, 10))[0]
+            email = f"fan{self.rng.randrange(max(1, self.suggestion_count // 3))}@example.com"
+            title = self.title()
+            # Generated titles are plain ASCII words, so utils.normalize_title would just lowercase them.
+            key = f"{title.lower()}|"
+            if key not in merged:
+                merged[key] = [email, title, status, suggested_at, suggested_at]
+            row = merged[key]
+            row[3], row[4] = min(row[3], suggested_at), max(row[4], suggested_at)
+            self.suggestion_votes.setdefault((key, email), suggested_at)
+
+        votes = {}
+        for key, _ in self.suggestion_votes:
+            votes[key] = votes.get(key, 0) + 1
+        for key, (email, title, status, first_at, last_at) in merged.items():
+            yield (email, title, None, status, self.timestamp(first_at), key, None, votes[key], self.timestamp(last_at))
+
+    def suggestion_vote_rows(self):
+        for (key, email), voted_at in self.suggestion_votes.items():
+            yield (key, email, self.timestamp(voted_at))
+
+
+def generate(output, seed=42, now=None, guardians=5_000, films=50_000, donations=10_000, suggestions=None,
+             lapsed_fraction=0.08, adoption_ratio=0.6, raw_payloads=False, out=sys.stdout):
+    now = now or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    suggestions = films // 100 if suggestions is None else suggestions
+    generator = DatasetGenerator(seed, now, guardians, films, donations, suggestions,
+                                 lapsed_fraction, adoption_ratio, raw_payloads)
+
+    conn = sqlite3.connect(output)
+    for pragma in ("journal_mode = OFF", "synchronous = OFF", "locking_mode = EXCLUSIVE", "cache_size = -262144"):
+        conn.execute(f"PRAGMA {pragma}")
+    tables, deferred = schema_statements()
+    for statement in tables:
+        conn.execute(statement)
+
+    counts = {}
+    started = time.perf_counter()
+
+    def step(name, sql, rows):
+        step_started = time.perf_counter()
+        counts[name] = chunked_insert(conn, sql, rows)
+        conn.commit()
+        print(f"  {name}: {counts[name]} rows in {time.perf_counter() - step_started:.1f}s", file=out)
+
+    step("guardians", "INSERT INTO guardians (id, name, email, tier, token, joined_at, last_paid_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+         generator.guardian_rows())
+    step("films", """INSERT INTO films (id, title, year, plot, poster_url, region, guardian_id, status, magnet, updated_at, info_hash)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", generator.film_rows(generator.adoptions()))
+    step("kofi_events", """INSERT INTO kofi_events (id, timestamp, type, is_public, from_name, email, message, amount, currency, url,
+                           is_subscription_payment, is_first_subscription_payment, tier_name, kofi_transaction_id, raw_payload)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", generator.event_rows())
+    step("suggestions", """INSERT INTO suggestions (email, title, notes, status, suggested_at, title_key, year, votes, last_suggested_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", generator.suggestion_rows())
+    step("suggestion_votes", "INSERT INTO suggestion_votes (title_key, email, voted_at) VALUES (?, ?, ?)",
+         generator.suggestion_vote_rows())
+
+    index_started = time.perf_counter()
+    for statement in deferred:
+        conn.execute(statement)
+    conn.commit()
+    print(f"  indexes and triggers: {len(deferred)} built in {time.perf_counter() - index_started:.1f}s", file=out)
+    conn.close()
+
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic Shiosayi database.")
+    parser.add_argument("--output", default="shiosayi_test.db", help="Database file to create.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed; the same seed and --now give the same data.")
+    parser.add_argument("--now", type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+                        help="Reference date (YYYY-MM-DD) that generated timestamps are relative to. Defaults to today.")
+    parser.add_argument("--guardians", type=int, default=5_000)
+    parser.add_argument("--films", type=int, default=50_000)
+    parser.add_argument("--donations", type=int, default=10_000, help="One-off donations on top of each guardian's monthly payments.")
+    parser.add_argument("--suggestions", type=int, help="Defaults to 1%% of --films.")
+    parser.add_argument("--lapsed-fraction", type=float, default=0.08, help="Share of guardians whose last payment is over 35 days old.")
+    parser.add_argument("--adoption-ratio", type=float, default=0.6, help="Average share of their tier limit that guardians use.")
+    parser.add_argument("--raw-payloads", action="store_true", help="Store a JSON raw_payload on every Ko-fi event.")
+    parser.add_argument("--force", action="store_true", help="Overwrite the output file if it exists.")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        if not args.force:
+            sys.exit(f"'{args.output}' already exists. Use --force to overwrite it.")
+        os.remove(args.output)
+
+    print(f"Generating '{args.output}' (seed {args.seed})...")
+    result = generate(args.output, args.seed, args.now, args.guardians, args.films, args.donations, args.suggestions,
+                      args.lapsed_fraction, args.adoption_ratio, args.raw_payloads)
+    print(f"✅ Done in {result['seconds']}s. Run 'flask --app app rebuild-stats' against it to fill the stats rollups.")
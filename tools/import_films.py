@@ -0,0 +1,196 @@
+import os
+import sys
+import csv
+import json
+import time
+import string
+import sqlite3
+import argparse
+from datetime import datetime
+from urllib.parse import parse_qsl, quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+FIELDS = ('title', 'year', 'plot', 'poster_url', 'region', 'guardian_id', 'status', 'magnet', 'info_hash')
+MIN_YEAR = 1870
+# What COLLATE NOCASE folds: ASCII letters only, so "Émile" and "émile" stay distinct in both checks.
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def normalize_magnet(magnet):
+    """Returns (normalized_magnet, info_hash) for a BitTorrent magnet link.
+
+    The info-hash is lowercased hex (base32 hashes are converted), the xt parameter
+    comes first and duplicate trackers are dropped, so the same torrent always
+    produces the same link.
+    """
+    magnet = magnet.strip()
+    if not magnet.lower().startswith('magnet:?'):
+        raise InvalidRow("magnet link must start with 'magnet:?'")
+
+    info_hash, display_name, trackers = None, None, []
+    for key, value in parse_qsl(magnet[len('magnet:?'):], keep_blank_values=True):
+        key = key.lower()
+        if key == 'xt' and value.lower().startswith('urn:btih:'):
+            try:
+                info_hash = utils.btih_to_hex(value[len('urn:btih:'):])
+            except ValueError as e:
+                raise InvalidRow(str(e))
+        elif key == 'dn' and display_name is None:
+            display_name = value
+        elif key == 'tr' and value not in trackers:
+            trackers.append(value)
+
+    if not info_hash:
+        raise InvalidRow("magnet link has no 'xt=urn:btih:' info-hash")
+
+    parts = [f"xt=urn:btih:{info_hash}"]
+    if display_name:
+        parts.append(f"dn={quote(display_name, safe='')}")
+    parts.extend(f"tr={quote(tracker, safe='')}" for tracker in trackers)
+    return "magnet:?" + "&".join(parts), info_hash
+
+
+def validate_row(row, max_year):
+    if not isinstance(row, dict):
+        raise InvalidRow(f"expected an object, got {type(row).__name__}")
+    title = (row.get('title') or '').strip()
+    if not title:
+        raise InvalidRow("'title' is required")
+
+    year = row.get('year')
+    if year in (None, ''):
+        year = None
+    else:
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            raise InvalidRow(f"'year' must be an integer, got {year!r}")
+        if not MIN_YEAR <= year <= max_year:
+            raise InvalidRow(f"'year' {year} is out of range")
+
+    status = (row.get('status') or 'orphan').strip().lower()
+    guardian_id = row.get('guardian_id') or None
+    if status not in ('orphan', 'adopted'):
+        raise InvalidRow(f"'status' must be 'orphan' or 'adopted', got {status!r}")
+    if status == 'adopted' and guardian_id is None:
+        raise InvalidRow("adopted films need a 'guardian_id'")
+
+    magnet, info_hash = None, None
+    if row.get('magnet'):
+        magnet, info_hash = normalize_magnet(row['magnet'])
+
+    def optional(name):
+        value = row.get(name)
+        if value is None:
+            return None
+        return str(value).strip() or None
+
+    return (title, year, optional('plot'), optional('poster_url'), optional('region'),
+            str(guardian_id) if guardian_id is not None else None, status, magnet, info_hash)
+
+
+def read_rows(path, file_format):
+    """Yields (line_number, row_dict) without loading the whole file."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, InvalidRow(f"invalid JSON: {e}")
+
+
+def insert_batch(conn, batch):
+    """Inserts a batch, skipping rows whose info-hash or title+year already exists. Returns rows inserted."""
+    conn.execute("DELETE FROM import_batch")
+    conn.executemany(f"INSERT INTO import_batch ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})", batch)
+    cursor = conn.execute(f"""
+        INSERT INTO films ({', '.join(FIELDS)}, updated_at)
+        SELECT {', '.join(FIELDS)}, ? FROM import_batch b
+        WHERE NOT EXISTS (SELECT 1 FROM films f WHERE f.info_hash = b.info_hash)
+          AND NOT EXISTS (SELECT 1 FROM films f WHERE f.title = b.title COLLATE NOCASE AND f.year IS b.year)
+    """, (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+    conn.commit()
+    return cursor.rowcount
+
+
+def import_films(db_path, path, file_format=None, batch_size=5000, max_errors=20, out=sys.stdout):
+    file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    max_year = datetime.now().year + 1
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"CREATE TEMP TABLE import_batch ({', '.join(FIELDS)})")
+
+    stats = {"read": 0, "inserted": 0, "duplicates": 0, "invalid": 0}
+    seen_hashes, seen_titles = set(), set()
+    batch = []
+    started = time.perf_counter()
+
+    def flush():
+        inserted = insert_batch(conn, batch)
+        stats["inserted"] += inserted
+        stats["duplicates"] += len(batch) - inserted
+        batch.clear()
+
+    try:
+        for line_number, row in read_rows(path, file_format):
+            stats["read"] += 1
+            try:
+                if isinstance(row, InvalidRow):
+                    raise row
+                film = validate_row(row, max_year)
+            except InvalidRow as e:
+                stats["invalid"] += 1
+                if stats["invalid"] <= max_errors:
+                    print(f"  line {line_number}: {e}", file=out)
+                continue
+
+            title_key = (film[0].translate(NOCASE), film[1])
+            if (film[8] and film[8] in seen_hashes) or title_key in seen_titles:
+                stats["duplicates"] += 1
+                continue
+            if film[8]:
+                seen_hashes.add(film[8])
+            seen_titles.add(title_key)
+
+            batch.append(film)
+            if len(batch) >= batch_size:
+                flush()
+                elapsed = time.perf_counter() - started
+                print(f"  {stats['read']} rows read, {stats['inserted']} inserted ({stats['read'] / elapsed:.0f} rows/s)", file=out)
+        if batch:
+            flush()
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 3)
+    stats["rows_per_second"] = round(stats["read"] / elapsed) if elapsed else stats["read"]
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-import films from a CSV or JSONL catalog.")
+    parser.add_argument("path", help="CSV (with a header row) or JSONL file of films.")
+    parser.add_argument("--db", default=os.getenv("DATABASE_FILENAME", "shiosayi.db"), help="Path to the main database.")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Input format (default: guessed from the extension).")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Rows per transaction.")
+    args = parser.parse_args()
+
+    print(f"🎬 Importing films from '{args.path}' into '{args.db}'...")
+    result = import_films(args.db, args.path, args.format, args.batch_size)
+    print(f"✅ Done: {result['read']} read, {result['inserted']} inserted, {result['duplicates']} duplicates, "
+          f"{result['invalid']} invalid in {result['seconds']}s ({result['rows_per_second']} rows/s).")
@@ -0,0 +1,85 @@
+# tracing.py
+import os
+import re
+import sys
+import time
+import sqlite3
+import threading
+from collections import deque
+from flask import has_request_context, request
+from config import settings
+
+SLOW_QUERY_TRACE = settings.SLOW_QUERY_TRACE
+SLOW_QUERY_THRESHOLD_MS = settings.SLOW_QUERY_THRESHOLD_MS
+SLOW_QUERY_BUFFER_SIZE = settings.SLOW_QUERY_BUFFER_SIZE
+
+_slow_queries = deque(maxlen=SLOW_QUERY_BUFFER_SIZE)
+_lock = threading.Lock()
+_tracing = threading.local()
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_INTERNAL_MODULES = {'database', 'tracing', 'sqlite3'}
+
+
+def sql_shape(sql):
+    """Normalizes a statement so that calls differing only in literals or IN-list length look the same."""
+    shape = _STRING_LITERAL.sub("?", sql)
+    shape = _NUMBER_LITERAL.sub("?", shape)
+    shape = _PLACEHOLDER_LIST.sub("(?...)", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+
+def _caller():
+    """Returns 'module.function:line' for the nearest frame outside the database layer."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.split('.')[0] not in _INTERNAL_MODULES:
+            return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+def _query_plan(connection, sql, parameters):
+    try:
+        # Call the base class so the EXPLAIN itself is neither counted nor traced.
+        cursor = sqlite3.Connection.execute(connection, f"EXPLAIN QUERY PLAN {sql}", parameters or ())
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        return [f"unavailable: {e}"]
+
+
+def record_statement(connection, sql, parameters, seconds):
+    """Called for every statement run through get_db. Keeps the ones over the threshold."""
+    if seconds * 1000 < SLOW_QUERY_THRESHOLD_MS or getattr(_tracing, 'active', False):
+        return
+
+    _tracing.active = True
+    try:
+        entry = {
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_ms": round(seconds * 1000, 3),
+            "sql": sql_shape(sql),
+            "query_plan": _query_plan(connection, sql, parameters),
+            "caller": _caller(),
+            "route": request.url_rule.rule if has_request_context() and request.url_rule else None,
+            "pid": os.getpid(),
+        }
+    finally:
+        _tracing.active = False
+
+    with _lock:
+        _slow_queries.append(entry)
+
+
+def slow_queries():
+    with _lock:
+        return list(reversed(_slow_queries))
+
+
+def clear():
+    with _lock:
+        _slow_queries.clear()
@@ -1,17 +1,60 @@
 # utils.py
 import os
+import io
+import re
+import json
 import uuid
+import base64
+import hashlib
+import zipfile
+import logging
 import secrets
 import string
-from PIL import Image, UnidentifiedImageError
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
 from werkzeug.utils import secure_filename
+from config import settings
 
-CDN_STORAGE_PATH = os.getenv("CDN_STORAGE_PATH")
-CDN_BASE_URL = os.getenv("CDN_BASE_URL")
+# PIL is imported inside the functions that need it: most workers and CLI commands never touch
+# a poster, and importing it at startup would cost every one of them.
 TARGET_WIDTH = 350
 TARGET_ASPECT_RATIO = 2 / 3
 ASPECT_RATIO_TOLERANCE = 0.05
 MAX_FILE_SIZE_BYTES = 1 * 1024 * 1024
+MAX_POSTER_PIXELS = 40_000_000
+JPEG_MAGIC = b'\xff\xd8\xff'
+POSTER_WORKERS = settings.POSTER_WORKERS
+POSTER_QUEUE_LIMIT = settings.POSTER_QUEUE_LIMIT
+# Widths in pixels; 'detail' keeps the original single-size output.
+POSTER_VARIANTS = {'thumb': 120, 'list': 240, 'detail': TARGET_WIDTH, 'detail2x': TARGET_WIDTH * 2}
+POSTER_ENCODER_OPTIONS = {
+    'jpeg': {'quality': 85, 'optimize': True, 'progressive': True},
+    'webp': {'quality': 80, 'method': 4},
+    'avif': {'quality': 60, 'speed': 8},
+}
+POSTER_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp', 'avif': 'avif'}
+POSTER_SOURCE_EXTENSIONS = ('.jpg', '.jpeg')
+POSTER_MIME_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+# A release year in brackets anywhere, or after a comma or dash at the end: "Ran (1985)", "Ran - 1985".
+# A bare trailing number is left alone, since it is usually part of the title ("Blade Runner 2049").
+TITLE_YEAR = re.compile(r"[(\[]\s*((?:18|19|20)\d\d)\s*[)\]]|[,\-\u2013\u2014]\s*((?:18|19|20)\d\d)\s*$")
+TITLE_APOSTROPHES = re.compile(r"['\u2019`]")
+TITLE_WORD = re.compile(r"[^\W_]+")
+
+# Uploads are rendered on a pool of POSTER_WORKERS threads per worker process, so the request
+# that accepted them returns at once. Slots cover the renders running and POSTER_QUEUE_LIMIT waiting.
+_poster_slots = threading.BoundedSemaphore(POSTER_WORKERS + POSTER_QUEUE_LIMIT)
+_poster_executor = None
+_poster_executor_lock = threading.Lock()
+_posters_admitted = 0
+_posters_admitted_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
 
 
 def generate_api_token(prefix="shio", length=32):
@@ -20,55 +63,394 @@ def generate_api_token(prefix="shio", length=32):
     token = ''.join(secrets.choice(alphabet) for _ in range(length))
     return f"{prefix}_{token}"
 
-def process_and_save_poster(file_storage):
+
+def normalize_title(title):
     """
-    Validates, resizes, and saves an uploaded film poster.
-    
-    Args:
-        file_storage: The FileStorage object from Flask's request.files.
+    Returns (key, year) for a free-text film title, so spellings of the same film share a key.
 
-    Returns:
-        A dictionary with the result:
-        {'success': True, 'url': '...', 'path': '...'} or
-        {'success': False, 'error': '...'}
+    The key is the title case-folded, with diacritics and punctuation removed and the release
+    year (if one is given) appended: "Amélie (2001)", "AMELIE, 2001" and "amelie [2001]" are all
+    "amelie|2001". Without a year the key ends in "|".
     """
-    if not CDN_STORAGE_PATH or not CDN_BASE_URL:
-        return {'success': False, 'error': 'Server configuration error: CDN_STORAGE_PATH or CDN_BASE_URL is not set.'}
+    year = None
+    match = TITLE_YEAR.search(title)
+    if match:
+        year = int(match[1] or match[2])
+        title = f"{title[:match.start()]} {title[match.end():]}"
+    text = unicodedata.normalize('NFKD', TITLE_APOSTROPHES.sub('', title).casefold())
+    words = TITLE_WORD.findall(''.join(c for c in text if not unicodedata.combining(c)))
+    # A title of nothing but punctuation still gets a key of its own rather than sharing an empty one.
+    key = ' '.join(words) or ' '.join(title.casefold().split())
+    return f"{key}|{year or ''}", year
 
-    filename = f"{uuid.uuid4().hex}.jpg"
-    
-    posters_dir = os.path.join(CDN_STORAGE_PATH, 'posters')
-    save_path = os.path.join(posters_dir, filename)
 
-    filename = f"{uuid.uuid4().hex}.jpg"
-    file_storage.seek(0, os.SEEK_END)
+def btih_to_hex(raw_hash):
+    """
+    Returns the lowercase hex form of a magnet link's urn:btih: info-hash, given as 40 hex digits
+    or 32 base32 characters. Raises ValueError, saying what is wrong, for anything else.
+    """
+    if len(raw_hash) == 40:
+        try:
+            return bytes.fromhex(raw_hash).hex()
+        except ValueError:
+            raise ValueError(f"invalid hex info-hash '{raw_hash}'")
+    if len(raw_hash) == 32:
+        try:
+            return base64.b32decode(raw_hash.upper()).hex()
+        except ValueError:
+            raise ValueError(f"invalid base32 info-hash '{raw_hash}'")
+    raise ValueError(f"info-hash '{raw_hash}' has an unexpected length")
 
+def inspect_poster(file_storage):
+    """
+    Checks size, format and aspect ratio from the file size and the JPEG header alone.
+
+    Returns (image, None) with the header parsed but no pixels decoded, or (None, error).
+    """
+    file_storage.seek(0, os.SEEK_END)
     file_size = file_storage.tell()
     if file_size > MAX_FILE_SIZE_BYTES:
-        return {'success': False, 'error': f'File is too large. Maximum size is {MAX_FILE_SIZE_BYTES / 1024 / 1024} MB.'}
+        return None, f'File is too large. Maximum size is {MAX_FILE_SIZE_BYTES / 1024 / 1024} MB.'
+    file_storage.seek(0)
+
+    if file_storage.read(3) != JPEG_MAGIC:
+        return None, 'Invalid file type. Only JPEG images are allowed.'
     file_storage.seek(0)
 
+    from PIL import Image, UnidentifiedImageError
     try:
-        img = Image.open(file_storage)
+        # Image.open only parses the header; restricting it to JPEG skips probing other formats.
+        img = Image.open(file_storage, formats=['JPEG'])
+    except UnidentifiedImageError:
+        return None, 'Cannot identify image file. It may be corrupt or not a valid image.'
 
-        if img.format != 'JPEG':
-            return {'success': False, 'error': 'Invalid file type. Only JPEG images are allowed.'}
+    if img.width * img.height > MAX_POSTER_PIXELS:
+        return None, f'Image is too large. Maximum is {MAX_POSTER_PIXELS} pixels.'
 
-        actual_ratio = img.width / img.height
-        if abs(actual_ratio - TARGET_ASPECT_RATIO) > ASPECT_RATIO_TOLERANCE:
-            error_msg = f'Invalid aspect ratio. Image ratio is {actual_ratio:.2f}, but must be near {TARGET_ASPECT_RATIO:.2f} (2:3).'
-            return {'success': False, 'error': error_msg}
+    actual_ratio = img.width / img.height
+    if abs(actual_ratio - TARGET_ASPECT_RATIO) > ASPECT_RATIO_TOLERANCE:
+        return None, f'Invalid aspect ratio. Image ratio is {actual_ratio:.2f}, but must be near {TARGET_ASPECT_RATIO:.2f} (2:3).'
 
-        new_height = int(TARGET_WIDTH / actual_ratio)
-        resized_img = img.resize((TARGET_WIDTH, new_height), Image.Resampling.LANCZOS)
-        os.makedirs(posters_dir, exist_ok=True)
-        resized_img.save(save_path, 'JPEG', quality=85, optimize=True)
-        
-        final_url = f"{CDN_BASE_URL}/posters/{filename}"
-        return {'success': True, 'url': final_url, 'path': save_path}
+    return img, None
 
-    except UnidentifiedImageError:
-        return {'success': False, 'error': 'Cannot identify image file. It may be corrupt or not a valid image.'}
+
+def _available_formats():
+    from PIL import features
+    formats = ['jpeg']
+    for name in ('webp', 'avif'):
+        try:
+            if features.check(name):
+                formats.append(name)
+        except ValueError:
+            # Older Pillow releases do not know the feature name at all.
+            pass
+    return formats
+
+
+_requested_formats = settings.POSTER_FORMATS
+
+
+@lru_cache(maxsize=None)
+def poster_formats():
+    """The formats every poster is written in. JPEG is always included, as the fallback every client accepts."""
+    return ['jpeg'] + [name for name in _available_formats() if name != 'jpeg' and name in _requested_formats]
+
+
+def _render_variants(img, poster_id, posters_dir):
+    """Decodes once, then writes every size in every available format. Returns (manifest, timings)."""
+    timings = {}
+    ratio = img.width / img.height
+    largest = max(POSTER_VARIANTS.values())
+
+    started = time.perf_counter()
+    # Draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale, as long as the result stays
+    # at least as large as the biggest variant, so most of the full-resolution work is never done.
+    img.draft('RGB', (largest, int(largest / ratio)))
+    img.load()
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    timings['decode'] = time.perf_counter() - started
+
+    manifest = {"id": poster_id, "variants": {}}
+    os.makedirs(posters_dir, exist_ok=True)
+    written = []
+    try:
+        _write_variants(img, ratio, posters_dir, manifest, timings, written)
+    except Exception:
+        # Only files this call created: another poster may share a content-hashed name.
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    return manifest, timings
+
+
+def _write_variants(img, ratio, posters_dir, manifest, timings, written):
+    from PIL import Image
+    source = img
+    for variant, width in sorted(POSTER_VARIANTS.items(), key=lambda item: -item[1]):
+        started = time.perf_counter()
+        # Never upscale: a small source gives a smaller 2x variant rather than a blurry one.
+        width = min(width, img.width)
+        size = (width, round(width / ratio))
+        # Largest first, each variant resized from the previous one instead of the full decode.
+        resized_img = source if size == source.size else source.resize(size, Image.Resampling.LANCZOS)
+        source = resized_img
+        timings['resize'] = timings.get('resize', 0) + time.perf_counter() - started
+
+        files = {}
+        for image_format in poster_formats():
+            started = time.perf_counter()
+            buffer = io.BytesIO()
+            resized_img.save(buffer, image_format.upper(), **POSTER_ENCODER_OPTIONS[image_format])
+            data = buffer.getvalue()
+            # Content-hashed names never change meaning, so they can be cached forever.
+            filename = f"{hashlib.sha256(data).hexdigest()[:20]}.{POSTER_EXTENSIONS[image_format]}"
+            path = os.path.join(posters_dir, filename)
+            if not os.path.exists(path):
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+                written.append(path)
+            files[image_format] = {"file": filename, "bytes": len(data)}
+            timings[f'encode_{image_format}'] = timings.get(f'encode_{image_format}', 0) + time.perf_counter() - started
+
+        manifest["variants"][variant] = {"width": size[0], "height": size[1], "files": files}
+
+    manifest["phash"] = perceptual_hash(source)
+    manifest_path = os.path.join(posters_dir, f"{manifest['id']}.json")
+    with open(manifest_path, "w") as f:
+        written.append(manifest_path)
+        json.dump(manifest, f, indent=2)
+
+
+def perceptual_hash(img):
+    """64-bit difference hash as 16 hex digits: near-identical images differ in only a few bits."""
+    from PIL import Image
+    small = img.convert('L').resize((9, 8), Image.Resampling.BOX)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{value:016x}"
+
+
+def fingerprint_poster(data):
+    """Process-pool worker: validates a poster and returns (phash, None) or (None, error)."""
+    img, error = inspect_poster(io.BytesIO(data))
+    if error:
+        return None, error
+    try:
+        # The hash only needs a few dozen pixels, so let libjpeg decode at 1/8 scale.
+        img.draft('L', (72, 64))
+        return perceptual_hash(img), None
+    except Exception as e:
+        return None, f'Cannot decode image: {e}'
+    finally:
+        img.close()
+
+
+def render_poster(data, poster_id, posters_dir):
+    """Process-pool worker: writes every variant of an already validated poster. Returns (manifest, None) or (None, error)."""
+    img, error = inspect_poster(io.BytesIO(data))
+    if error:
+        return None, error
+    try:
+        manifest, _ = _render_variants(img, poster_id, posters_dir)
+        return manifest, None
+    except Exception as e:
+        return None, f'Cannot render image: {e}'
+    finally:
+        img.close()
+
+
+def _poster_members(archive):
+    return [member for member in archive.infolist()
+            if not member.is_dir() and member.filename.lower().endswith(POSTER_SOURCE_EXTENSIONS)]
+
+
+def count_poster_files(file):
+    """The number of JPEGs in a zip archive, from its central directory alone. Rewinds the file."""
+    with zipfile.ZipFile(file) as archive:
+        count = len(_poster_members(archive))
+    file.seek(0)
+    return count
+
+
+def iter_poster_files(path):
+    """
+    Yields (name, bytes) for every JPEG in a directory tree, or in a zip archive given as a path or file object.
+
+    At most MAX_FILE_SIZE_BYTES + 1 bytes are read of each file, whatever size a zip member
+    claims, so an oversized file costs no more memory than a valid one and is rejected as too large.
+    """
+    if isinstance(path, (str, os.PathLike)) and os.path.isdir(path):
+        for root, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(POSTER_SOURCE_EXTENSIONS):
+                    with open(os.path.join(root, filename), 'rb') as f:
+                        yield filename, f.read(MAX_FILE_SIZE_BYTES + 1)
+        return
+    with zipfile.ZipFile(path) as archive:
+        for member in _poster_members(archive):
+            with archive.open(member) as f:
+                yield os.path.basename(member.filename), f.read(MAX_FILE_SIZE_BYTES + 1)
+
+
+def load_poster_manifest(poster_id):
+    try:
+        with open(os.path.join(settings.CDN_STORAGE_PATH, 'posters', f"{poster_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def negotiate_poster_format(manifest, variant, accept_header):
+    """
+    Returns the file name of the format the client prefers for a variant, by Accept q-value and
+    then by size, or None if the variant is unknown or the client accepts none of its formats.
+
+    AVIF and WebP are only sent to clients that name them; wildcards (image/*, */*) and a
+    missing Accept header get JPEG, which every client can decode.
+    """
+    entry = manifest.get("variants", {}).get(variant)
+    if not entry:
+        return None
+    if not accept_header:
+        return entry["files"]["jpeg"]["file"]
+    accept = parse_accept_header(accept_header, MIMEAccept)
+    named = {value.lower(): quality for value, quality in accept}
+    # Smallest first, so a tie goes to the smaller file.
+    qualities = {image_format: named.get(f"image/{image_format}", 0)
+                 for image_format in ('avif', 'webp') if image_format in entry["files"]}
+    qualities['jpeg'] = accept.quality('image/jpeg')
+    image_format = max(qualities, key=qualities.get)
+    return entry["files"][image_format]["file"] if qualities[image_format] > 0 else None
+
+
+def staged_poster_path(poster_id):
+    """Where an accepted upload waits, outside the served posters directory, until it is rendered."""
+    return os.path.join(settings.CDN_STORAGE_PATH, 'posters', 'incoming', f"{poster_id}.jpg")
+
+
+def stage_poster(file_storage):
+    """
+    Validates an uploaded film poster from its header and saves the original for rendering.
+
+    Args:
+        file_storage: The FileStorage object from Flask's request.files.
+
+    Returns:
+        {'success': True, 'id': '...', 'sha256': '...', 'timings_ms': {...}} or
+        {'success': False, 'error': '...', 'timings_ms': {...}}
+        No pixels are decoded here; render_staged_poster does that off the request thread.
+        The sha256 is of the bytes staged, which is never more than MAX_FILE_SIZE_BYTES.
+    """
+    if not settings.CDN_STORAGE_PATH or not settings.CDN_BASE_URL:
+        return {'success': False, 'error': 'Server configuration error: CDN_STORAGE_PATH or CDN_BASE_URL is not set.'}
+
+    poster_id = uuid.uuid4().hex
+    timings = {}
+    started = time.perf_counter()
+    # Read at most one byte past the limit, so an oversized file still fails the size check.
+    file_storage.seek(0)
+    data = file_storage.read(MAX_FILE_SIZE_BYTES + 1)
+    img, error = inspect_poster(io.BytesIO(data))
+    timings['inspect'] = time.perf_counter() - started
+    if error:
+        return {'success': False, 'error': error, 'timings_ms': _to_ms(timings)}
+    img.close()
+
+    path = staged_poster_path(poster_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+    return {'success': True, 'id': poster_id, 'sha256': hashlib.sha256(data).hexdigest(), 'timings_ms': _to_ms(timings)}
+
+
+def discard_staged_poster(poster_id):
+    try:
+        os.remove(staged_poster_path(poster_id))
+    except OSError:
+        pass
+
+
+def render_staged_poster(poster_id):
+    """
+    Saves a staged poster in every size and format. The staged original is left for the caller to discard.
+
+    Returns:
+        {'success': True, 'url': '...', 'manifest': {...}, 'timings_ms': {...}} or
+        {'success': False, 'error': '...', 'timings_ms': {...}}
+        'url' is the content-hashed JPEG of the 'detail' variant, which matches the old single output.
+    """
+    posters_dir = os.path.join(settings.CDN_STORAGE_PATH, 'posters')
+    path = staged_poster_path(poster_id)
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            img, error = inspect_poster(f)
+            if error:
+                return {'success': False, 'error': error, 'timings_ms': {}}
+            try:
+                manifest, timings = _render_variants(img, poster_id, posters_dir)
+            finally:
+                img.close()
     except Exception as e:
-        logging.error(f"Error processing poster for '{filename}': {e}")
-        return {'success': False, 'error': 'An unexpected error occurred during image processing.'}
\ No newline at end of file
+        logger.error("Error processing poster '%s': %s", poster_id, e)
+        return {'success': False, 'error': 'An unexpected error occurred during image processing.', 'timings_ms': {}}
+    timings['total'] = time.perf_counter() - started
+
+    logger.debug("Poster '%s' processed: %s", poster_id, timings)
+    detail_file = manifest["variants"]["detail"]["files"]["jpeg"]["file"]
+    return {
+        'success': True,
+        'url': f"{settings.CDN_BASE_URL}/posters/{detail_file}",
+        'manifest': manifest,
+        'timings_ms': _to_ms(timings)
+    }
+
+
+def submit_poster_render(func, *args):
+    """
+    Runs func(*args) on this worker's poster render pool. Returns False without queueing it when
+    POSTER_WORKERS renders are running and POSTER_QUEUE_LIMIT more are already waiting.
+    """
+    global _poster_executor
+    if not _poster_slots.acquire(blocking=False):
+        return False
+    with _poster_executor_lock:
+        if _poster_executor is None:
+            _poster_executor = ThreadPoolExecutor(max_workers=POSTER_WORKERS, thread_name_prefix="poster-render")
+    _count_admitted(1)
+
+    def run():
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Poster render failed.")
+        finally:
+            _count_admitted(-1)
+            _poster_slots.release()
+
+    _poster_executor.submit(run)
+    return True
+
+
+def _count_admitted(delta):
+    global _posters_admitted
+    with _posters_admitted_lock:
+        _posters_admitted += delta
+
+
+def poster_backlog():
+    """Uploads rendering or waiting for the render pool in this worker."""
+    return _posters_admitted
+
+
+def _to_ms(timings):
+    return {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}